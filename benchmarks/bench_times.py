@@ -0,0 +1,92 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+"""bench_times.py
+Micro-benchmarks for the time handling on the processing hot paths.
+Compares the strptime-based ISO8601 parser and per-point datetime hour/day
+arithmetic that the pipeline used to run, against the shared fixed-width parser,
+integer epoch-ns arithmetic and the vectorized lookups.
+Run from the repository root: python3 benchmarks/bench_times.py [-n POINTS]
+Prints the cost per point of each variant, in nanoseconds.
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, time as d_time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline.lookups import IntensityIndex, SiloIndex  # noqa: E402
+from pipeline.utils import (HOUR_NS, datetime_to_epoch_ns, datetime_to_isostring, epoch_ns_to_datetime,  # noqa: E402
+                            epoch_ns_to_isostring, isostring_to_datetime, isostring_to_epoch_ns)
+
+START_NS = 1546300800 * 1000000000  # 2019-01-01T00:00:00Z
+STEP_NS = 3600 * 1000000000 // 4
+
+
+def legacy_isostring_to_datetime(iso_string):
+    # The strptime parser that pipeline/utils.py and nmdb/utils.py used to have
+    if iso_string.endswith('Z'):
+        iso_string = iso_string[:-1] + "+0000"
+    else:
+        last4 = iso_string[-4:]
+        if ":" in last4:
+            iso_string = iso_string[:-4] + last4.replace(":", "")
+    try:
+        return datetime.strptime(iso_string, "%Y-%m-%dT%H:%M:%S%z")
+    except ValueError:
+        return datetime.strptime(iso_string, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def legacy_hour_start(at_time):
+    # How the start of a point's hour used to be found
+    return datetime.combine(at_time.date(), d_time(at_time.hour, 0, 0, 0, tzinfo=at_time.tzinfo))
+
+
+def bench(name, fn, points, repeat):
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    print("{:<48} {:>10.1f} ns/point".format(name, best * 1e9 / points))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time handling micro-benchmarks.")
+    parser.add_argument('-n', '--points', type=int, default=100000, help="Number of points per benchmark.")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Take the best of this many runs.")
+    args = parser.parse_args()
+    n = args.points
+    times = np.arange(START_NS, START_NS + n * STEP_NS, STEP_NS, dtype=np.int64)[:n]
+    time_list = times.tolist()
+    strings = [epoch_ns_to_isostring(t) for t in time_list]
+    datetimes = [epoch_ns_to_datetime(t) for t in time_list]
+
+    print("Parsing {} ISO8601 strings".format(n))
+    bench("strptime to datetime (legacy)", lambda: [legacy_isostring_to_datetime(s) for s in strings], n, args.repeat)
+    bench("isostring_to_datetime", lambda: [isostring_to_datetime(s) for s in strings], n, args.repeat)
+    bench("strptime to epoch ns (legacy)",
+          lambda: [datetime_to_epoch_ns(legacy_isostring_to_datetime(s)) for s in strings], n, args.repeat)
+    bench("isostring_to_epoch_ns", lambda: [isostring_to_epoch_ns(s) for s in strings], n, args.repeat)
+
+    print("Formatting {} times".format(n))
+    bench("datetime_to_isostring", lambda: [datetime_to_isostring(d) for d in datetimes], n, args.repeat)
+    bench("epoch_ns_to_isostring", lambda: [epoch_ns_to_isostring(t) for t in time_list], n, args.repeat)
+
+    print("Hour flooring {} times".format(n))
+    bench("datetime.combine (legacy)", lambda: [legacy_hour_start(d) for d in datetimes], n, args.repeat)
+    bench("integer, per point", lambda: [t - t % HOUR_NS for t in time_list], n, args.repeat)
+    bench("integer, array", lambda: times - times % HOUR_NS, n, args.repeat)
+
+    # an intensity record every hour and SILO data every day, as in production
+    intensity_times = np.arange(times[0] - HOUR_NS, times[-1] + HOUR_NS, HOUR_NS, dtype=np.int64)
+    intensity_index = IntensityIndex(intensity_times, np.linspace(90.0, 110.0, len(intensity_times)))
+    silo_times = np.arange(times[0] - times[0] % (24 * HOUR_NS), times[-1] + 24 * HOUR_NS, 24 * HOUR_NS,
+                           dtype=np.int64)
+    silo_index = SiloIndex(silo_times, np.full(len(silo_times), 20.0), np.full(len(silo_times), 50.0))
+    print("Intensity and SILO lookups for {} points".format(n))
+    bench("IntensityIndex.lookup_many", lambda: intensity_index.lookup_many(times), n, args.repeat)
+    bench("SiloIndex.averages_many", lambda: silo_index.averages_many(times), n, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
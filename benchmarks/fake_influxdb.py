@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+#
+"""fake_influxdb.py
+An in-process stand-in for the InfluxDB 1.x HTTP API, for benchmarks.
+It serves /ping, /query and /write on a local port, so the pipeline's own
+InfluxDBClient talks to it over HTTP exactly as it talks to the real server.
+Only the InfluxQL the pipeline uses, now and before it was reworked, is understood:
+SELECT of columns, * or COUNT(field), with AND-ed tag and time conditions,
+GROUP BY time(), ORDER BY time and LIMIT; FIRST(field) and LAST(field), with other
+columns of the selected point; MEAN(field) and LAST(*); DIFFERENCE(field); a
+subquery in place of the measurement; SELECT * INTO ... GROUP BY *; DELETE;
+DROP SERIES; and CREATE DATABASE, which is ignored.
+Chunked responses and the epoch parameter behave like the real server.
+Every request is counted, with the bytes and points that went each way.
+"""
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import re
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+NS_PER_SECOND = 1000000000
+EPOCH_DIVISORS = {'h': 3600 * NS_PER_SECOND, 'm': 60 * NS_PER_SECOND, 's': NS_PER_SECOND,
+                  'ms': 1000000, 'u': 1000, 'ns': 1}
+DEFAULT_CHUNK_SIZE = 10000
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+_ISOSTRING = re.compile(r'''^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(?:Z|([+-])(\d\d):(\d\d))$''')
+_CONDITION = re.compile(r'''("?\w+"?)\s*(>=|<=|!=|=|>|<)\s*('[^']*'|\$\w+|-?\d+)''')
+_SELECT = re.compile(r'''^SELECT\s+(?P<columns>.+?)\s+FROM\s+(?P<measurement>"[^"]+"|\w+|\((?P<subquery>SELECT\s.+)\))'''
+                     r'''(?:\s+WHERE\s+(?P<where>.+?))?'''
+                     r'''(?:\s+GROUP\s+BY\s+time\((?P<interval>\d+)s(?:,\s*(?P<offset>\d+)s)?\)(?:\s*,\s*(?P<tags>"?\w+"?))?)?'''
+                     r'''(?:\s+ORDER\s+BY\s+time\s+(?P<order>ASC|DESC))?'''
+                     r'''(?:\s+LIMIT\s+(?P<limit>\d+))?$''', re.IGNORECASE | re.DOTALL)
+_SELECT_INTO = re.compile(r'''^SELECT\s+\*\s+INTO\s+(?P<target>"[^"]+"|\w+)\s+FROM\s+(?P<measurement>"[^"]+"|\w+)'''
+                          r'''(?:\s+WHERE\s+(?P<where>.+?))?\s+GROUP\s+BY\s+\*$''', re.IGNORECASE | re.DOTALL)
+_DELETE = re.compile(r'''^(?:DELETE|DROP\s+SERIES)\s+FROM\s+(?P<measurement>"[^"]+"|\w+)'''
+                     r'''(?:\s+WHERE\s+(?P<where>.+))?$''', re.IGNORECASE | re.DOTALL)
+_COUNT = re.compile(r'''^COUNT\(\s*"?(\w+)"?\s*\)$''', re.IGNORECASE)
+_FUNCTION = re.compile(r'''^(?P<function>MEAN|FIRST|LAST|DIFFERENCE)\(\s*(?P<field>\*|"?\w+"?)\s*\)'''
+                       r'''(?:\s+as\s+(?P<alias>"[^"]+"|\w+))?$''', re.IGNORECASE)
+
+
+def rfc3339(epoch_ns):
+    """
+    Format a time the way InfluxDB does, with trailing zeros of the fraction left off.
+    """
+    seconds, nanosecond = divmod(int(epoch_ns), NS_PER_SECOND)
+    days, seconds = divmod(seconds, 86400)
+    day = date.fromordinal(days + _EPOCH_ORDINAL)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    s = "%04d-%02d-%02dT%02d:%02d:%02d" % (day.year, day.month, day.day, hour, minute, second)
+    if nanosecond:
+        s += ("." + "%09d" % nanosecond).rstrip('0')
+    return s + "Z"
+
+
+def isostring_to_epoch_ns(iso_string):
+    """
+    Parse a time in a query. Kept apart from pipeline.utils, so that benchmarks also run against older pipelines.
+    """
+    match = _ISOSTRING.match(iso_string)
+    if match is None:
+        raise ValueError("invalid time: {}".format(iso_string))
+    year, month, day, hour, minute, second = (int(g) for g in match.groups()[:6])
+    fraction, sign, offset_h, offset_m = match.groups()[6:]
+    days = date(year, month, day).toordinal() - _EPOCH_ORDINAL
+    offset = 0 if sign is None else (int(offset_h) * 3600 + int(offset_m) * 60) * (1 if sign == '+' else -1)
+    nanosecond = int(fraction[:9].ljust(9, '0')) if fraction else 0
+    return (days * 86400 + hour * 3600 + minute * 60 + second - offset) * NS_PER_SECOND + nanosecond
+
+
+def _unquote(name):
+    return name.strip().strip('"')
+
+
+def _split_unescaped(text, sep):
+    """
+    Split line protocol text on sep, ignoring escaped separators and separators inside double quotes.
+    """
+    parts = []
+    current = []
+    quoted = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\' and i + 1 < len(text):
+            current.append(text[i + 1])
+            i += 2
+            continue
+        if c == '"':
+            quoted = not quoted
+        if c == sep and not quoted:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(c)
+        i += 1
+    parts.append(''.join(current))
+    return parts
+
+
+def _column_value(tags, fields, name):
+    value = fields.get(name, None)
+    return tags.get(name, None) if value is None else value
+
+
+def _field_value(text):
+    if text.startswith('"'):
+        return text[1:-1]
+    if text.endswith('i'):
+        return int(text[:-1])
+    if text in ('t', 'T', 'true', 'True', 'TRUE'):
+        return True
+    if text in ('f', 'F', 'false', 'False', 'FALSE'):
+        return False
+    return float(text)
+
+
+def parse_line(line, precision_ns=1):
+    """
+    :return: (measurement, tags, fields, epoch-ns time or None) for one line of line protocol
+    """
+    parts = _split_unescaped(line, ' ')
+    series = _split_unescaped(parts[0], ',')
+    tags = dict(t.split('=', 1) for t in series[1:])
+    fields = {}
+    for f in _split_unescaped(parts[1], ','):
+        k, v = f.split('=', 1)
+        fields[k] = _field_value(v)
+    at = int(parts[2]) * precision_ns if len(parts) > 2 and parts[2] else None
+    return series[0], tags, fields, at
+
+
+class FakeInfluxDB(object):
+    """
+    The stored data and request counters, shared by every handler thread.
+    Data is kept per measurement as {(time, sorted tag items): (tags, fields)}, so a point
+    written again at the same time with the same tags replaces the old one, as in InfluxDB.
+    """
+    __slots__ = ('measurements', 'lock', 'stats')
+
+    def __new__(cls):
+        self = super(FakeInfluxDB, cls).__new__(cls)
+        self.measurements = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+        return self
+
+    def reset_stats(self):
+        self.stats = {'query_requests': 0, 'queries': 0, 'write_requests': 0, 'points_read': 0,
+                      'points_written': 0, 'bytes_received': 0, 'bytes_sent': 0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def write_lines(self, body, precision=None):
+        precision_ns = EPOCH_DIVISORS.get(precision or 'ns', 1)
+        n = 0
+        with self.lock:
+            for line in body.splitlines():
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                measurement, tags, fields, at = parse_line(line, precision_ns)
+                key = (at, tuple(sorted(tags.items())))
+                series = self.measurements.setdefault(measurement, {})
+                if key in series:
+                    series[key][1].update(fields)
+                else:
+                    series[key] = (tags, fields)
+                n += 1
+            self.stats['points_written'] += n
+        return n
+
+    def _conditions(self, where, bind_params):
+        tag_conditions = []
+        time_conditions = []
+        if not where:
+            return tag_conditions, time_conditions
+        for name, op, value in _CONDITION.findall(where):
+            name = _unquote(name)
+            if value.startswith('$'):
+                value = str(bind_params[value[1:]])
+            elif value.startswith("'"):
+                value = value[1:-1]
+            if name == 'time':
+                value = int(value) if value.lstrip('-').isdigit() else isostring_to_epoch_ns(value)
+                time_conditions.append((op, value))
+            else:
+                tag_conditions.append((name, op, value))
+        return tag_conditions, time_conditions
+
+    @staticmethod
+    def _matches(value, op, expected):
+        if op == '=':
+            return value == expected
+        if op == '!=':
+            return value != expected
+        if op == '>':
+            return value > expected
+        if op == '<':
+            return value < expected
+        if op == '>=':
+            return value >= expected
+        return value <= expected
+
+    def _select_rows(self, measurement, tag_conditions, time_conditions):
+        rows = []
+        with self.lock:
+            series = self.measurements.get(measurement, {})
+            for (at, _), (tags, fields) in series.items():
+                if all(self._matches(at, op, v) for op, v in time_conditions) and \
+                        all(self._matches(tags.get(name, ''), op, v) for name, op, v in tag_conditions):
+                    rows.append((at, tags, fields))
+        rows.sort(key=lambda r: r[0])
+        return rows
+
+    def delete(self, measurement, where, bind_params):
+        tag_conditions, time_conditions = self._conditions(where, bind_params)
+        with self.lock:
+            series = self.measurements.get(measurement, {})
+            for key in [k for k, (tags, _) in series.items()
+                        if all(self._matches(k[0], op, v) for op, v in time_conditions) and
+                        all(self._matches(tags.get(name, ''), op, v) for name, op, v in tag_conditions)]:
+                del series[key]
+
+    def select_into(self, match, bind_params):
+        """
+        Copy the matching points, with their tags, to the target measurement.
+        :return: the number of points written
+        """
+        tag_conditions, time_conditions = self._conditions(match.group('where'), bind_params)
+        rows = self._select_rows(_unquote(match.group('measurement')), tag_conditions, time_conditions)
+        with self.lock:
+            series = self.measurements.setdefault(_unquote(match.group('target')), {})
+            for at, tags, fields in rows:
+                series[(at, tuple(sorted(tags.items())))] = (dict(tags), dict(fields))
+            self.stats['points_written'] += len(rows)
+        return len(rows)
+
+    def select(self, match, bind_params):
+        """
+        :return: (columns, list of row value lists, series name), times as epoch-ns, or for a COUNT
+            grouped by a tag, a list of (columns, values, series name, tags) for each of its values
+        """
+        tag_conditions, time_conditions = self._conditions(match.group('where'), bind_params)
+        subquery = match.group('subquery')
+        if subquery is None:
+            name = _unquote(match.group('measurement'))
+            rows = self._select_rows(name, tag_conditions, time_conditions)
+        else:
+            inner = _SELECT.match(subquery.strip())
+            if inner is None:
+                raise ValueError("error parsing query: {}".format(subquery))
+            columns, values, name = self.select(inner, bind_params)
+            # the subquery's columns are the outer query's fields
+            rows = [(v[0], {}, dict(zip(columns[1:], v[1:]))) for v in values
+                    if all(self._matches(v[0], op, t) for op, t in time_conditions)]
+        # aggregates without GROUP BY time() are timed at the start of the query's time range
+        lower = min([v for op, v in time_conditions if op in ('>', '>=')] or [0])
+        items = [c.strip() for c in match.group('columns').split(',')]
+        count = _COUNT.match(items[0]) if len(items) == 1 else None
+        if count is not None:
+            field = count.group(1)
+            values = [r[0] for r in rows if r[2].get(field, None) is not None]
+            interval = match.group('interval')
+            if interval is None:
+                return ['time', 'count'], ([[lower, len(values)]] if values else []), name
+            interval_ns = int(interval) * NS_PER_SECOND
+            offset_ns = int(match.group('offset') or 0) * NS_PER_SECOND
+            if match.group('tags') is None:
+                return ['time', 'count'], self._count_buckets(values, interval_ns, offset_ns), name
+            # one series for each value of the tag
+            tag = _unquote(match.group('tags'))
+            tag_times = {}
+            for at, tags, fields in rows:
+                if fields.get(field, None) is not None:
+                    tag_times.setdefault(tags.get(tag, ''), []).append(at)
+            return [(['time', 'count'], self._count_buckets(times, interval_ns, offset_ns), name, {tag: value})
+                    for value, times in sorted(tag_times.items())]
+        functions = [_FUNCTION.match(item) for item in items]
+        if any(f is not None for f in functions):
+            columns, values = self._select_functions(rows, items, functions, lower)
+            return columns, values, name
+        if match.group('order') and match.group('order').upper() == 'DESC':
+            rows.reverse()
+        if match.group('limit') is not None:
+            rows = rows[:int(match.group('limit'))]
+        columns = ['time']
+        sources = []
+        for item in items:
+            if item == '*':
+                names = sorted({k for r in rows for k in r[2]} | {k for r in rows for k in r[1]})
+                columns.extend(names)
+                sources.extend(names)
+                continue
+            parts = re.split(r'\s+as\s+', item, flags=re.IGNORECASE)
+            source = _unquote(parts[0])
+            if source == 'time':
+                continue
+            columns.append(_unquote(parts[-1]))
+            sources.append(source)
+        values = [[at] + [_column_value(tags, fields, source) for source in sources] for at, tags, fields in rows]
+        return columns, values, name
+
+    @staticmethod
+    def _count_buckets(times, interval_ns, offset_ns):
+        buckets = {}
+        for at in times:
+            start = (at - offset_ns) // interval_ns * interval_ns + offset_ns
+            buckets[start] = buckets.get(start, 0) + 1
+        return [[t, n] for t, n in sorted(buckets.items())]
+
+    @staticmethod
+    def _select_functions(rows, items, functions, lower):
+        """
+        MEAN, FIRST, LAST and DIFFERENCE, over rows in time order.
+        A lone FIRST or LAST of a field selects a point, and the other columns are that point's.
+        :return: (columns, list of row value lists)
+        """
+        if len(items) == 1 and functions[0].group('function').upper() == 'DIFFERENCE':
+            field = _unquote(functions[0].group('field'))
+            series = [(at, fields[field]) for at, _, fields in rows if fields.get(field, None) is not None]
+            alias = _unquote(functions[0].group('alias') or 'difference')
+            return ['time', alias], [[at, v - prev] for (_, prev), (at, v) in zip(series, series[1:])]
+        selectors = [f for f in functions if f is not None and f.group('function').upper() in ('FIRST', 'LAST')
+                     and f.group('field') != '*']
+        if len(selectors) == 1 and len(selectors) == len([f for f in functions if f is not None]):
+            selector = selectors[0]
+            field = _unquote(selector.group('field'))
+            with_field = [r for r in rows if r[2].get(field, None) is not None]
+            if not with_field:
+                return ['time'], []
+            at, tags, fields = with_field[0] if selector.group('function').upper() == 'FIRST' else with_field[-1]
+            columns = ['time']
+            row = [at]
+            for item, f in zip(items, functions):
+                if f is not None:
+                    columns.append(_unquote(f.group('alias') or f.group('function').lower()))
+                    row.append(fields[field])
+                else:
+                    columns.append(_unquote(item))
+                    row.append(_column_value(tags, fields, _unquote(item)))
+            return columns, [row]
+        if not rows:
+            return ['time'], []
+        columns = ['time']
+        row = [lower]
+        for item, f in zip(items, functions):
+            if f is None:
+                raise ValueError("mixing aggregate and non-aggregate queries is not supported: {}".format(item))
+            function = f.group('function').lower()
+            field = _unquote(f.group('field'))
+            if field == '*':
+                names = sorted({k for r in rows for k in r[2]})
+            else:
+                names = [field]
+            for name in names:
+                present = [fields[name] for _, _, fields in rows if fields.get(name, None) is not None]
+                if function == 'mean':
+                    value = sum(present) / len(present) if present else None
+                elif function == 'first':
+                    value = present[0] if present else None
+                elif function == 'last':
+                    value = present[-1] if present else None
+                else:
+                    raise ValueError("{} cannot be combined with other functions".format(function.upper()))
+                if field == '*':
+                    columns.append("{}_{}".format(function, name))
+                else:
+                    columns.append(_unquote(f.group('alias') or function))
+                row.append(value)
+        return columns, [row]
+
+    def run_query(self, text, bind_params):
+        """
+        :return: list of (columns, values, name), or a list of them with their tags, for each statement
+        """
+        statements = []
+        lines = [line for line in text.splitlines() if not line.strip().startswith('--')]
+        for statement in ' '.join(lines).split(';'):
+            statement = statement.strip()
+            if not statement:
+                continue
+            self.count('queries')
+            match = _SELECT_INTO.match(statement)
+            if match is not None:
+                statements.append((['time', 'written'], [[0, self.select_into(match, bind_params)]], 'result'))
+                continue
+            match = _SELECT.match(statement)
+            if match is not None:
+                statements.append(self.select(match, bind_params))
+                continue
+            match = _DELETE.match(statement)
+            if match is not None:
+                self.delete(_unquote(match.group('measurement')), match.group('where'), bind_params)
+                statements.append(None)
+                continue
+            if statement.upper().startswith('CREATE DATABASE'):
+                statements.append(None)
+                continue
+            raise ValueError("error parsing query: {}".format(statement))
+        return statements
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeInfluxDB'
+    # headers and body go out in separate sends, which Nagle's algorithm would hold back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def db(self):
+        return self.server.fake_influxdb
+
+    def _params(self):
+        split = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(split.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.db.count('bytes_received', len(self.path) + len(body))
+        return split.path, params, body
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Influxdb-Version', '1.8.0')
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        self.db.count('bytes_sent', len(body))
+
+    def do_GET(self):
+        path, params, body = self._params()
+        if path == '/ping':
+            self._send(204)
+        elif path == '/query':
+            if body:
+                params.update({k: v[-1] for k, v in parse_qs(body.decode('utf-8')).items()})
+            self._query(params)
+        else:
+            self._send(404, b'{"error":"not found"}')
+
+    def do_POST(self):
+        path, params, body = self._params()
+        if path == '/write':
+            self.db.count('write_requests')
+            self.db.write_lines(body.decode('utf-8'), params.get('precision', None))
+            self._send(204)
+        elif path == '/query':
+            if body:
+                params.update({k: v[-1] for k, v in parse_qs(body.decode('utf-8')).items()})
+            self._query(params)
+        else:
+            self._send(404, b'{"error":"not found"}')
+
+    def _query(self, params):
+        self.db.count('query_requests')
+        bind_params = json.loads(params['params']) if 'params' in params else {}
+        try:
+            statements = self.db.run_query(params.get('q', ''), bind_params)
+        except (ValueError, KeyError) as e:
+            self._send(400, json.dumps({'error': str(e)}).encode('utf-8'))
+            return
+        epoch = params.get('epoch', None)
+        divisor = EPOCH_DIVISORS.get(epoch, None)
+        chunked = params.get('chunked', 'false') == 'true'
+        chunk_size = int(params.get('chunk_size', DEFAULT_CHUNK_SIZE) or DEFAULT_CHUNK_SIZE)
+        documents = []
+        for statement_id, statement in enumerate(statements):
+            if isinstance(statement, list):
+                # a grouped statement is never split into chunks
+                series = []
+                for columns, values, name, tags in statement:
+                    self.db.count('points_read', len(values))
+                    for row in values:
+                        row[0] = rfc3339(row[0]) if divisor is None else row[0] // divisor
+                    series.append({'name': name, 'tags': tags, 'columns': columns, 'values': values})
+                documents.append([{'statement_id': statement_id, 'series': series} if series
+                                  else {'statement_id': statement_id}])
+                continue
+            if statement is None or len(statement[1]) < 1:
+                documents.append([{'statement_id': statement_id}])
+                continue
+            columns, values, name = statement
+            self.db.count('points_read', len(values))
+            for row in values:
+                row[0] = rfc3339(row[0]) if divisor is None else row[0] // divisor
+            step = chunk_size if chunked else len(values)
+            chunks = []
+            for start in range(0, len(values), step):
+                result = {'statement_id': statement_id,
+                          'series': [{'name': name, 'columns': columns, 'values': values[start:start + step]}]}
+                if start + step < len(values):
+                    result['series'][0]['partial'] = True
+                    result['partial'] = True
+                chunks.append(result)
+            documents.append(chunks)
+        if chunked:
+            lines = [json.dumps({'results': [result]}) for chunks in documents for result in chunks]
+            body = ('\n'.join(lines) + '\n').encode('utf-8')
+        else:
+            body = json.dumps({'results': [chunks[0] for chunks in documents]}).encode('utf-8')
+        self._send(200, body)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only in Python 3.7 and later
+    daemon_threads = True
+
+
+def start_server(fake_influxdb=None, host='127.0.0.1', port=0):
+    """
+    Serve a FakeInfluxDB from a daemon thread.
+    :return: (server, FakeInfluxDB); the port is server.server_address[1], stop with server.shutdown()
+    """
+    if fake_influxdb is None:
+        fake_influxdb = FakeInfluxDB()
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.fake_influxdb = fake_influxdb
+    thread = threading.Thread(target=server.serve_forever, name='fake-influxdb', daemon=True)
+    thread.start()
+    return server, fake_influxdb
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+"""fake_mongo.py
+An in-memory stand-in for the parts of pymongo.MongoClient the pipeline uses,
+for benchmarks. Databases and collections are reached as attributes or items,
+as on a MongoClient. Every FakeMongoClient shares one store, so documents loaded
+before a benchmark are seen by the clients the pipeline creates itself.
+Queries support equality, $in, $nin, $ne, $lt, $lte, $gt and $gte; updates
+support $set and upsert. Operations are counted in stats, per process.
+"""
+from copy import deepcopy
+from itertools import count
+
+_OPERATORS = {
+    '$in': lambda value, arg: value in arg,
+    '$nin': lambda value, arg: value not in arg,
+    '$ne': lambda value, arg: value != arg,
+    '$lt': lambda value, arg: value is not None and value < arg,
+    '$lte': lambda value, arg: value is not None and value <= arg,
+    '$gt': lambda value, arg: value is not None and value > arg,
+    '$gte': lambda value, arg: value is not None and value >= arg,
+}
+
+_ids = count(1)
+
+# operation counts for this process
+stats = {'mongo_queries': 0, 'mongo_writes': 0}
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        value = doc.get(key, None)
+        if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            if not all(_OPERATORS[op](value, arg) for op, arg in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return deepcopy(doc)
+    include = {k for k, v in projection.items() if v}
+    if include:
+        include.add('_id')
+        return {k: deepcopy(v) for k, v in doc.items() if k in include and projection.get(k, 1)}
+    return {k: deepcopy(v) for k, v in doc.items() if k not in projection}
+
+
+class _Result(object):
+    __slots__ = ('inserted_id', 'inserted_ids', 'matched_count', 'modified_count', 'upserted_id', 'deleted_count')
+
+    def __init__(self, **kwargs):
+        for s in self.__slots__:
+            setattr(self, s, kwargs.get(s, None))
+
+
+class FakeCollection(object):
+    __slots__ = ('name', 'docs')
+
+    def __new__(cls, name):
+        self = super(FakeCollection, cls).__new__(cls)
+        self.name = name
+        self.docs = []
+        return self
+
+    def find(self, query=None, projection=None, **kwargs):
+        stats['mongo_queries'] += 1
+        return [project(d, projection) for d in self.docs if matches(d, query or {})]
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        stats['mongo_queries'] += 1
+        for d in self.docs:
+            if matches(d, query or {}):
+                return project(d, projection)
+        return None
+
+    def count_documents(self, query, **kwargs):
+        stats['mongo_queries'] += 1
+        return sum(1 for d in self.docs if matches(d, query))
+
+    def insert_one(self, doc, **kwargs):
+        stats['mongo_writes'] += 1
+        doc.setdefault('_id', next(_ids))
+        self.docs.append(deepcopy(doc))
+        return _Result(inserted_id=doc['_id'])
+
+    def insert_many(self, docs, **kwargs):
+        return _Result(inserted_ids=[self.insert_one(d).inserted_id for d in docs])
+
+    def update_one(self, query, update, upsert=False, **kwargs):
+        stats['mongo_writes'] += 1
+        for d in self.docs:
+            if matches(d, query):
+                d.update(deepcopy(update.get('$set', {})))
+                return _Result(matched_count=1, modified_count=1)
+        if not upsert:
+            return _Result(matched_count=0, modified_count=0)
+        doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+        doc.update(update.get('$set', {}))
+        return _Result(matched_count=0, modified_count=0, upserted_id=self.insert_one(doc).inserted_id)
+
+    def delete_many(self, query, **kwargs):
+        stats['mongo_writes'] += 1
+        keep = [d for d in self.docs if not matches(d, query)]
+        deleted = len(self.docs) - len(keep)
+        self.docs[:] = keep
+        return _Result(deleted_count=deleted)
+
+    def drop(self):
+        del self.docs[:]
+
+
+class FakeDatabase(object):
+    __slots__ = ('name', 'collections')
+
+    def __new__(cls, name):
+        self = super(FakeDatabase, cls).__new__(cls)
+        self.name = name
+        self.collections = {}
+        return self
+
+    def __getitem__(self, name):
+        try:
+            return self.collections[name]
+        except KeyError:
+            collection = self.collections[name] = FakeCollection(name)
+            return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+# database name to FakeDatabase, shared by every FakeMongoClient
+_databases = {}
+
+
+class FakeMongoClient(object):
+    """
+    Takes, and ignores, the same arguments as pymongo.MongoClient.
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        try:
+            return _databases[name]
+        except KeyError:
+            db = _databases[name] = FakeDatabase(name)
+            return db
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self):
+        pass
+
+
+def reset():
+    """
+    Forget every database.
+    """
+    _databases.clear()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+"""fixtures.py
+Deterministic benchmark data, in the formats the pipeline imports it from:
+raw.csv, intensity.csv and silo.csv as the tab-separated SQL Server exports the
+CSV converters read, and all_stations documents built from the repository's own
+pipeline/all_stations.tsv. The same seed, sites and days always give the same data.
+"""
+import csv
+from datetime import datetime, timedelta
+import os
+import random
+import shutil
+
+from bson import Decimal128
+
+from pipeline.utils import datetime_to_sql
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALL_STATIONS_TSV = os.path.join(REPO_ROOT, "pipeline", "all_stations.tsv")
+FIXTURE_START = datetime(2019, 1, 1)
+RAW_INTERVAL = timedelta(minutes=30)
+DEFAULT_SEED = 2019
+# the station parameters the processing levels read, kept here so the fixtures also work with older pipelines
+CALIBRATION_FIELDS = ('beta', 'ref_pressure', 'ref_intensity', 'latit_scaling', 'elev_scaling', 'n0_cal',
+                      'bulk_density', 'lattice_water_g_g', 'soil_organic_matter_g_g')
+
+RAW_HEADERS = ("SiteNo", "Timestamp", "Flag", "Count", "Pressure1", "InternalTemperature", "InternalHumidity",
+               "Battery", "TubeTemperature", "TubeHumidity", "Rain", "VWC1", "VWC2", "VWC3", "Pressure2",
+               "ExternalTemperature", "ExternalHumidity")
+INTENSITY_HEADERS = ("SiteNo", "Timestamp", "BadDataFlag", "Intensity")
+SILO_HEADERS = ("SiteNo", "Date2", "T_Max", "Smx", "T_Min", "Smn", "Rain", "Srn", "Evap", "Sev", "Radn", "Ssl", "VP",
+                "Svp", "RHmaxT", "RHminT", "AverageTemperature", "AverageHumidity")
+
+
+def station_docs(site_nos):
+    """
+    all_stations documents as the processing levels read them: an int site_no and
+    Decimal128 calibration parameters. Stations are taken from all_stations.tsv in order,
+    wrapping around if more sites are asked for than it has.
+    :rtype: list
+    """
+    with open(ALL_STATIONS_TSV, "r", encoding="latin1") as f:
+        r = csv.reader(f, delimiter="\t")
+        headers = next(r)
+        rows = [dict(zip(headers, row)) for row in r]
+    docs = []
+    for i, site_no in enumerate(site_nos):
+        row = rows[i % len(rows)]
+        doc = {f: Decimal128(row[f]) for f in CALIBRATION_FIELDS}
+        doc['site_no'] = int(site_no)
+        doc['site_name'] = row['site_name']
+        docs.append(doc)
+    return docs
+
+
+def _raw_rows(rng, site_no, days, n0_cal):
+    at = FIXTURE_START
+    # corrected, this gives soil moisture in range for the station's calibration
+    base_count = int(0.45 * n0_cal)
+    count = base_count
+    previous = None
+    for _ in range(days * 24 * 60 // 30):
+        count = min(max(int(0.3 * n0_cal), int(count + rng.gauss(0, 0.01 * base_count))), int(0.6 * n0_cal))
+        external_temperature = round(rng.uniform(5.0, 35.0), 2)
+        external_humidity = round(rng.uniform(20.0, 95.0), 2)
+        if rng.random() < 0.05:
+            # a dropout, so level2 has to fall back to SILO
+            external_temperature = external_humidity = 0.0
+        row = [site_no, datetime_to_sql(at), 0, count, round(rng.uniform(990.0, 1020.0), 2),
+               round(rng.uniform(10.0, 40.0), 2), round(rng.uniform(10.0, 60.0), 2),
+               round(rng.uniform(11.5, 13.5) if rng.random() > 0.01 else 9.5, 2),
+               round(rng.uniform(10.0, 40.0), 2), round(rng.uniform(10.0, 60.0), 2),
+               round(rng.choice((0.0, 0.0, 0.0, 0.2, 1.4)), 1), 0.0, 0.0, 0.0,
+               round(rng.uniform(990.0, 1020.0), 2), external_temperature, external_humidity]
+        if previous is not None and rng.random() < 0.002:
+            # a record sent twice, a few minutes apart, for the duplicate checks
+            duplicate = list(previous)
+            duplicate[1] = datetime_to_sql(at - timedelta(minutes=3))
+            yield duplicate
+        yield row
+        previous = row
+        at += RAW_INTERVAL
+
+
+def _intensity_rows(rng, site_no, days):
+    at = FIXTURE_START - timedelta(days=1)
+    for _ in range((days + 2) * 24):
+        yield [site_no, datetime_to_sql(at), 0, round(rng.uniform(95.0, 110.0), 3)]
+        at += timedelta(hours=1)
+
+
+def _silo_rows(rng, site_no, days):
+    at = FIXTURE_START - timedelta(days=1)
+    for _ in range(days + 2):
+        t_max = round(rng.uniform(15.0, 40.0), 1)
+        t_min = round(t_max - rng.uniform(5.0, 15.0), 1)
+        rh_max_t = round(rng.uniform(20.0, 60.0), 1)
+        rh_min_t = round(rh_max_t + rng.uniform(10.0, 35.0), 1)
+        yield [site_no, datetime_to_sql(at), t_max, 25, t_min, 25, round(rng.choice((0.0, 0.0, 2.5)), 1), 0,
+               round(rng.uniform(2.0, 9.0), 1), 25, round(rng.uniform(10.0, 30.0), 1), 25,
+               round(rng.uniform(10.0, 25.0), 1), 25, rh_max_t, rh_min_t,
+               round((t_max + t_min) / 2.0, 2), round((rh_max_t + rh_min_t) / 2.0, 2)]
+        at += timedelta(days=1)
+
+
+def _write_tsv(path, headers, rows):
+    n = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f, delimiter="\t", lineterminator="\n")
+        w.writerow(headers)
+        for row in rows:
+            w.writerow(row)
+            n += 1
+    return n
+
+
+def write_fixtures(directory, site_nos, days, seed=DEFAULT_SEED):
+    """
+    Write raw.csv, intensity.csv, silo.csv and a copy of all_stations.tsv to directory,
+    which is where the CSV converters look for them when it is the working directory.
+    :return: dict of file name to number of data rows
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    n0_cals = {d['site_no']: float(d['n0_cal'].to_decimal()) for d in station_docs(site_nos)}
+    counts = {
+        "raw.csv": _write_tsv(os.path.join(directory, "raw.csv"), RAW_HEADERS,
+                              (row for s in site_nos for row in _raw_rows(rng, s, days, n0_cals[s]))),
+        "intensity.csv": _write_tsv(os.path.join(directory, "intensity.csv"), INTENSITY_HEADERS,
+                                    (row for s in site_nos for row in _intensity_rows(rng, s, days))),
+        "silo.csv": _write_tsv(os.path.join(directory, "silo.csv"), SILO_HEADERS,
+                               (row for s in site_nos for row in _silo_rows(rng, s, days))),
+    }
+    shutil.copyfile(ALL_STATIONS_TSV, os.path.join(directory, "all_stations.tsv"))
+    return counts
@@ -0,0 +1,291 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+"""run_benchmarks.py
+End-to-end benchmarks of the pipeline stages, without a real InfluxDB or MongoDB.
+An in-process fake of the InfluxDB HTTP API (fake_influxdb.py) and an in-memory
+MongoDB stand-in (fake_mongo.py) are loaded from deterministic fixtures (fixtures.py),
+then each stage runs as it does in production, through the pipeline's own clients:
+the CSV converters (which load the fixtures), raw_to_level1, level1_to_level2,
+level2_to_level3, level3_to_level4 and check_in_raw.
+
+Each stage runs in its own forked process, so its peak RSS is its own. For each stage
+this reports the wall time, rows per second (the larger of the points it read and the
+points it wrote), the InfluxQL statements and HTTP requests it issued, the bytes sent
+each way, its MongoDB operations and its peak RSS. peak_rss_mb includes the pages the
+fork inherited from the runner; rss_growth_mb is how far the stage grew above where it
+started.
+
+Run from the repository root, on Linux:
+    python3 benchmarks/run_benchmarks.py [-s SITES] [-d DAYS] [-o results.json] [-c baseline.json]
+Write -o on one commit and pass it as -c on another to compare them. The fakes also
+serve the queries of the pipeline before it was reworked, so to benchmark a commit
+that predates this directory, copy benchmarks/ into a checkout of it.
+"""
+import argparse
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import pymongo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_influxdb import start_server  # noqa: E402
+from benchmarks import fake_mongo  # noqa: E402
+from benchmarks.fake_mongo import FakeMongoClient  # noqa: E402
+from benchmarks.fixtures import DEFAULT_SEED, FIXTURE_START, REPO_ROOT, station_docs, write_fixtures  # noqa: E402
+
+MB = 1024.0 * 1024.0
+
+
+class BenchRun(object):
+    """
+    What every stage needs to know about this run.
+    """
+    __slots__ = ('site_nos', 'start_time', 'backprocess')
+
+    def __new__(cls, site_nos, days):
+        self = super(BenchRun, cls).__new__(cls)
+        self.site_nos = tuple(site_nos)
+        # a day past the end of the fixtures, going back a day before their start
+        self.start_time = FIXTURE_START.replace(tzinfo=timezone.utc) + timedelta(days=days + 1)
+        self.backprocess = timedelta(days=days + 2)
+        return self
+
+
+def bench_csv_raw_vals(run):
+    from pipeline import csv_influx_converter
+    csv_influx_converter.raw_vals()
+
+
+def bench_csv_intensities(run):
+    from pipeline import csv_influx_converter
+    csv_influx_converter.intensities()
+
+
+def bench_csv_silo_data(run):
+    from pipeline import csv_influx_converter
+    csv_influx_converter.silo_data()
+
+
+def bench_csv_all_stations(run):
+    # stores site_no as a string, so its documents are thrown away with the forked process
+    from pipeline import csv_mongodb_converter
+    csv_mongodb_converter.all_stations()
+
+
+def bench_raw_to_level1(run):
+    from pipeline import cosmoz_process_levels
+    for site_no in run.site_nos:
+        cosmoz_process_levels.raw_to_level1(site_no, start_time=run.start_time, backprocess=run.backprocess)
+
+
+def bench_level1_to_level2(run):
+    from pipeline import cosmoz_process_levels
+    for site_no in run.site_nos:
+        cosmoz_process_levels.level1_to_level2(FakeMongoClient(), site_no, start_time=run.start_time,
+                                               backprocess=run.backprocess)
+
+
+def bench_level2_to_level3(run):
+    from pipeline import cosmoz_process_levels
+    for site_no in run.site_nos:
+        cosmoz_process_levels.level2_to_level3(FakeMongoClient(), site_no, start_time=run.start_time,
+                                               backprocess=run.backprocess)
+
+
+def bench_level3_to_level4(run):
+    from pipeline import cosmoz_process_levels
+    for site_no in run.site_nos:
+        cosmoz_process_levels.level3_to_level4(site_no, start_time=run.start_time, backprocess=run.backprocess)
+
+
+def bench_check_in_raw(run):
+    from pipeline import detect_duplicates
+    for site_no in run.site_nos:
+        detect_duplicates.check_in_raw(site_no)
+
+
+# In order: each stage reads what the ones before it wrote
+BENCHMARKS = (
+    ("csv_raw_vals", bench_csv_raw_vals),
+    ("csv_intensities", bench_csv_intensities),
+    ("csv_silo_data", bench_csv_silo_data),
+    ("csv_all_stations", bench_csv_all_stations),
+    ("raw_to_level1", bench_raw_to_level1),
+    ("level1_to_level2", bench_level1_to_level2),
+    ("level2_to_level3", bench_level2_to_level3),
+    ("level3_to_level4", bench_level3_to_level4),
+    ("check_in_raw", bench_check_in_raw),
+)
+
+
+def _status_kb(name):
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(name + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Reset this process's peak RSS (VmHWM) to its current RSS, where Linux allows it.
+    :return: True if it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _stage_process(fn, run, conn):
+    result = {'error': None}
+    reset = _reset_peak_rss()
+    start_kb = _status_kb("VmRSS")
+    mongo_before = dict(fake_mongo.stats)
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            started = time.perf_counter()
+            fn(run)
+            result['seconds'] = time.perf_counter() - started
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result.update({k: v - mongo_before[k] for k, v in fake_mongo.stats.items()})
+    peak_kb = _status_kb("VmHWM") if reset else None
+    if peak_kb is None:
+        # Without a reset this is the high-water mark of the whole process, runner included
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = peak_kb * 1024.0 / MB
+    result['rss_growth_mb'] = None if start_kb is None else max(0, peak_kb - start_kb) * 1024.0 / MB
+    conn.send(result)
+    conn.close()
+
+
+def run_stage(name, fn, run, fake_db):
+    """
+    Run one stage in a forked process and measure it.
+    :rtype: dict
+    """
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    before = fake_db.snapshot()
+    p = ctx.Process(target=_stage_process, args=(fn, run, child_conn), name="bench-{}".format(name))
+    p.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {'error': "The benchmark process exited with code {}.".format(p.exitcode),
+                  'mongo_queries': 0, 'mongo_writes': 0}
+    p.join()
+    after = fake_db.snapshot()
+    stats = {k: after[k] - before[k] for k in after}
+    result['name'] = name
+    result.update(stats)
+    result['rows'] = max(stats['points_read'], stats['points_written'])
+    seconds = result.get('seconds', None)
+    result['rows_per_second'] = result['rows'] / seconds if seconds else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print("{:<18} {:>9} {:>9} {:>11} {:>8} {:>8} {:>9} {:>9} {:>6} {:>9}".format(
+        "stage", "seconds", "rows", "rows/s", "queries", "writes", "MB sent", "MB recv", "mongo", "peak MB"))
+    for r in results:
+        if r['error'] is not None:
+            print("{:<18} FAILED".format(r['name']))
+            continue
+        line = "{:<18} {:>9.3f} {:>9} {:>11.0f} {:>8} {:>8} {:>9.2f} {:>9.2f} {:>6} {:>9.1f}".format(
+            r['name'], r['seconds'], r['rows'], r['rows_per_second'] or 0.0, r['queries'], r['write_requests'],
+            r['bytes_received'] / MB, r['bytes_sent'] / MB, r['mongo_queries'] + r['mongo_writes'],
+            r['peak_rss_mb'])
+        old = (baseline or {}).get(r['name'], None)
+        if old is not None and old.get('seconds'):
+            line += "  {:+.1f}% time vs baseline".format(100.0 * (r['seconds'] - old['seconds']) / old['seconds'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmarks against in-process fake databases.")
+    parser.add_argument('-s', '--sites', type=int, default=1, help="Number of sites in the fixtures.")
+    parser.add_argument('-d', '--days', type=int, default=90, help="Days of half-hourly raw records per site.")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="Seed for the fixture data.")
+    parser.add_argument('-o', '--output', type=str, help="Write the results to this JSON file.")
+    parser.add_argument('-c', '--compare', type=str, help="Compare with the results in this JSON file.")
+    args = parser.parse_args()
+
+    server, fake_db = start_server()
+    # The pipeline reads its database config when it is imported, so point it at the fake first
+    os.environ['INFLUX_DB_HOST'] = server.server_address[0]
+    os.environ['INFLUX_DB_PORT'] = str(server.server_address[1])
+    # Before the pipeline is imported, as older versions of it connect to MongoDB at import time
+    pymongo.MongoClient = FakeMongoClient
+    # imported here, so the stages don't count the imports
+    from pipeline import cosmoz_process_levels, csv_influx_converter, csv_mongodb_converter, \
+        detect_duplicates  # noqa: F401
+    from pipeline._mongo_db_config import config as mongodb_config
+
+    site_nos = list(range(1, args.sites + 1))
+    FakeMongoClient()[mongodb_config['DB_NAME']].all_stations.insert_many(station_docs(site_nos))
+    run = BenchRun(site_nos, args.days)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="cosmoz-bench-") as work_dir:
+        fixture_rows = write_fixtures(work_dir, site_nos, args.days, seed=args.seed)
+        # the CSV converters read their files from the working directory
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for name, fn in BENCHMARKS:
+                results.append(run_stage(name, fn, run, fake_db))
+        finally:
+            os.chdir(cwd)
+    server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = {r['name']: r for r in json.load(f)['benchmarks']}
+    print_results(results, baseline)
+    for r in results:
+        if r['error'] is not None:
+            print("{} failed:\n{}".format(r['name'], r['error']), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                'commit': git_commit(),
+                'created': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'sites': args.sites,
+                'days': args.days,
+                'seed': args.seed,
+                'fixture_rows': fixture_rows,
+                'benchmarks': results,
+            }, f, indent=1)
+    return 1 if any(r['error'] is not None for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
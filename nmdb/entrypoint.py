@@ -7,9 +7,11 @@ import math
 import traceback
 from datetime import datetime, timezone, timedelta
 
+from pipeline.tracing import start_tracing, write_report
+
 from .data_getter import DataGetter
 from .mongo_db import get_all_site_no
-from .influx_db import get_intensity_timestamp, store_intensity_data, \
+from .influx_db import get_intensity_timestamp, get_intensity_timestamps, store_intensity_data, \
     get_previous_valid_intensity_row
 from .config import SITE_NUMBERS_TO_GET_DATA_FOR, SITE_NUMBERS_TO_IGNORE_DATA_FOR, MAXIMUM_LOOKBACK_TIME_DIFF, DEBUG_FILE
 
@@ -52,9 +54,16 @@ class Main(object):
 
     def main(self):
         self.__class__.initialize()
+        # traced to $TRACE_FILE, if it is set
+        trace_settings = start_tracing()
 
         self.__class__.retrieve_intensity_values()
 
+        if trace_settings is not None:
+            report_path, report = write_report(trace_settings)
+            print("\n".join(report))
+            print("Trace report written to {}".format(report_path))
+
         try:
             millis = math.floor(time.time() * 1000.0)
             if self.__class__.debug_writer:
@@ -69,10 +78,10 @@ class Main(object):
     def retrieve_intensity_values(cls):
         hour_offset = timedelta(hours=1)
         all_site_no = get_all_site_no()
+        all_site_no = [site_no for site_no in all_site_no if site_no not in SITE_NUMBERS_TO_IGNORE_DATA_FOR]
+        database_timestamps = get_intensity_timestamps(all_site_no)
         for site_no in all_site_no:
-            if site_no in SITE_NUMBERS_TO_IGNORE_DATA_FOR:
-                continue
-            database_timestamp = get_intensity_timestamp(site_no)  # type: datetime
+            database_timestamp = database_timestamps[site_no]  # type: datetime
             if database_timestamp is None:
                 continue
             db_time_millis = database_timestamp.timestamp() * 1000.0
@@ -1,73 +1,32 @@
 # -*- coding: utf-8 -*-
 #
+import asyncio
 import math
-import time
 
 from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBServerError
+
+from pipeline.async_db import DEFAULT_MAX_CONCURRENCY, AsyncInfluxClient, run_sync
+from pipeline.dirty_ranges import extend_range
+from pipeline.influx_cached_writer import adaptive_writer
+from pipeline.tracing import trace_influx_client
 
 from .intensity import Intensity
+from .mongo_db import mark_written_ranges
 from .utils import datetime_to_isostring, isostring_to_datetime
 from ._influx_db_config import config as influx_config
 
 INTENSITY_TABLE = "intensity"
 RAW_VALS_TABLE = "raw_values"
 
-class AccumCacheInfluxWriter(object):
-    __slots__ = ('influx_client', 'accum_cache', 'current_len', 'cache_len')
-
-    def __new__(cls, influx_client, cache_length=10):
-        self = super(AccumCacheInfluxWriter, cls).__new__(cls)
-        self.influx_client = influx_client
-        self.accum_cache = []
-        self.current_len = 0
-        self.cache_len = cache_length
-        return self
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *args, **kwargs):
-        if self.current_len > 0:
-            self._maybe_flush(force=True, delete_cache=True)
-
-    def _maybe_flush(self, force=False, delete_cache=False):
-        if force or self.current_len >= self.cache_len:
-            try:
-                self.influx_client.write_points(self.accum_cache)
-            except InfluxDBServerError as er:
-                msg = er.args[0]
-                if b'"timeout"' in msg:
-                    time.sleep(5)
-                    self.influx_client.write_points(self.accum_cache)
-                else:
-                    raise
-            if delete_cache:
-                del self.accum_cache
-            else:
-                self.accum_cache = []
-            self.current_len = 0
-
-    def write_point(self, point, *args, **kwargs):
-        self.accum_cache.append(point)
-        self.current_len += 1
-        self._maybe_flush()
-
-    def write_points(self, points, *args, **kwargs):
-        self.accum_cache.extend(points)
-        self.current_len += len(points)
-        self._maybe_flush()
-
-
 def make_influx_client(new=False):
     if not new and make_influx_client.cached:
         return make_influx_client.cached
     if new:
         make_influx_client.cached = None
-    influx_client = InfluxDBClient(
+    influx_client = trace_influx_client(InfluxDBClient(
         influx_config['DB_HOST'], int(influx_config['DB_PORT']),
         influx_config['DB_USERNAME'], influx_config['DB_PASSWORD'],
-        influx_config['DB_NAME'], timeout=30)
+        influx_config['DB_NAME'], timeout=30))
     make_influx_client.cached = influx_client
     return influx_client
 make_influx_client.cached = None
@@ -77,7 +36,8 @@ def store_raw_data(raw_data_rows, influx_client=None):
     if influx_client is None:
         influx_client = make_influx_client()
     rows = iter(raw_data_rows)
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+    written_ranges = {}
+    with adaptive_writer(influx_client) as writer:
         while True:
             try:
                 row = next(rows)
@@ -114,13 +74,16 @@ def store_raw_data(raw_data_rows, influx_client=None):
                 }
             }
             writer.write_point(json_body)
+            extend_range(written_ranges, site_num, row.current_timestamp)
+    mark_written_ranges(written_ranges, RAW_VALS_TABLE)
 
 
 def store_intensity_data(intensity_data_rows, influx_client=None):
     if influx_client is None:
         influx_client = make_influx_client()
     rows = iter(intensity_data_rows)
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+    written_ranges = {}
+    with adaptive_writer(influx_client) as writer:
         while True:
             try:
                 row = next(rows)
@@ -145,6 +108,8 @@ def store_intensity_data(intensity_data_rows, influx_client=None):
                 }
             }
             writer.write_point(json_body)
+            extend_range(written_ranges, site_num, row.timestamp)
+    mark_written_ranges(written_ranges, INTENSITY_TABLE)
 
 
 def get_intensity_timestamp(site_no, influx_client=None):
@@ -157,10 +122,68 @@ def get_intensity_timestamp(site_no, influx_client=None):
     """
     timestamp = _get_max_intensity_timestamp(site_no, influx_client)
     if timestamp is None:
-        timestamp = _get_first_data_timestamp(site_no, influx_client)
+        timestamp = _get_first_data_timestamp(site_no, influx_client=influx_client)
     return timestamp
 
 
+def get_intensity_timestamps(site_nos, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    get_intensity_timestamp for many sites, with the queries for every site in flight at once.
+    :param site_nos: The siteNos in the Intensity table to check for
+    :param max_concurrency: the most queries to have in flight at once
+    :return: dict of siteNo to its last valid Intensity timestamp, or None
+    :rtype: dict
+    """
+    return run_sync(_get_intensity_timestamps(site_nos, max_concurrency))
+
+
+async def _get_intensity_timestamps(site_nos, max_concurrency):
+    async def _site_timestamp(influx_client, site_no):
+        timestamp = _first_point_time(await influx_client.query(_max_intensity_query(site_no)))
+        if timestamp is None:
+            timestamp = _first_point_time(await influx_client.query(_first_data_query(site_no)), truncate_hour=True)
+        return timestamp
+
+    async with AsyncInfluxClient(influx_config['DB_HOST'], influx_config['DB_PORT'], influx_config['DB_USERNAME'],
+                                 influx_config['DB_PASSWORD'], influx_config['DB_NAME'],
+                                 max_concurrency=max_concurrency) as influx_client:
+        timestamps = await asyncio.gather(*(_site_timestamp(influx_client, site_no) for site_no in site_nos),
+                                          return_exceptions=True)
+    site_timestamps = {}
+    for site_no, timestamp in zip(site_nos, timestamps):
+        if isinstance(timestamp, Exception):
+            # like get_intensity_timestamp, a site whose queries fail is left out
+            print("Couldn't get intensity timestamp for site {}: {}".format(site_no, timestamp))
+            timestamp = None
+        elif isinstance(timestamp, BaseException):
+            raise timestamp
+        site_timestamps[site_no] = timestamp
+    return site_timestamps
+
+
+def _max_intensity_query(site_no):
+    return """SELECT * FROM "{}" WHERE site_no='{}' ORDER BY time DESC LIMIT 1""".format(INTENSITY_TABLE, site_no)
+
+
+def _first_data_query(site_no):
+    return """SELECT * FROM "{}" WHERE site_no='{}' ORDER BY time ASC LIMIT 1""".format(RAW_VALS_TABLE, site_no)
+
+
+def _first_point_time(response, truncate_hour=False):
+    """
+    :param response: the result of a query with LIMIT 1
+    :param truncate_hour:
+    :return: the time of the response's point, or None if it has none
+    :rtype: datetime | NoneType
+    """
+    for p in response.get_points():
+        timestamp = isostring_to_datetime(str(p['time']))
+        if truncate_hour:
+            timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+        return timestamp
+    return None
+
+
 def _get_max_intensity_timestamp(site_no, influx_client=None):
     """
     A private method returns the maximum timestamp in the Intensity table for a given siteNo.
@@ -172,25 +195,16 @@ def _get_max_intensity_timestamp(site_no, influx_client=None):
     try:
         if influx_client is None:
             influx_client = make_influx_client()
-        select_query = """SELECT * FROM "{}" WHERE site_no='{}' ORDER BY time DESC LIMIT 1""".format(INTENSITY_TABLE, site_no)
         #String selectQuery = "SELECT MAX(Timestamp) FROM " + INTENSITY_TABLE + " WHERE SiteNo = " + siteNo;
 
         #Statement st = connection.createStatement();
         #st.execute(selectQuery);
         #ResultSet rs = st.getResultSet();
         #rs.next();
-        response = influx_client.query(select_query)
-        try:
-            intensities = list(response.get_points())
-            assert len(intensities) > 0
-            if len(intensities) > 1:
-                print("Found too many intensity records in a single hour period.")
-            intensity_p = intensities[0]
-        except (StopIteration, AssertionError):
-            print(RuntimeError("Cannot get max (latest) intensity time for site {}".format(site_no)))
-            raise
-        max_timestamp_as_string = str(intensity_p['time'])
-        max_timestamp = isostring_to_datetime(max_timestamp_as_string)
+        response = influx_client.query(_max_intensity_query(site_no))
+        max_timestamp = _first_point_time(response)
+        if max_timestamp is None:
+            raise RuntimeError("Cannot get max (latest) intensity time for site {}".format(site_no))
         return max_timestamp
     except Exception as e:
         print(e)
@@ -216,28 +230,15 @@ def _get_first_data_timestamp(site_no, truncate_hour=True, influx_client=None):
     try:
         if influx_client is None:
             influx_client = make_influx_client()
-        select_query = """SELECT * FROM "{}" WHERE site_no='{}' ORDER BY time ASC LIMIT 1""".format(RAW_VALS_TABLE, site_no)
         # Statement st = connection.createStatement();
         # st.execute(selectQuery);
         # ResultSet rs = st.getResultSet();
         # rs.next();
 
-        response = influx_client.query(select_query)
-        try:
-            intensities = list(response.get_points())
-            assert len(intensities) > 0
-            if len(intensities) > 1:
-                print(
-                    "Found too many data records in a single hour period.")
-            intensity_p = intensities[0]
-        except (StopIteration, AssertionError):
-            print(RuntimeError(
-                "Cannot get first data time for site {}".format(site_no)))
-            raise
-        first_timestamp_string = str(intensity_p['time'])
-        first_timestamp = isostring_to_datetime(first_timestamp_string)
-        if truncate_hour:
-            first_timestamp = first_timestamp.replace(minute=0, second=0, microsecond=0)
+        response = influx_client.query(_first_data_query(site_no))
+        first_timestamp = _first_point_time(response, truncate_hour=truncate_hour)
+        if first_timestamp is None:
+            raise RuntimeError("Cannot get first data time for site {}".format(site_no))
         return first_timestamp
     except Exception as e:
         print(e)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 #
 from pymongo import MongoClient
+from pipeline.dirty_ranges import mark_dirty_ranges
+from pipeline.tracing import trace_mongo_client
 from ._mongo_db_config import config as mongodb_config
 from datetime import datetime
 
@@ -11,7 +13,7 @@ def make_mongo_client(new=False):
         return make_mongo_client.cached
     if new:
         make_mongo_client.cached = None
-    mongo_client = MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
+    mongo_client = trace_mongo_client(MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT'])))  # 27017
     make_mongo_client.cached = mongo_client
     return mongo_client
 make_mongo_client.cached = None
@@ -80,3 +82,16 @@ def get_nmdb_from_site_no(site_no, mongo_client=None):
     except LookupError:
         nmdb = 0
     return nmdb
+
+
+def mark_written_ranges(ranges, source, mongo_client=None):
+    """
+    Record that each site's input data was written over its range, so the levels already
+    processed over that range can be recomputed.
+    :param ranges: dict of site number to (start, end), as from pipeline.dirty_ranges.extend_range
+    :param source: one of pipeline.dirty_ranges.SOURCES
+    :param mongo_client:
+    """
+    if mongo_client is None:
+        mongo_client = make_mongo_client()
+    mark_dirty_ranges(getattr(mongo_client, mongodb_config['DB_NAME']), ranges, source)
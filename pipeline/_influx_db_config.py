@@ -16,6 +16,7 @@ defaults = module.defaults = {
     "DB_NAME": "cosmoz",
     "DB_USERNAME": "username",
     "DB_PASSWORD": "password",
+    "POOL_SIZE": 10,
 }
 config = module.config = dict()
 
@@ -24,6 +25,7 @@ config['DB_PORT'] = getenv("INFLUX_DB_PORT", None)
 config['DB_NAME'] = getenv("INFLUX_DB_NAME", None)
 config['DB_USERNAME'] = getenv("INFLUX_DB_USERNAME", None)
 config['DB_PASSWORD'] = getenv("INFLUX_DB_PASSWORD", None)
+config['POOL_SIZE'] = getenv("INFLUX_DB_POOL_SIZE", None)
 
 for k, v in defaults.items():
     if k not in config or config[k] is None:
@@ -34,5 +36,6 @@ DB_PORT = int(config['DB_PORT'])
 DB_NAME = config['DB_NAME']
 DB_USERNAME = config['DB_USERNAME']
 DB_PASSWORD = config['DB_PASSWORD']
+POOL_SIZE = int(config['POOL_SIZE'])
 
 
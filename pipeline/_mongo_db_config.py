@@ -2,7 +2,10 @@
 #
 import sys
 from os import getenv
-from .utils import do_load_dotenv
+try:
+    from .utils import do_load_dotenv
+except ImportError:
+    from utils import do_load_dotenv
 
 do_load_dotenv()
 
@@ -11,12 +14,14 @@ defaults = module.defaults = {
     "DB_HOST": "documentdb",
     "DB_PORT": 27017,
     "DB_NAME": "cosmoz",
+    "POOL_SIZE": 10,
 }
 config = module.config = dict()
 
 config['DB_HOST'] = getenv("MONGO_DB_HOST", None)
 config['DB_PORT'] = getenv("MONGO_DB_PORT", None)
 config['DB_NAME'] = getenv("MONGO_DB_NAME", None)
+config['POOL_SIZE'] = getenv("MONGO_DB_POOL_SIZE", None)
 
 for k, v in defaults.items():
     if k not in config or config[k] is None:
@@ -25,3 +30,4 @@ for k, v in defaults.items():
 DB_HOST = config['DB_HOST']
 DB_PORT = int(config['DB_PORT'])
 DB_NAME = config['DB_NAME']
+POOL_SIZE = int(config['POOL_SIZE'])
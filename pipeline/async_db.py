@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+"""async_db.py
+asyncio access to InfluxDB, over its 1.x HTTP API with aiohttp, and to MongoDB with motor.
+A single process can keep many queries in flight, up to a configurable limit.
+Query results are influxdb ResultSet objects, so they are used with .get_points()
+exactly like the results of the blocking InfluxDBClient.
+run_sync runs a coroutine to completion, for use from the existing synchronous code.
+"""
+import asyncio
+import json
+
+import aiohttp
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from influxdb.line_protocol import make_lines
+from influxdb.resultset import ResultSet
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from ._influx_db_config import config as influx_config
+from ._mongo_db_config import config as mongodb_config
+from .tracing import Span, mongo_template, query_template, result_rows, tracing_enabled
+
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_TIMEOUT = 30
+
+
+class AsyncInfluxClient(object):
+    """
+    A minimal asyncio counterpart of influxdb.InfluxDBClient: query and write_points.
+    At most max_concurrency requests are in flight at once; the rest wait their turn.
+    Use as an async context manager, or await close() when done.
+    """
+    __slots__ = ('base_url', 'database', 'auth_params', 'timeout', 'max_concurrency', 'semaphore', 'session')
+
+    def __new__(cls, host=None, port=None, username=None, password=None, database=None,
+                max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+        self = super(AsyncInfluxClient, cls).__new__(cls)
+        host = influx_config['DB_HOST'] if host is None else host
+        port = influx_config['DB_PORT'] if port is None else port
+        username = influx_config['DB_USERNAME'] if username is None else username
+        password = influx_config['DB_PASSWORD'] if password is None else password
+        self.base_url = "http://{}:{}".format(host, int(port))
+        self.database = influx_config['DB_NAME'] if database is None else database
+        self.auth_params = {'u': username, 'p': password}
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        # These belong to an event loop, so they are made on first use inside it
+        self.semaphore = None
+        self.session = None
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.close()
+
+    def _open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.semaphore = None
+
+    async def _request(self, method, path, params, data=None, expected=200):
+        session = self._open()
+        params = dict(params)
+        params.update(self.auth_params)
+        async with self.semaphore:
+            async with session.request(method, self.base_url + path, params=params, data=data) as response:
+                status = response.status
+                body = await response.text()
+        if status == expected:
+            return body
+        if 500 <= status < 600:
+            raise InfluxDBServerError(body)
+        raise InfluxDBClientError(body, status)
+
+    async def query(self, query, bind_params=None, epoch=None, method="GET"):
+        """
+        :param query: the InfluxQL query
+        :param bind_params: values for $name placeholders in the query
+        :param epoch: return times as epoch integers of this precision (h, m, s, ms, u or ns)
+        :param method: GET, or POST for queries that change the database
+        :return: a ResultSet, or a list of them for several statements
+        """
+        params = {'db': self.database, 'q': query}
+        if bind_params:
+            params['params'] = json.dumps(bind_params)
+        if epoch is not None:
+            params['epoch'] = epoch
+        span = Span("influx.query", query_template(query)) if tracing_enabled() else None
+        try:
+            body = await self._request(method, "/query", params)
+            data = json.loads(body)
+            results = [ResultSet(result, raise_errors=True) for result in data.get('results', [])]
+            if span is not None:
+                span.bytes = len(body)
+                span.rows = result_rows(results)
+        finally:
+            if span is not None:
+                span.finish()
+        if len(results) == 1:
+            return results[0]
+        return results
+
+    async def write_points(self, points, time_precision=None, tags=None):
+        """
+        :param points: list of points, as for InfluxDBClient.write_points
+        :param time_precision: the precision of integer point times, None for ns
+        :param tags: tags to add to every point
+        :return: True
+        """
+        params = {'db': self.database}
+        if time_precision is not None:
+            params['precision'] = time_precision
+        data = make_lines({'points': points, 'tags': tags}, time_precision).encode('utf-8')
+        if not tracing_enabled():
+            await self._request("POST", "/write", params, data=data, expected=204)
+            return True
+        span = Span("influx.write", "WRITE {}".format(",".join(sorted({p['measurement'] for p in points}))))
+        span.bytes = len(data)
+        span.rows = len(points)
+        try:
+            await self._request("POST", "/write", params, data=data, expected=204)
+        finally:
+            span.finish()
+        return True
+
+
+def make_async_mongo_client():
+    """
+    :return: a motor client for the cosmoz mongo server
+    :rtype: AsyncIOMotorClient
+    """
+    return AsyncIOMotorClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
+
+
+async def query_many(influx_client, queries):
+    """
+    Send many queries concurrently, within the client's concurrency limit.
+    :param influx_client:
+    :type influx_client: AsyncInfluxClient
+    :param queries: iterable of (query, bind_params) pairs
+    :return: the results, in the same order as the queries
+    :rtype: list
+    """
+    return await asyncio.gather(*(influx_client.query(q, bind_params=b) for (q, b) in queries))
+
+
+async def find_docs(mongo_client, collection, query=None, projection=None):
+    """
+    :param mongo_client:
+    :type mongo_client: AsyncIOMotorClient
+    :param collection: the name of a collection in the cosmoz database
+    :return: every matching document
+    :rtype: list
+    """
+    mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
+    cursor = getattr(mdb, collection).find(query or {}, projection)
+    if not tracing_enabled():
+        return await cursor.to_list(None)
+    span = Span("mongo.find", mongo_template(collection, "find", query))
+    try:
+        docs = await cursor.to_list(None)
+        span.rows = len(docs)
+        return docs
+    finally:
+        span.finish()
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion on a new event loop, from synchronous code.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
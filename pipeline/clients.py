@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+"""clients.py
+The pipeline's InfluxDB and MongoDB clients, made on first use and kept for the rest of the process.
+Importing a module no longer connects to anything, and a process never uses a client it inherited
+through fork: the first time a worker asks for a client it gets its own, with its own sockets.
+The size of each client's keep-alive connection pool is set by $INFLUX_DB_POOL_SIZE and
+$MONGO_DB_POOL_SIZE. init_worker_clients is for Pool initializers, so a worker's clients are
+closed when it exits; close_clients closes them in the main process. A thread that writes alongside
+another can have an InfluxDB client of its own, with open_thread_influx_client.
+"""
+from multiprocessing.util import Finalize
+import os
+import threading
+
+from influxdb import InfluxDBClient
+from pymongo import MongoClient
+
+try:
+    from ._influx_db_config import config as influx_config
+except ImportError:
+    from _influx_db_config import config as influx_config
+try:
+    from ._mongo_db_config import config as mongodb_config
+except ImportError:
+    from _mongo_db_config import config as mongodb_config
+try:
+    from .tracing import trace_influx_client, trace_mongo_client
+except ImportError:
+    from tracing import trace_influx_client, trace_mongo_client
+
+# This process's clients, by kind, and the process they belong to
+_clients = {}
+_pid = None
+_finalizer_pid = None
+_lock = threading.Lock()
+# Clients of one thread only, see open_thread_influx_client
+_thread_clients = threading.local()
+
+
+def _process_clients():
+    global _pid
+    pid = os.getpid()
+    if _pid != pid:
+        # inherited through fork: their sockets are the parent's, so leave them to it
+        _clients.clear()
+        _pid = pid
+    return _clients
+
+
+def get_influx_client():
+    """
+    :return: this process's InfluxDB client
+    :rtype: influxdb.InfluxDBClient
+    """
+    client = getattr(_thread_clients, 'influx', None)
+    if client is not None:
+        return client
+    with _lock:
+        clients = _process_clients()
+        client = clients.get('influx', None)
+        if client is None:
+            client = clients['influx'] = _make_influx_client()
+    return client
+
+
+def _make_influx_client():
+    return trace_influx_client(InfluxDBClient(
+        influx_config['DB_HOST'], int(influx_config['DB_PORT']),
+        influx_config['DB_USERNAME'], influx_config['DB_PASSWORD'],
+        influx_config['DB_NAME'], timeout=30, pool_size=int(influx_config['POOL_SIZE'])))
+
+
+def open_thread_influx_client():
+    """
+    Give the calling thread its own InfluxDB client, which get_influx_client returns in that thread
+    until close_thread_influx_client. For a thread that writes while another thread of the process
+    queries, as they would otherwise share one requests.Session, which is not thread-safe.
+    """
+    _thread_clients.influx = _make_influx_client()
+
+
+def close_thread_influx_client():
+    """
+    Close the calling thread's own InfluxDB client, if it has one.
+    """
+    client = getattr(_thread_clients, 'influx', None)
+    _thread_clients.influx = None
+    if client is not None:
+        client.close()
+
+
+def get_mongo_client():
+    """
+    :return: this process's MongoDB client, traced when the run is traced.
+        It connects on its first operation.
+    :rtype: pymongo.MongoClient
+    """
+    with _lock:
+        clients = _process_clients()
+        client = clients.get('mongo', None)
+        if client is None:
+            client = clients['mongo'] = MongoClient(
+                mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']),  # 27017
+                maxPoolSize=int(mongodb_config['POOL_SIZE']), connect=False)
+    return trace_mongo_client(client)
+
+
+def close_clients():
+    """
+    Close this process's clients. The next get_ makes new ones.
+    """
+    with _lock:
+        clients = _process_clients()
+        closing = list(clients.values())
+        clients.clear()
+    for client in closing:
+        try:
+            client.close()
+        except Exception as e:
+            print("Could not close {}: {!r}".format(type(client).__name__, e))
+
+
+def init_worker_clients():
+    """
+    Pool initializer part: forget the clients inherited from the parent, and close the worker's own when it exits.
+    """
+    global _finalizer_pid
+    with _lock:
+        _process_clients()
+        if _finalizer_pid == os.getpid():
+            return
+        _finalizer_pid = os.getpid()
+    Finalize(None, close_clients, exitpriority=10)
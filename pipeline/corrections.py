@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+"""corrections.py
+Columnar level1->level2 correction kernel.
+Takes whole arrays of level1 readings and computes the pressure, water vapour
+and intensity corrections and the corrected count in one batch.
+"""
+import numpy as np
+
+
+def _wv_corr(temperature, humidity):
+    """
+    The water vapour correction equation, over arrays
+    :param temperature: degrees C
+    :param humidity: relative humidity, percent
+    :return: the wv_corr array
+    """
+    return 1+0.0054*((2165*((0.6108*np.exp((17.27*temperature)/(temperature+237.3)))*(humidity/100.0)))/(temperature+273.16)-0)
+
+
+def press_corr(pressure1, pressure2, beta, ref_pressure):
+    """
+    Pressure correction. Uses pressure2 where it is non-zero, otherwise pressure1,
+    otherwise no correction (1.0).
+    :param pressure1:
+    :param pressure2:
+    :param beta: the site's beta coefficient
+    :type beta: float
+    :param ref_pressure: the site's reference pressure
+    :type ref_pressure: float
+    :return: the press_corr array
+    """
+    pressure1 = np.asarray(pressure1, dtype=np.float64)
+    pressure2 = np.asarray(pressure2, dtype=np.float64)
+    use_pressure = np.where(pressure2 != 0, pressure2, pressure1)
+    with np.errstate(over='ignore'):
+        corr = np.exp(beta * (use_pressure - ref_pressure))
+    return np.where(use_pressure != 0, corr, 1.0)
+
+
+def silo_fallbacks(external_temperature, external_humidity, average_humidity):
+    """
+    :return: how many points wv_corr corrects with the SILO averages, for want of external readings
+    :rtype: int
+    """
+    have_external = (np.asarray(external_temperature) != 0) & (np.asarray(external_humidity) != 0)
+    return int(np.count_nonzero(~have_external & ~np.isnan(np.asarray(average_humidity, dtype=np.float64))))
+
+
+def wv_corr(external_temperature, external_humidity, average_temperature, average_humidity,
+            emulate_old_version=False):
+    """
+    Water vapour correction.
+    Uses the external temperature and humidity when both are non-zero, otherwise the SILO
+    average temperature and humidity for that day, otherwise whichever readings are available.
+    Missing SILO values are given as NaN.
+    :param external_temperature:
+    :param external_humidity:
+    :param average_temperature: SILO average temperature for the day of each point, or NaN
+    :param average_humidity: SILO average humidity for the day of each point, or NaN
+    :param emulate_old_version: store wv_corr the way the old system did
+    :return: (wv_corr_use, wv_corr_store) arrays
+    :rtype: tuple
+    """
+    external_temperature = np.asarray(external_temperature, dtype=np.float64)
+    external_humidity = np.asarray(external_humidity, dtype=np.float64)
+    average_temperature = np.asarray(average_temperature, dtype=np.float64)
+    average_humidity = np.asarray(average_humidity, dtype=np.float64)
+    have_external = (external_temperature != 0) & (external_humidity != 0)
+    have_silo = ~have_external & ~np.isnan(average_humidity)
+    fallback = ~(have_external | have_silo)
+    have_average_temperature = ~np.isnan(average_temperature)
+    # Otherwise use the SILO average values, with a zero temperature when SILO has none.
+    silo_temp = np.where(have_average_temperature, average_temperature, 0.0)
+    # Finally, use either external OR average values, or zero
+    fallback_humidity = np.where(external_humidity == 0, average_humidity, external_humidity)
+    fallback_temp = np.where(external_temperature == 0, silo_temp, external_temperature)
+    fallback_humidity_ok = ~np.isnan(fallback_humidity) & (fallback_humidity != 0)
+    use_temp = np.select([have_external, have_silo], [external_temperature, silo_temp], fallback_temp)
+    use_humidity = np.select([have_external, have_silo], [external_humidity, average_humidity], fallback_humidity)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        computed = _wv_corr(use_temp, use_humidity)
+    wv_corr_use = np.where(fallback & ~fallback_humidity_ok, 1.0, computed)
+    if emulate_old_version:
+        wv_corr_store = np.where(fallback | (have_silo & ~have_average_temperature), 1.0, wv_corr_use)
+    else:
+        wv_corr_store = wv_corr_use
+    return wv_corr_use, wv_corr_store
+
+
+def intensity_corr(intensity, ref_intensity):
+    """
+    Intensity correction. Points with no intensity (NaN) or a zero intensity get no correction (1.0).
+    :param intensity: the NMDB intensity matched to each point, or NaN
+    :param ref_intensity: the site's reference intensity
+    :type ref_intensity: float
+    :return: the intensity_corr array
+    """
+    intensity = np.asarray(intensity, dtype=np.float64)
+    usable = ~np.isnan(intensity) & (intensity != 0.0)  # prevent div by zero
+    return np.where(usable, intensity / ref_intensity, 1.0)
+
+
+def level2_corrections(count, pressure1, pressure2, external_temperature, external_humidity,
+                       average_temperature, average_humidity, intensity,
+                       beta, ref_pressure, ref_intensity, scaling, emulate_old_version=False):
+    """
+    Compute every level2 correction for a batch of level1 points.
+    :param count: neutron counts
+    :param pressure1:
+    :param pressure2:
+    :param external_temperature:
+    :param external_humidity:
+    :param average_temperature: SILO average temperature for the day of each point, or NaN
+    :param average_humidity: SILO average humidity for the day of each point, or NaN
+    :param intensity: NMDB intensity matched to each point, or NaN
+    :param beta: site beta coefficient
+    :param ref_pressure: site reference pressure
+    :param ref_intensity: site reference intensity
+    :param scaling: the site's latit_scaling / elev_scaling
+    :param emulate_old_version: store wv_corr the way the old system did
+    :return: dict of press_corr, wv_corr (as stored), intensity_corr and corr_count arrays
+    :rtype: dict
+    """
+    if scaling == 0:
+        raise ZeroDivisionError("Site latit_scaling/elev_scaling is zero.")
+    count = np.asarray(count, dtype=np.float64)
+    pc = press_corr(pressure1, pressure2, beta, ref_pressure)
+    wv_corr_use, wv_corr_store = wv_corr(external_temperature, external_humidity,
+                                         average_temperature, average_humidity,
+                                         emulate_old_version=emulate_old_version)
+    ic = intensity_corr(intensity, ref_intensity)
+    corr_count = (count*wv_corr_use*pc/ic)/scaling
+    return {
+        "press_corr": pc,
+        "wv_corr": wv_corr_store,
+        "intensity_corr": ic,
+        "corr_count": corr_count,
+    }
@@ -16,159 +16,240 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import argparse
+import os
 import sys
 from multiprocessing import Process, Pool, Queue
-import math
 from datetime import time as d_time, datetime, timedelta, timezone
-from influxdb import InfluxDBClient
-from pymongo import MongoClient
-from sortedcontainers import SortedList
+from functools import partial
+import numpy as np
 
-from .influx_cached_writer import AccumCacheInfluxWriter
-from .utils import datetime_to_isostring, isostring_to_datetime
-from ._influx_db_config import config as influx_config
+from .async_db import DEFAULT_MAX_CONCURRENCY, AsyncInfluxClient, find_docs, make_async_mongo_client, query_many, \
+    run_sync
+from .clients import close_clients, get_influx_client, get_mongo_client, init_worker_clients
+from .corrections import level2_corrections, silo_fallbacks
+from .dirty_ranges import ONE_MICROSECOND, clear_dirty, clip_ranges, level_ranges, pending_dirty, probe_next_time
+from .filters import SMOOTHING_HALF_WIDTH_NS, smooth_level3
+from .frames import Frame, read_frame, stream_frames
+from .fused import RAW_LEAD_IN_NS, fused_levels
+from .influx_cached_writer import adaptive_writer
+from .lookups import IntensityIndex, SiloIndex
+from .metrics import flush_metrics, increment, record_run, set_run, stage_metrics, start_run, timed_stage
+from .raw_checks import DUPLICATE_WINDOW_NS, column_record_keys, duplicate_mask, level1_flags
+from .scheduler import DEFAULT_CHUNK_DAYS, ChunkTask, chunk_bounds, chunk_count_query, chunk_counts_from_result, \
+    chunk_tasks, plan_site_chunks, point_count_from_result, point_count_query, probe_point_count, \
+    run_largest_first, run_largest_first_overlapped
+from .site_params import get_site_params, init_worker, load_all_site_params, load_snapshot, save_snapshot, \
+    set_site_params
+from .soil_moisture import level3_values
+from .tracing import DEFAULT_TOP, set_tracing, start_tracing, write_report
+from .watermarks import LEVELS, STATE_COLLECTION, get_watermarks, is_up_to_date, probe_latest_time, set_watermark, \
+    stage_back_times, watermarks_from_docs
+from .verify import verify_level
+from .utils import DAY_NS, datetime_to_isostring, isostring_to_datetime, datetime_to_epoch_ns, epoch_ns_to_isostring
 from ._mongo_db_config import config as mongodb_config
 
-influx_client = InfluxDBClient(
-    influx_config['DB_HOST'], int(influx_config['DB_PORT']),
-    influx_config['DB_USERNAME'], influx_config['DB_PASSWORD'],
-    influx_config['DB_NAME'], timeout=30)
-
 THIRTY_YEARS = timedelta(days=365 * 30)
 TEN_YEARS = timedelta(days=365 * 10)
 ONE_YEAR = timedelta(days=365)
 
+WRITE_BATCH_SIZE = 10
+# A --dropold rebuild writes each level to a staging copy, nobody reads it until it is promoted.
+# Not "_temp", that is the reference copy --verify compares against.
+STAGING_SUFFIX = "_staging"
+REBUILD_BATCH_SIZE = 5000
+# A field every point of each level has, to read which points a level has
+LEVEL_KEY_FIELDS = {"level1": "count", "level2": "count", "level3": "soil_moist", "level4": "soil_moist"}
+# The levels whose points are tagged with their flag, level4 points only have their site
+FLAG_TAGGED_LEVELS = ("level1", "level2", "level3")
+# statements sent in one request while promoting
+PROMOTE_BATCH = 500
+
+
+def end_time_clause(end_time):
+    """
+    :param end_time: inclusive upper time bound, or None for no bound
+    :type end_time: datetime | NoneType
+    :return: an InfluxQL condition to append to a WHERE clause
+    :rtype: str
+    """
+    if end_time is None:
+        return ""
+    return """ AND "time" <= '{}'""".format(datetime_to_isostring(end_time))
+
+
+def clear_level_range(measurement, site_no, back_time, end_time):
+    """
+    Delete a site's points after back_time, up to end_time, before recomputing them as a dirty range.
+    The recomputed points may have different flags (series) or be dropped altogether,
+    so they would not simply overwrite the old ones.
+    """
+    influx_client = get_influx_client()
+    influx_client.query(
+        """DELETE FROM {} WHERE site_no=$s AND "time" > '{}'{};""".format(
+            measurement, datetime_to_isostring(back_time), end_time_clause(end_time)),
+        bind_params={"s": str(site_no)}, method='POST')
+    increment('queries')
+
+
+def level_measurement(level, staging=False):
+    """
+    :return: the measurement a level is written to, its staging copy when rebuilding
+    """
+    return level + STAGING_SUFFIX if staging else level
+
+
+def level_writer(influx_client, staging=False):
+    """
+    :return: a writer for a stage's points. Its batches grow with the write latency,
+        and start large when rebuilding into the staging copy. It prints the write rate it achieved when it exits.
+    :rtype: AccumCacheInfluxWriter
+    """
+    return adaptive_writer(influx_client, cache_length=REBUILD_BATCH_SIZE if staging else WRITE_BATCH_SIZE,
+                           report=print)
+
 
-def level3_to_level4(site_no=1, start_time=None, backprocess=None, drop_old=False):
+RAW_SELECT = """\
+SELECT "time", site_no, "count", pressure1, internal_temperature, internal_humidity, battery, tube_temperature, tube_humidity, rain, vwc1, vwc2, vwc3, pressure2, external_temperature, external_humidity, flag as raw_flag
+FROM "raw_values"
+"""
+
+
+def stream_raw_frames(site_no, from_time, needed_time, end_time=None):
+    """
+    Stream raw_values from from_time (and up to end_time), for records after needed_time.
+    If no record comes before needed_time, the record before from_time is loaded too,
+    so the first needed record still has a previous count.
+    :return: generator of Frames of raw rows, with flag selected as raw_flag
+    """
+    influx_client = get_influx_client()
+    frames = stream_frames(influx_client, """{}\
+WHERE "time" >= '{}'{} AND site_no=$s""".format(RAW_SELECT, datetime_to_isostring(from_time), end_time_clause(end_time)),
+                           bind_params={"s": str(site_no)})
+    first = True
+    for frame in frames:
+        if first and frame['time'][0] > datetime_to_epoch_ns(needed_time):
+            previous = read_frame(influx_client, """{}\
+WHERE "time" < '{}' AND site_no=$s ORDER BY time DESC LIMIT 1;""".format(RAW_SELECT, datetime_to_isostring(from_time)),
+                                  bind_params={"s": str(site_no)})
+            frame = Frame.concat([previous, frame])
+        first = False
+        yield frame
+
+
+def load_raw_frame(site_no, from_time, needed_time, end_time=None):
+    """
+    The rows of stream_raw_frames, as one Frame.
+    :rtype: Frame
+    """
+    return Frame.concat(list(stream_raw_frames(site_no, from_time, needed_time, end_time=end_time)))
+
+
+@timed_stage("level4")
+def level3_to_level4(site_no=1, start_time=None, backprocess=None, drop_old=False, end_time=None, staging=False,
+                     replace_range=False):
+    influx_client = get_influx_client()
+    target = level_measurement("level4", staging)
     if start_time is None:
         start_time = datetime.now().astimezone(timezone.utc)
     if backprocess is None:
         backprocess = TEN_YEARS
     back_time = start_time - backprocess
-    time_string = datetime_to_isostring(back_time)
-    result = influx_client.query("""\
+    # Smoothing windows for points near back_time reach back before it, so load that context too.
+    context_time_string = datetime_to_isostring(back_time - timedelta(hours=3, seconds=1))
+    frames = stream_frames(influx_client, """\
 SELECT "time", site_no, soil_moist, effective_depth, rainfall
---FROM "level3_temp"
-FROM "level3"
-WHERE "time" > '{}' AND flag='0' AND site_no='{}'""".format(time_string, site_no))
-    points = result.get_points()
+FROM "{}"
+WHERE "time" >= '{}'{} AND flag='0' AND site_no='{}'""".format(
+        level_measurement("level3", staging), context_time_string, end_time_clause(None if end_time is None else end_time + timedelta(hours=3, seconds=1)), site_no))
     if drop_old:
         influx_client.query(
-            "DROP SERIES FROM level4 WHERE site_no='{}';".format(site_no),
+            "DROP SERIES FROM {} WHERE site_no='{}';".format(target, site_no),
             method='POST')
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
-        for p in points:
-            this_datetime = isostring_to_datetime(p['time'])
-            three_h_ago = datetime_to_isostring(this_datetime - timedelta(hours=3, seconds=1))
-            three_h_fwd = datetime_to_isostring(this_datetime + timedelta(hours=3, seconds=1))
-
-            r2 = influx_client.query("""\
-SELECT MEAN("soil_moist") as soil_moist_filtered, MEAN("effective_depth") as depth_filtered
-FROM (SELECT soil_moist, effective_depth FROM "level3"
-WHERE "time" >= '{}' AND "time" <= '{}' AND flag='0' AND site_no='{}'
-LIMIT 7)""".format(three_h_ago, three_h_fwd, site_no))
-            p2 = r2.get_points()
-            try:
-                avgs = next(p2)
-                soil_moist_filtered = avgs['soil_moist_filtered']
-                depth_filtered = avgs['depth_filtered']
-            except (StopIteration, KeyError):
-                soil_moist_filtered = p['soil_moist']
-                depth_filtered = p['effective_depth']
-            json_body = {
-                "measurement": "level4",
-                #"measurement": "level4_temp",
-                "tags": {
-                    "site_no": p['site_no'],
-                },
-                "time": p['time'],
-                "fields": {
-                    "soil_moist": float(p['soil_moist']),
-                    "effective_depth": float(p['effective_depth']),
-                    "rainfall": float(p['rainfall']),
-                    "soil_moist_filtered": soil_moist_filtered,
-                    "depth_filtered": depth_filtered
-                }
-            }
-            writer.write_point(json_body)
-
-
-def level2_to_level3(mongo_client, site_no=1, start_time=None, backprocess=None, drop_old=False):
+        increment('queries')
+    elif replace_range:
+        clear_level_range(target, site_no, back_time, end_time)
+    back_ns = datetime_to_epoch_ns(back_time)
+    end_ns = None if end_time is None else datetime_to_epoch_ns(end_time)
+    site_tag = str(site_no)
+
+    def write_smoothed(writer, frame, from_index, to_index):
+        times = frame['time']
+        soil_moist_filtered, depth_filtered = smooth_level3(times, frame['soil_moist'], frame['effective_depth'])
+        first_index = max(from_index, int(np.searchsorted(times, back_ns, side='right')))
+        if end_ns is not None:
+            to_index = min(to_index, int(np.searchsorted(times, end_ns, side='right')))
+        if first_index >= to_index:
+            return
+        rows = slice(first_index, to_index)
+        writer.write_columns(target, {"site_no": site_tag}, {
+            "soil_moist": frame['soil_moist'][rows],
+            "effective_depth": frame['effective_depth'][rows],
+            "rainfall": frame['rainfall'][rows],
+            "soil_moist_filtered": soil_moist_filtered[rows],
+            "depth_filtered": depth_filtered[rows],
+        }, times[rows])
+
+    frame = Frame({})
+    written = 0  # frame rows before this are written already, or only there for context
+    with level_writer(influx_client, staging) as writer:
+        for batch in frames:
+            frame = Frame.concat([frame, batch])
+            times = frame['time']
+            # A point's smoothing window is complete once a point more than half a window after it has arrived
+            ready = int(np.searchsorted(times, times[-1] - SMOOTHING_HALF_WIDTH_NS, side='left'))
+            write_smoothed(writer, frame, written, ready)
+            keep = int(np.searchsorted(times, times[ready] - SMOOTHING_HALF_WIDTH_NS, side='left'))
+            frame = frame.take(slice(keep, None))
+            written = ready - keep
+        if len(frame) > written:
+            write_smoothed(writer, frame, written, len(frame))
+
+
+@timed_stage("level3")
+def level2_to_level3(mongo_client, site_no=1, start_time=None, backprocess=None, drop_old=False, end_time=None,
+                     staging=False, replace_range=False):
+    influx_client = get_influx_client()
+    target = level_measurement("level3", staging)
     if start_time is None:
         start_time = datetime.now().astimezone(timezone.utc)
     if backprocess is None:
         backprocess = TEN_YEARS
     back_time = start_time - backprocess
     time_string = datetime_to_isostring(back_time)
-    mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
-    all_stations = mdb.all_stations
-    this_site = all_stations.find_one({'site_no': site_no})
-    try:
-        alternate_algorithm = this_site["alternate_algorithm"]
-    except LookupError:
-        alternate_algorithm = None
-    sandy_a = 1216036430.0
-    sandy_b = -3.272
-    result = influx_client.query("""\
+    site_params = get_site_params(site_no, mongo_client)
+    frames = stream_frames(influx_client, """\
 SELECT "time", site_no, wv_corr, corr_count, rain, flag as level2_flag
 --SELECT "time", site_no, wv_corr, corr_count, flag as level2_flag
---FROM "level2_temp"
-FROM "level2"
-WHERE "time" > '{}' AND site_no='{}'""".format(time_string, site_no))
-    points = result.get_points()
+FROM "{}"
+WHERE "time" > '{}'{} AND site_no='{}'""".format(
+        level_measurement("level2", staging), time_string, end_time_clause(end_time), site_no))
     if drop_old:
-        influx_client.query("DROP SERIES FROM level3 WHERE site_no='{}';".format(site_no), method='POST')
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
-        for p in points:
-            wv_corr = float(p['wv_corr'])
-            corr_count = float(p['corr_count'])
-            n0_cal = float(this_site['n0_cal'].to_decimal())
-            bulk_density = float(this_site['bulk_density'].to_decimal())
-            lattice_water_g_g = this_site['lattice_water_g_g'].to_decimal()
-            soil_organic_matter_g_g = this_site['soil_organic_matter_g_g'].to_decimal()
-            lattice_soil_organic_sum = float(lattice_water_g_g + soil_organic_matter_g_g)
-            if alternate_algorithm and alternate_algorithm == "sandy":
-                if wv_corr == 1.0:
-                    flag = 5
-                elif corr_count > (3.0 * n0_cal):
-                     flag = 3
-                elif corr_count < (0.5 * n0_cal):
-                    flag = 2
-                else:
-                    flag = int(p['level2_flag'])
-                corrected_moist_val = sandy_a * (corr_count ** sandy_b)
-            else:
-                if wv_corr == 1.0:
-                    flag = 5
-                elif corr_count > n0_cal:
-                    flag = 3
-                elif corr_count < (0.4 * n0_cal):
-                    flag = 2
-                else:
-                    flag = int(p['level2_flag'])
-                corrected_moist_val = (0.0808 / ((corr_count / n0_cal) - 0.372) - 0.115 - lattice_soil_organic_sum) * bulk_density
-            #((0.0808 / ((l2.CorrCount / a.N0_Cal) - 0.372) - 0.115 - a.LatticeWater_g_g - a.SoilOrganicMatter_g_g) * a.BulkDensity) * 100
-            soil_moisture = corrected_moist_val * 100.0
-            #5.8 / ( ((a.LatticeWater_g_g + a.SoilOrganicMatter_g_g) * a.BulkDensity) + ( (0.0808 / ( (l2.CorrCount / a.N0_Cal) - 0.372) - 0.115 - a.LatticeWater_g_g - a.SoilOrganicMatter_g_g) * a.BulkDensity ) + 0.0829) AS EffectiveDepth,
-            effective_depth = 5.8 / ((lattice_soil_organic_sum * bulk_density) + corrected_moist_val + 0.0829)
-            json_body = {
-                "measurement": "level3",
-                #"measurement": "level3_temp",
-                "tags": {
-                    "site_no": p['site_no'],
-                    "flag": flag,
-                },
-                "time": p['time'],
-                "fields": {
-                    "soil_moist": soil_moisture,
-                    "effective_depth": effective_depth,
-                    "rainfall": float(p['rain']) * 0.2
-                }
-            }
-            writer.write_point(json_body)
-
-
-def level1_to_level2(mongo_client, site_no=1, start_time=None, backprocess=None, drop_old=False):
+        influx_client.query("DROP SERIES FROM {} WHERE site_no='{}';".format(target, site_no), method='POST')
+        increment('queries')
+    elif replace_range:
+        clear_level_range(target, site_no, back_time, end_time)
+    site_tag = str(site_no)
+    with level_writer(influx_client, staging) as writer:
+        for frame in frames:
+            values = level3_values(
+                frame['corr_count'],
+                frame['wv_corr'],
+                frame['level2_flag'],
+                frame['rain'],
+                site_params,
+                alternate_algorithm=site_params.alternate_algorithm)
+            writer.write_columns(target, {"site_no": site_tag}, {
+                "soil_moist": values['soil_moist'],
+                "effective_depth": values['effective_depth'],
+                "rainfall": values['rainfall'],
+            }, frame['time'], tag_columns={"flag": values['flag']})
+
+
+@timed_stage("level2")
+def level1_to_level2(mongo_client, site_no=1, start_time=None, backprocess=None, drop_old=False, end_time=None,
+                     staging=False, replace_range=False):
+    influx_client = get_influx_client()
+    target = level_measurement("level2", staging)
     emulate_old_version = False
     if start_time is None:
         start_time = datetime.now().astimezone(timezone.utc)
@@ -176,260 +257,178 @@ def level1_to_level2(mongo_client, site_no=1, start_time=None, backprocess=None,
         backprocess = TEN_YEARS
     back_time = start_time - backprocess
     time_string = datetime_to_isostring(back_time)
-    mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
-    all_stations_collection = mdb.all_stations
-    this_site = all_stations_collection.find_one({'site_no': site_no})
-    result = influx_client.query("""\
+    site_params = get_site_params(site_no, mongo_client)
+    frames = stream_frames(influx_client, """\
 SELECT "time", site_no, "count", pressure1, pressure2, external_temperature, external_humidity, rain, flag as level1_flag
-FROM "level1"
-WHERE "time" > '{}' AND site_no=$s""".format(time_string), bind_params={"s": str(site_no)})
-    points = result.get_points()
+FROM "{}"
+WHERE "time" > '{}'{} AND site_no=$s""".format(level_measurement("level1", staging), time_string, end_time_clause(end_time)),
+                           bind_params={"s": str(site_no)})
+    intensity_index = IntensityIndex.load(influx_client, site_no, back_time, with_earliest=emulate_old_version,
+                                          to_time=end_time)
+    silo_index = SiloIndex.load(influx_client, site_no, back_time, to_time=end_time)
     if drop_old:
-        influx_client.query("DROP SERIES FROM level2 WHERE site_no=$s;", bind_params={"s": str(site_no)}, method='POST')
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
-        for p in points:
-            count = p['count']
-            pressure1 = float(p['pressure1'])
-            pressure2 = float(p['pressure2'])
-            if pressure2 != 0:
-                press_corr = math.exp(float(this_site['beta'].to_decimal()) * (pressure2 - float(this_site['ref_pressure'].to_decimal())))
-            elif pressure1 != 0:
-                press_corr = math.exp(float(this_site['beta'].to_decimal()) * (pressure1 - float(this_site['ref_pressure'].to_decimal())))
-            else:
-                press_corr = 1.0
-            this_datetime = isostring_to_datetime(p['time'])
-            this_day_start = datetime_to_isostring(this_datetime.date())
-            this_day_end = datetime_to_isostring(datetime.combine(this_datetime.date(), d_time(11, 59, 59, 999999, tzinfo=this_datetime.tzinfo)))
-            this_hour_start = datetime_to_isostring(datetime.combine(this_datetime.date(), d_time(this_datetime.hour, 0, 0, 0, tzinfo=this_datetime.tzinfo)))
-            this_hour_end = datetime_to_isostring(datetime.combine(this_datetime.date(), d_time(this_datetime.hour, 59, 59, 999999, tzinfo=this_datetime.tzinfo)))
-            external_temperature = float(p['external_temperature'])
-            external_humidity = float(p['external_humidity'])
+        influx_client.query("DROP SERIES FROM {} WHERE site_no=$s;".format(target), bind_params={"s": str(site_no)}, method='POST')
+        increment('queries')
+    elif replace_range:
+        clear_level_range(target, site_no, back_time, end_time)
+    site_tag = str(site_no)
+    with level_writer(influx_client, staging) as writer:
+        for frame in frames:
+            times = frame['time']
             # if external temperature or external humidity is zero, we will need to get the data from SILO.
-            if external_temperature == 0 or external_humidity == 0:
-                silo_req = influx_client.query("""SELECT LAST(*) FROM "silo_data" WHERE "time" >= '{}' AND "time" <= '{}' AND site_no='{}'""".format(this_day_start, this_day_end, site_no))
-                try:
-                    sp = next(silo_req.get_points())
-                    average_temperature = float(sp['last_average_temperature'])
-                    average_humidity = float(sp['last_average_humidity'])
-                except (StopIteration, ValueError, KeyError):
-                    average_temperature = None
-                    average_humidity = None
-            else:
-                average_temperature = None
-                average_humidity = None
-
-            if external_temperature != 0 and external_humidity != 0:
-                # IF ExternalTemperature AND ExternalHumidity (from the Level1View View) has valid data. Use them in the WVCorr equation
-                wv_corr_store = 1+0.0054*((2165*((0.6108*math.exp((17.27*external_temperature)/(external_temperature+237.3)))*(external_humidity/100.0)))/(external_temperature+273.16)-0)
-                wv_corr_use = wv_corr_store
-            elif average_humidity is not None:
-                # Otherwise, IF AverageTemperature AND AverageHumidity (from the SiloData table) has valid data. Use them in the WVCorr equation.
-                use_temp = average_temperature if average_temperature is not None else 0.0
-                wv_corr_use = 1+0.0054*((2165*((0.6108*math.exp((17.27*use_temp)/(use_temp+237.3)))*(average_humidity/100.0)))/(use_temp+273.16)-0)
-                if emulate_old_version:
-                    if average_temperature is not None:
-                        wv_corr_store = wv_corr_use
-                    else:
-                        wv_corr_store = 1.0
-                else:
-                    wv_corr_store = wv_corr_use
-            else:
-                # Finally, use either external OR average values, or zero
-                use_humidity = average_humidity if external_humidity == 0 else external_humidity
-                use_temp = average_temperature if external_temperature == 0 else external_temperature
-                if use_humidity is None or use_humidity == 0:
-                    wv_corr_use = 1.0
-                else:
-                    if use_temp is None:
-                        use_temp = 0.0  # Use the actual zero temp in the calculation
-                    wv_corr_use = 1+0.0054*((2165*((0.6108*math.exp((17.27*use_temp)/(use_temp+237.3)))*(use_humidity/100.0)))/(use_temp+273.16)-0)
-                if emulate_old_version:
-                    wv_corr_store = 1.0  # Store this, to match the old way the system stored wv_corr
-                else:
-                    wv_corr_store = wv_corr_use
-            # IF we can match the record's timestamp (to the hour) to one in the Intensity table. Use the Intensity value in the IntensityCorr equation.
-            intensity_req = influx_client.query("""SELECT * FROM "intensity" WHERE "time" >= '{}' AND "time" <= '{}' AND site_no='{}'""".format(this_hour_start, this_hour_end, site_no))
-            try:
-                intensities = list(intensity_req.get_points())
-                assert len(intensities) > 0
-                if len(intensities) > 1:
-                    print("Found too many intensity records in a single hour period.")
-                intensity_p = intensities[0]
-                #int_key = "intensity"
-            except (StopIteration, AssertionError):
-                # no intensity to the nearest hour
-                # Otherwise, IF we can find the last valid timestamp for this record. Use the Intensity value in the IntensityCorr equation.
-                if emulate_old_version:
-                    intensity_req = influx_client.query("""SELECT FIRST("intensity") AS "intensity", "bad_data_flag" FROM "intensity" WHERE "time" <= '{}' AND site_no='{}'""".format(p['time'], site_no))
-                    #int_key = "first_intensity"
-                else:
-                    intensity_req = influx_client.query("""SELECT LAST("intensity") AS "intensity", "bad_data_flag" FROM "intensity" WHERE "time" <= '{}' AND site_no='{}'""".format(p['time'], site_no))
-                    #int_key = "last_intensity"
-                try:
-                    intensity_p = next(intensity_req.get_points())
-                except StopIteration:
-                    intensity_req = influx_client.query("""SELECT FIRST("intensity") AS "intensity", "bad_data_flag" FROM "intensity" WHERE "time" >= '{}' AND site_no='{}'""".format(p['time'], site_no))
-                    try:
-                        intensity_p = next(intensity_req.get_points())
-                        #int_key = "first_intensity"
-                    except Exception:
-                        intensity_p = None
-                        #int_key = None
-            if intensity_p and "intensity" in intensity_p:
-                use_intensity = float(intensity_p["intensity"])
-                if use_intensity == 0.0:  # prevent div by zero
-                    intensity_corr = 1.0
-                else:
-                    intensity_corr = use_intensity / float(this_site['ref_intensity'].to_decimal())
-            else:
-                intensity_corr = 1.0
-            latit_scaling = this_site['latit_scaling'].to_decimal()
-            elev_scaling = this_site['elev_scaling'].to_decimal()
-            try:
-                corr_count = (float(count)*wv_corr_use*press_corr/intensity_corr)/float(latit_scaling/elev_scaling)
-            except ZeroDivisionError:
-                print("count:", p["count"])
-                print("latit_scaling:", latit_scaling)
-                print("elev_scaling:", elev_scaling)
-                print("wv_corr_use:", wv_corr_use)
-                print("intensity_corr:", intensity_corr)
-                raise
-            json_body = {
-                "measurement": "level2",
-                #"measurement": "level2_temp",
-                "tags": {
-                    "site_no": p['site_no'],
-                    "flag": int(p['level1_flag']),
-                },
-                "time": p['time'],
-                "fields": {
-                    "count": int(count),
-                    "press_corr": press_corr,
-                    "wv_corr": wv_corr_store,
-                    "intensity_corr": intensity_corr,
-                    "corr_count": corr_count,
-                    "rain": float(p['rain']),
-                }
-            }
-            writer.write_point(json_body)
-
-def is_duplicate(site_no, record1, record2, table):
-    if isinstance(record2, datetime):
-        record2 = datetime_to_isostring(record2)
-    if isinstance(record2, str):
-        result = influx_client.query("""\
-        SELECT "time", site_no, "count", pressure1, internal_temperature, internal_humidity, battery, tube_temperature, tube_humidity, rain, vwc1, vwc2, vwc3, pressure2, external_temperature, external_humidity, flag as raw_flag
-        FROM "{}"
-        WHERE "time" = '{}' AND site_no=$s;""".format(table, record2), bind_params={"s": str(site_no)})
-        points = result.get_points()
-        try:
-            record2 = next(iter(points))
-        except (IndexError, StopIteration):
-            return False
-    different = {}
-    for key, val in record1.items():
-        if key in ("time", "site_no", "flag"):
-            continue
-        if key in record2:
-            val2 = record2[key]
-            if val != val2:
-                different[key] = (val, val2)
-    return len(different) < 1
+            needs_silo = (frame['external_temperature'] == 0) | (frame['external_humidity'] == 0)
+            average_temperatures, average_humidities = silo_index.averages_many(times)
+            average_temperatures = np.where(needs_silo, average_temperatures, np.nan)
+            average_humidities = np.where(needs_silo, average_humidities, np.nan)
+            # IF we can match the record's timestamp (to the hour) to one in the Intensity table, or else find the
+            # last valid timestamp for this record. Use the Intensity value in the IntensityCorr equation.
+            intensities = intensity_index.lookup_many(times, emulate_old_version=emulate_old_version)
+            corrections = level2_corrections(
+                frame['count'],
+                frame['pressure1'],
+                frame['pressure2'],
+                frame['external_temperature'],
+                frame['external_humidity'],
+                average_temperatures,
+                average_humidities,
+                intensities,
+                site_params.beta,
+                site_params.ref_pressure,
+                site_params.ref_intensity,
+                site_params.check_scaling(), emulate_old_version=emulate_old_version)
+            increment('silo_fallbacks', silo_fallbacks(frame['external_temperature'], frame['external_humidity'],
+                                                       average_humidities))
+            writer.write_columns(target, {"site_no": site_tag}, {
+                "count": [int(c) for c in frame['count'].tolist()],
+                "press_corr": corrections['press_corr'],
+                "wv_corr": corrections['wv_corr'],
+                "intensity_corr": corrections['intensity_corr'],
+                "corr_count": corrections['corr_count'],
+                "rain": frame['rain'],
+            }, times, tag_columns={"flag": frame['level1_flag']})
 
 
-def raw_to_level1(site_no=1, start_time=None, backprocess=None, drop_old=False):
+@timed_stage("level1")
+def raw_to_level1(site_no=1, start_time=None, backprocess=None, drop_old=False, end_time=None, staging=False,
+                  replace_range=False):
+    influx_client = get_influx_client()
+    target = level_measurement("level1", staging)
     if start_time is None:
         start_time = datetime.now().astimezone(timezone.utc)
     if backprocess is None:
         backprocess = TEN_YEARS
     back_time = start_time - backprocess
-    time_string = datetime_to_isostring(back_time)
-    a_res = influx_client.query("""SELECT "time", "count", site_no FROM "raw_values" WHERE site_no=$s""", bind_params={"s": str(site_no)})
-    all_mapped = {}
-    for p in a_res.get_points():
-        all_mapped[isostring_to_datetime(p["time"])] = p
-    all_times = SortedList(all_mapped.keys())
-    result = influx_client.query("""\
-SELECT "time", site_no, "count", pressure1, internal_temperature, internal_humidity, battery, tube_temperature, tube_humidity, rain, vwc1, vwc2, vwc3, pressure2, external_temperature, external_humidity, flag as raw_flag
-FROM "raw_values"
-WHERE "time" > '{}' AND site_no=$s;""".format(time_string), bind_params={"s": str(site_no)})
-    points = result.get_points()
-    result2 = influx_client.query("""\
-SELECT DIFFERENCE("count") as count_diff
-FROM "raw_values"
-WHERE "time" > '{}' AND site_no=$s""".format(time_string), bind_params={"s": str(site_no)})
-    points2 = result2.get_points()
+    # Duplicates are checked against records up to 29 minutes before the first processed record, so load those too.
+    frames = stream_raw_frames(site_no, back_time - timedelta(minutes=29.0), back_time, end_time=end_time)
+    back_ns = datetime_to_epoch_ns(back_time)
     if drop_old:
-        influx_client.query("DROP SERIES FROM level1 WHERE site_no=$s;", bind_params={"s":str(site_no)}, method='POST')
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
-        try:
-            #skip the first p, because it doesn't have a corresponding diff
-            _ = next(points)
-        except StopIteration:
-            return
-        #influx_client.query("DROP SERIES FROM level1_temp WHERE site_no='{}';".format(site_no), method='POST')
-        for p in points:
-            time_str = p['time']
-            at_time = isostring_to_datetime(time_str)
-            count = p['count']
-            dup_back_time = at_time - timedelta(minutes=29.0)
-            possible_duplicates_times = list(all_times.irange(dup_back_time, at_time, inclusive=(True, False)))
-            if len(possible_duplicates_times) > 0:
-                for dt in possible_duplicates_times:
-                    dc = all_mapped[dt]['count']
-                    dtstring = all_mapped[dt]['time']
-                    if dc == count:
-                        im_duplicate = is_duplicate(site_no, p, dtstring, 'raw_values')
-                        if im_duplicate:
-                            break
-                else:
-                    im_duplicate = False
-                if im_duplicate:
-                    print("Skipping time {} at site {} because it is a duplicate.".format(time_str, site_no))
-                    _ = next(points2)
-                    continue
-            bat = p['battery']
-            p2 = next(points2)
-            count_diff = p2['count_diff']
-            prev_count = count+(count_diff * -1.0)
-            if prev_count < 0:
-                raise ValueError("Incorrect previous_count calculation.")
-            if bat < 10:
-                flag = 4
-            elif count < (0.8 * prev_count) or count > (1.2 * prev_count):
-                flag = 1
-            else:
-                flag = p['raw_flag']
-
-            json_body = {
-                "measurement": "level1",
-                #"measurement": "level1_temp",
-                "tags": {
-                    "site_no": p['site_no'],
-                    "flag": int(flag),
-                },
-                "time": time_str,
-                "fields": {
-                    "count": int(p['count']),
-                    "pressure1": float(p['pressure1']),
-                    "internal_temperature": float(p['internal_temperature']),
-                    "internal_humidity": float(p['internal_humidity']),
-                    "battery": float(p['battery']),
-                    "tube_temperature": float(p['tube_temperature']),
-                    "tube_humidity": float(p['tube_humidity']),
-                    "rain": float(p['rain']),
-                    "vwc1": float(p['vwc1']),
-                    "vwc2": float(p['vwc2']),
-                    "vwc3": float(p['vwc3']),
-                    "pressure2": float(p['pressure2']),
-                    "external_temperature": float(p['external_temperature']),
-                    "external_humidity": float(p['external_humidity']),
-                }
-            }
-            writer.write_point(json_body)
+        influx_client.query("DROP SERIES FROM {} WHERE site_no=$s;".format(target), bind_params={"s":str(site_no)}, method='POST')
+        increment('queries')
+    elif replace_range:
+        clear_level_range(target, site_no, back_time, end_time)
+    site_tag = str(site_no)
+    carry = Frame({})
+    with level_writer(influx_client, staging) as writer:
+        for batch in frames:
+            # the first len(carry) rows are from the previous batch, for the duplicate window and previous count
+            rows = Frame.concat([carry, batch])
+            times = rows['time']
+            duplicates = duplicate_mask(times, column_record_keys(rows))
+            flags, _ = level1_flags(rows['count'], rows['battery'], rows['raw_flag'])
+            #skip the very first record, because it doesn't have a previous count
+            first_index = max(int(np.searchsorted(times, back_ns, side='right')), len(carry), 1)
+            for i in np.flatnonzero(duplicates[first_index:]).tolist():
+                print("Skipping time {} at site {} because it is a duplicate.".format(
+                    epoch_ns_to_isostring(times[first_index + i]), site_no))
+            write = np.zeros(len(rows), dtype=bool)
+            write[first_index:] = ~duplicates[first_index:]
+            fields = {f: rows[f][write] for f in LEVEL_FIELDS["level1"]}
+            fields["count"] = [int(c) for c in fields["count"].tolist()]
+            writer.write_columns(target, {"site_no": site_tag}, fields, times[write],
+                                 tag_columns={"flag": flags[write]})
+            keep = min(int(np.searchsorted(times, times[-1] - DUPLICATE_WINDOW_NS, side='left')), len(rows) - 1)
+            carry = rows.take(slice(keep, None))
+
+
+LEVEL_FIELDS = {
+    "level1": ("count", "pressure1", "internal_temperature", "internal_humidity", "battery", "tube_temperature",
+               "tube_humidity", "rain", "vwc1", "vwc2", "vwc3", "pressure2", "external_temperature",
+               "external_humidity"),
+    "level2": ("count", "press_corr", "wv_corr", "intensity_corr", "corr_count", "rain"),
+    "level3": ("soil_moist", "effective_depth", "rainfall"),
+    "level4": ("soil_moist", "effective_depth", "rainfall", "soil_moist_filtered", "depth_filtered"),
+}
+
+
+def write_level_columns(measurement, site_no, columns, drop_old=False, staging=False):
+    """
+    Write one level's columns, as produced by fused.fused_levels, to its measurement.
+    :param measurement: level1, level2, level3 or level4
+    :param site_no:
+    :param columns:
+    :type columns: dict
+    :param drop_old: drop the site's existing series from the measurement first
+    :param staging: write to the level's staging copy, for a rebuild
+    """
+    influx_client = get_influx_client()
+    target = level_measurement(measurement, staging)
+    if drop_old:
+        influx_client.query("DROP SERIES FROM {} WHERE site_no=$s;".format(target), bind_params={"s": str(site_no)}, method='POST')
+        increment('queries')
+    fields = {f: columns[f] for f in LEVEL_FIELDS[measurement]}
+    if "count" in fields:
+        fields["count"] = [int(c) for c in fields["count"].tolist()]
+    tag_columns = {"flag": columns['flag']} if 'flag' in columns else None
+    with level_writer(influx_client, staging) as writer:
+        writer.write_columns(target, {"site_no": str(site_no)}, fields, columns['time'], tag_columns=tag_columns)
+
+
+def load_fused_inputs(mongo_client, site_no, back_time, end_time=None, emulate_old_version=False):
+    """
+    Read everything fused_levels needs to compute a site's levels for (back_time, end_time].
+    :return: keyword arguments for fused.fused_levels
+    :rtype: dict
+    """
+    influx_client = get_influx_client()
+    site_params = get_site_params(site_no, mongo_client)
+    smoothing_width = timedelta(microseconds=SMOOTHING_HALF_WIDTH_NS // 1000)
+    context_time = back_time - smoothing_width
+    context_end_time = None if end_time is None else end_time + smoothing_width
+    raw = load_raw_frame(
+        site_no, back_time - timedelta(microseconds=RAW_LEAD_IN_NS // 1000), context_time, end_time=context_end_time)
+    intensity_index = IntensityIndex.load(influx_client, site_no, context_time, with_earliest=emulate_old_version,
+                                          to_time=context_end_time)
+    silo_index = SiloIndex.load(influx_client, site_no, context_time, to_time=context_end_time)
+    return {
+        'raw': raw,
+        'site_params': site_params,
+        'intensity_index': intensity_index,
+        'silo_index': silo_index,
+        'window_start_ns': datetime_to_epoch_ns(back_time),
+        'window_end_ns': None if end_time is None else datetime_to_epoch_ns(end_time),
+        'emulate_old_version': emulate_old_version,
+    }
+
+
+@timed_stage("fused")
+def fused_process_levels(mongo_client, site_no=1, start_time=None, backprocess=None, drop_old=False, end_time=None,
+                         staging=False):
+    """
+    Process raw->level4 in memory: raw_values is read once, and each level is only written, never re-read.
+    With an end_time, only records up to end_time are written, but raw data is read past it for the smoothing.
+    """
+    if start_time is None:
+        start_time = datetime.now().astimezone(timezone.utc)
+    if backprocess is None:
+        backprocess = TEN_YEARS
+    back_time = start_time - backprocess
+    levels = fused_levels(**load_fused_inputs(mongo_client, site_no, back_time, end_time=end_time))
+    for measurement in LEVELS:
+        write_level_columns(measurement, site_no, levels[measurement], drop_old=drop_old, staging=staging)
 
 
 def fix_raws(site_no=1):
+    influx_client = get_influx_client()
     result = influx_client.query("""\
 SELECT *
 FROM "raw_values"
@@ -453,206 +452,528 @@ WHERE site_no='{}' AND time='{}';""".format(site_no, bad_t)
     return
 
 
-def test1(site_no=1, start_time=None):
+def verify_stage(site_no, level, start_time=None, backprocess=None, end_time=None, staging=False):
+    """
+    Compare the part of a site's level that a stage just processed with its "_temp" copy, and print the summary.
+    :param staging: check the level's staging copy, which a rebuild writes to, rather than the level
+    :return: True if they agree
+    :rtype: bool
+    """
+    influx_client = get_influx_client()
     if start_time is None:
         start_time = datetime.now().astimezone(timezone.utc)
-    back_time = start_time - TEN_YEARS
-    time_string = datetime_to_isostring(back_time)
-    result1 = influx_client.query("""\
-    SELECT "time", site_no, "count", pressure1, internal_temperature, internal_humidity, battery, tube_temperature, tube_humidity, rain, vwc1, vwc2, vwc3, pressure2, external_temperature, external_humidity, flag
-    FROM "level1"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points1 = result1.get_points()
-    result2 = influx_client.query("""\
-    SELECT "time", site_no, "count", pressure1, internal_temperature, internal_humidity, battery, tube_temperature, tube_humidity, rain, vwc1, vwc2, vwc3, pressure2, external_temperature, external_humidity, flag
-    FROM "level1_temp"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points2 = result2.get_points()
-    _ = next(points1)
-    t = 0
-    d = 0
-    for p1 in points1:
-        p2 = next(points2)
-        t += 1
-        diffkeys = [k for k in p1 if p1[k] != p2[k]]
-        for k in diffkeys:
-            d += 1
-            print(k, ':', p1[k], '->', p2[k])
-    return d < 1
-
-def test2(site_no=1, start_time=None):
-    if start_time is None:
-        start_time = datetime.now().astimezone(timezone.utc)
-    back_time = start_time - TEN_YEARS
-    time_string = datetime_to_isostring(back_time)
-    result1 = influx_client.query("""\
-    SELECT "time", site_no, "count", press_corr, wv_corr, intensity_corr, corr_count, flag
-    FROM "level2"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points1 = result1.get_points()
-    result2 = influx_client.query("""\
-    SELECT "time", site_no, "count", press_corr, wv_corr, intensity_corr, corr_count, flag
-    FROM "level2_temp"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points2 = result2.get_points()
-    t = 0
-    d = 0
-    for p1 in points1:
-        p2 = next(points2)
-        t += 1
-        diffkeys = [k for k in p1 if p1[k] != p2[k]]
-        for k in diffkeys:
-            orig_one = p1[k]
-            if isinstance(orig_one, float):
-                diff = math.fabs(orig_one - p2[k])
-                diff_perc = (diff/orig_one) * 100
-                #these all seem to be 0.00000088888888 different. (8.8888888e-07)
-                if diff_perc < 8.88888912e-07:
-                    #print("Close enough:", k, ':', p1[k], '->', p2[k], "d:", diff, "p:", diff_perc)
-                    pass
-                else:
-                    d += 1
-                    print("Not close enough:", k, ':', p1[k], '->', p2[k], "d:", diff, "p:", diff_perc)
-                    print(p1)
-                    print(p2)
-            else:
-                d += 1
-                print("Different!", k, ':', p1[k], '->', p2[k])
-                print(p1)
-                print(p2)
-    if d > 0:
-        percent_wrong = (d/t) * 100
-        print("Percentage of total entries with differences: {}/{} {}%".format(d, t, percent_wrong))
-    return d < 1
-
-def test3(site_no=1, start_time=None):
-    if start_time is None:
-        start_time = datetime.now().astimezone(timezone.utc)
-    back_time = start_time - TEN_YEARS
-    time_string = datetime_to_isostring(back_time)
-    result1 = influx_client.query("""\
-    --SELECT "time", site_no, soil_moist, effective_depth, flag
-    SELECT "time", site_no, soil_moist, effective_depth, rainfall, flag
-    FROM "level3"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points1 = result1.get_points()
-    result2 = influx_client.query("""\
-    --SELECT "time", site_no, soil_moist, effective_depth, flag
-    SELECT "time", site_no, soil_moist, effective_depth, rainfall, flag
-    FROM "level3_temp"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points2 = result2.get_points()
-    t = 0
-    d = 0
-    for p1 in points1:
-        p2 = next(points2)
-        t += 1
-        diffkeys = [k for k in p1 if p1[k] != p2[k]]
-        for k in diffkeys:
-            orig_one = p1[k]
-            if isinstance(orig_one, float):
-                diff = math.fabs(orig_one - p2[k])
-                diff_perc = (diff / orig_one) * 100
-                if diff < 0.00001 or diff_perc < 0.00033:
-                    pass
-                else:
-                    d += 1
-                    print("Not close enough:", k, ':', p1[k], '->', p2[k], "d:", diff, "p:", diff_perc)
-                    print(p1)
-                    print(p2)
-            else:
-                d += 1
-                print("Different!", k, ':', p1[k], '->', p2[k])
-                print(p1)
-                print(p2)
-    if d > 0:
-        percent_wrong = (d/t) * 100
-        print("Percentage of total entries with differences: {}/{} {}%".format(d, t, percent_wrong))
-    return d < 1
+    if backprocess is None:
+        backprocess = TEN_YEARS
+    report = verify_level(influx_client, site_no, level, back_time=start_time - backprocess, end_time=end_time,
+                          reference=level_measurement(level, staging))
+    for line in report.summary():
+        print(line)
+    return report.ok
 
 
-def test4(site_no=1, start_time=None):
-    if start_time is None:
-        start_time = datetime.now().astimezone(timezone.utc)
-    back_time = start_time - TEN_YEARS
-    time_string = datetime_to_isostring(back_time)
-    result1 = influx_client.query("""\
-    SELECT "time", site_no, soil_moist, effective_depth, rainfall, soil_moist_filtered, depth_filtered
-    FROM "level4"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points1 = result1.get_points()
-    result2 = influx_client.query("""\
-    SELECT "time", site_no, soil_moist, effective_depth, rainfall, soil_moist_filtered, depth_filtered
-    FROM "level4_temp"
-    WHERE "time" > '{}' AND site_no='{}';""".format(time_string, site_no))
-    points2 = result2.get_points()
-    t = 0
-    d = 0
-    for p1 in points1:
-        try:
-            p2 = next(points2)
-        except StopIteration:
-            break
-        t += 1
-        diffkeys = [k for k in p1 if p1[k] != p2[k]]
-        for k in diffkeys:
-            orig_one = p1[k]
-            if isinstance(orig_one, float):
-                diff = math.fabs(orig_one - p2[k])
-                diff_perc = (diff / orig_one) * 100
-                # these all seem to be 0.00000088888888 different. (8.8888888e-07)
-                if diff < 3.29e-05 or diff_perc < 4.8e-06:
-                    # print("Close enough: ", k, ':', p1[k], '->', p2[k], "d:", diff)
-                    pass
-                else:
-                    d += 1
-                    print("Not close enough:", k, ':', p1[k], '->', p2[k], "d:", diff, "p:", diff_perc)
-                    print(p1)
-                    print(p2)
-            else:
-                d += 1
-                print("Different!", k, ':', p1[k], '->', p2[k])
-                print(p1)
-                print(p2)
-    if d > 0:
-        percent_wrong = (d/t) * 100
-        print("Percentage of total entries with differences: {}/{} {}%".format(d, t, percent_wrong))
-    return d < 1
+def recompute_dirty_ranges(mongo_client, site_no):
+    """
+    Recompute the parts of each level affected by late-arriving inputs recorded in the dirty ranges collection.
+    Only the parts of those ranges up to where incremental processing resumes each level are recomputed,
+    the rest is left to it. So this runs before a run advances the watermarks, otherwise it would recompute
+    what that run has only just processed, such as the span of every routine raw ingest.
+    A level without a watermark has all of its ranges recomputed, see clip_ranges.
+    :return: the number of dirty ranges consumed
+    :rtype: int
+    """
+    influx_client = get_influx_client()
+    mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
+    docs = pending_dirty(mdb, site_no)
+    if len(docs) < 1:
+        return 0
+    changes = [(d['source'], d['start'], d['end']) for d in docs]
+    ranges = level_ranges(
+        changes,
+        next_raw_time=lambda t: probe_next_time(influx_client, "raw_values", site_no, t),
+        next_intensity_time=lambda t: probe_next_time(influx_client, "intensity", site_no, t))
+    now = datetime.now().astimezone(timezone.utc)
+    stages = (
+        ("level1", lambda **kw: raw_to_level1(site_no=site_no, **kw)),
+        ("level2", lambda **kw: level1_to_level2(mongo_client, site_no=site_no, **kw)),
+        ("level3", lambda **kw: level2_to_level3(mongo_client, site_no=site_no, **kw)),
+        ("level4", lambda **kw: level3_to_level4(site_no=site_no, **kw)),
+    )
+    # Anything after where the next incremental run starts each level is picked up by that run
+    ranges = clip_ranges(ranges, stage_back_times(get_watermarks(mdb, site_no), None))
+    for level, stage in stages:
+        for (range_start, range_end) in ranges[level]:
+            print("Site {} recomputing {} from {} to {}".format(site_no, level, range_start, range_end))
+            # stages process "time" > back_time, so start just before the range
+            stage(start_time=now, backprocess=now - (range_start - ONE_MICROSECOND), end_time=range_end,
+                  replace_range=True)
+    clear_dirty(mdb, [d['_id'] for d in docs])
+    return len(docs)
 
 
+@timed_stage("process_levels")
 def process_levels(site_no, options={}):
+    influx_client = get_influx_client()
     start_time = options.get('start_time', None)
     backprocess = options.get('backprocess', None)
     do_tests = options.get('do_tests', False)
     drop_old = options.get('drop_old', False)
-    mongo_client2 = MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
+    fused = options.get('fused', False)
+    incremental = options.get('incremental', False)
+    dirty_ranges = options.get('dirty_ranges', False)
+    mongo_client2 = get_mongo_client()
     p_start_time = datetime.now().astimezone(timezone.utc)
     if start_time is None:
         start_time = p_start_time
     print("Starting process_levels for site {}, at {}".format(site_no, p_start_time))
     if do_tests:
-        print("Doing site {} with sanity tests turned on. This takes longer.".format(site_no))
+        print("Doing site {} with sanity tests turned on.".format(site_no))
+    backprocesses = {level: backprocess for level in LEVELS}
+    if dirty_ranges:
+        recompute_dirty_ranges(mongo_client2, site_no)
+    if incremental:
+        mdb = getattr(mongo_client2, mongodb_config['DB_NAME'])
+        watermarks = get_watermarks(mdb, site_no)
+        latest_raw_time = probe_latest_time(influx_client, "raw_values", site_no)
+        if is_up_to_date(watermarks, latest_raw_time):
+            print("Site {} has no new raw data since {}, skipping.".format(site_no, latest_raw_time))
+            return
+        default_back_time = start_time - (TEN_YEARS if backprocess is None else backprocess)
+        for level, back_time in stage_back_times(watermarks, default_back_time).items():
+            backprocesses[level] = start_time - back_time
+        print("Site {} incremental from {}".format(site_no, ", ".join(
+            "{} {}".format(level, start_time - backprocesses[level]) for level in LEVELS)))
+
+    def stage_done(level):
+        if incremental:
+            set_watermark(mdb, site_no, level, latest_raw_time)
+
     #fix_raws(site_no=site_no)
-    raw_to_level1(site_no=site_no, start_time=start_time, backprocess=backprocess, drop_old=drop_old)
-    print("Finished raw->level1 for site {}, starting level1->level2.".format(site_no))
-    if do_tests:
-        assert test1(site_no=site_no, start_time=start_time)
-    level1_to_level2(mongo_client2, site_no=site_no, start_time=start_time, backprocess=backprocess, drop_old=drop_old)
-    print("Finished level1->level2 for site {}, starting level2->level3.".format(site_no))
-    if do_tests:
-        assert test2(site_no=site_no, start_time=start_time)
-    level2_to_level3(mongo_client2, site_no=site_no, start_time=start_time, backprocess=backprocess, drop_old=drop_old)
-    print("Finished level2->level3 for site {}, starting level3->level4.".format(site_no))
-    if do_tests:
-        assert test3(site_no=site_no, start_time=start_time)
-    level3_to_level4(site_no=site_no, start_time=start_time, backprocess=backprocess, drop_old=drop_old)
-    if do_tests:
-        assert test4(site_no=site_no, start_time=start_time)
+    if fused:
+        fused_backprocess = max(backprocesses.values()) if incremental else backprocess
+        fused_process_levels(mongo_client2, site_no=site_no, start_time=start_time,
+                             backprocess=fused_backprocess, drop_old=drop_old)
+        for level in LEVELS:
+            stage_done(level)
+        print("Finished fused raw->level4 for site {}.".format(site_no))
+        if do_tests:
+            for level in LEVELS:
+                assert verify_stage(site_no, level, start_time, fused_backprocess)
+    else:
+        raw_to_level1(site_no=site_no, start_time=start_time, backprocess=backprocesses["level1"], drop_old=drop_old)
+        stage_done("level1")
+        print("Finished raw->level1 for site {}, starting level1->level2.".format(site_no))
+        if do_tests:
+            assert verify_stage(site_no, "level1", start_time, backprocesses["level1"])
+        level1_to_level2(mongo_client2, site_no=site_no, start_time=start_time, backprocess=backprocesses["level2"], drop_old=drop_old)
+        stage_done("level2")
+        print("Finished level1->level2 for site {}, starting level2->level3.".format(site_no))
+        if do_tests:
+            assert verify_stage(site_no, "level2", start_time, backprocesses["level2"])
+        level2_to_level3(mongo_client2, site_no=site_no, start_time=start_time, backprocess=backprocesses["level3"], drop_old=drop_old)
+        stage_done("level3")
+        print("Finished level2->level3 for site {}, starting level3->level4.".format(site_no))
+        if do_tests:
+            assert verify_stage(site_no, "level3", start_time, backprocesses["level3"])
+        level3_to_level4(site_no=site_no, start_time=start_time, backprocess=backprocesses["level4"], drop_old=drop_old)
+        stage_done("level4")
+        if do_tests:
+            assert verify_stage(site_no, "level4", start_time, backprocesses["level4"])
     p_end_time = datetime.now().astimezone(timezone.utc)
     print("Finished process_levels for site {}, at {}".format(site_no, p_end_time))
     print("Site {} process_levels took {}".format(site_no, (p_end_time-p_start_time)))
 
 
+def drop_staged_levels(site_no):
+    """
+    Drop whatever an earlier, unfinished rebuild of a site left in the staging measurements.
+    """
+    influx_client = get_influx_client()
+    influx_client.query("".join('DROP SERIES FROM "{}" WHERE site_no=$s;'.format(level_measurement(level, True))
+                                for level in LEVELS), bind_params={"s": str(site_no)}, method='POST')
+    increment('queries', len(LEVELS))
+
+
+def site_series_times(influx_client, level, measurement, site_no):
+    """
+    :param level: the level the measurement holds, it or its staging copy
+    :return: each flag of the site's points to their sorted epoch-ns times. level4 points have no flag,
+        they are all under None.
+    :rtype: dict
+    """
+    flag_column = ', flag' if level in FLAG_TAGGED_LEVELS else ''
+    frame = read_frame(influx_client, 'SELECT "time"{}, "{}" FROM "{}" WHERE site_no=$s'.format(
+        flag_column, LEVEL_KEY_FIELDS[level], measurement), bind_params={"s": str(site_no)})
+    if len(frame) < 1:
+        return {}
+    if 'flag' not in frame:
+        return {None: np.unique(frame['time'])}
+    return {int(flag): np.unique(frame['time'][frame['flag'] == flag]) for flag in np.unique(frame['flag'])}
+
+
+def day_counts(series_times):
+    """
+    :param series_times: as from site_series_times
+    :return: (flag, start of the UTC day in epoch ns) to the number of points with that flag in that day
+    :rtype: dict
+    """
+    counts = {}
+    for flag, times in series_times.items():
+        days, day_points = np.unique(times // DAY_NS * DAY_NS, return_counts=True)
+        counts.update(((flag, day), n) for day, n in zip(days.tolist(), day_points.tolist()))
+    return counts
+
+
+def live_day_counts(influx_client, level, site_no, first, last):
+    """
+    Count a site's points in a level between two epoch ns times, for each flag and day, on the server.
+    :return: as from day_counts
+    :rtype: dict
+    """
+    group_flag = ', flag' if level in FLAG_TAGGED_LEVELS else ''
+    result = influx_client.query(
+        'SELECT COUNT("{}") FROM "{}" WHERE site_no=$s AND "time" >= {} AND "time" <= {} GROUP BY time(86400s){}'.format(
+            LEVEL_KEY_FIELDS[level], level, first, last, group_flag), bind_params={"s": str(site_no)}, epoch='ns')
+    increment('queries')
+    counts = {}
+    for (_, tags), points in result.items():
+        flag = int(tags['flag']) if tags and tags.get('flag', None) else None
+        for p in points:
+            if p['count']:
+                counts[(flag, int(p['time']))] = p['count']
+    return counts
+
+
+def _flag_order(flag):
+    return -1 if flag is None else flag
+
+
+def stale_day_statements(level, live_counts, staged_counts):
+    """
+    Once the staged points are copied in, a level has every staged point, so each flag and day in
+    which it has more points than its staging copy has stale ones too. For each of those days, the
+    statements delete the flag's points in the day and copy its staged points in again. A flag the
+    staging copy has no points with is deleted in one statement.
+    :param live_counts: the level's points, as from live_day_counts
+    :param staged_counts: its staging copy's points, as from day_counts
+    :return: DELETE and SELECT INTO statements, with the site number as the $s bind parameter
+    :rtype: list
+    """
+    staging = level_measurement(level, True)
+    staged_flags = {flag for (flag, _) in staged_counts}
+    statements = ["""DELETE FROM "{}" WHERE site_no=$s AND flag='{}'""".format(level, flag)
+                  for flag in sorted({flag for (flag, _) in live_counts} - staged_flags, key=_flag_order)]
+    for (flag, day), n in sorted(live_counts.items(), key=lambda fd_n: (_flag_order(fd_n[0][0]), fd_n[0][1])):
+        if flag not in staged_flags or n <= staged_counts.get((flag, day), 0):
+            continue
+        day_clause = """{} AND "time" >= {} AND "time" < {}""".format(
+            "" if flag is None else " AND flag='{}'".format(flag), day, day + DAY_NS)
+        statements.append('DELETE FROM "{}" WHERE site_no=$s{}'.format(level, day_clause))
+        statements.append('SELECT * INTO "{}" FROM "{}" WHERE site_no=$s{} GROUP BY *'.format(level, staging, day_clause))
+    return statements
+
+
+def read_staged_levels(site_no):
+    """
+    :return: level name to the site's points in its staging copy, as from site_series_times
+    :rtype: dict
+    """
+    influx_client = get_influx_client()
+    return {level: site_series_times(influx_client, level, level_measurement(level, True), site_no)
+            for level in LEVELS}
+
+
+def _all_times(series_times):
+    """
+    :param series_times: as from site_series_times
+    :return: the sorted times of every flag's points
+    """
+    if not series_times:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(list(series_times.values())))
+
+
+def staged_level_problems(staged):
+    """
+    Check a site's rebuilt levels against what the stages always write: level1 has points,
+    level2 has a point with the time and flag of each level1 point and no others, level3 has
+    a point at each level2 time and no others, and level4 only has points at level3 times,
+    as it leaves out the flagged ones.
+    :param staged: as from read_staged_levels
+    :return: a description of each check that fails, none if the rebuild is complete
+    :rtype: list
+    """
+    problems = []
+    level1 = _all_times(staged["level1"])
+    if len(level1) < 1:
+        problems.append("level1 has no points")
+    if set(staged["level1"]) != set(staged["level2"]) or \
+            any(not np.array_equal(times, staged["level2"][flag]) for flag, times in staged["level1"].items()):
+        problems.append("level2 points are not level1's")
+    level3 = _all_times(staged["level3"])
+    if not np.array_equal(_all_times(staged["level2"]), level3):
+        problems.append("level3 times are not level2's")
+    outside = np.setdiff1d(_all_times(staged["level4"]), level3)
+    if len(outside) > 0:
+        problems.append("level4 has {} points at times level3 does not have".format(len(outside)))
+    return problems
+
+
+def promote_staged_levels(site_no, staged=None):
+    """
+    Replace a site's levels with their staging copies. For each level, the staged points are
+    copied in on the server first, overwriting the old points at the same times and flags.
+    Then the old points outside the staged time span are deleted, and the days with old points
+    the copy does not have are found by counting points on the server, see stale_day_statements.
+    The staging copy is only dropped after that, so if a step fails it is still there to promote again.
+    :param staged: as from read_staged_levels, if it has been read already
+    """
+    influx_client = get_influx_client()
+    if staged is None:
+        staged = read_staged_levels(site_no)
+    bind_params = {"s": str(site_no)}
+    for level in LEVELS:
+        staging = level_measurement(level, True)
+        influx_client.query('SELECT * INTO "{}" FROM "{}" WHERE site_no=$s GROUP BY *'.format(level, staging),
+                            bind_params=bind_params, method='POST')
+        increment('queries')
+        if staged[level]:
+            first = min(int(times[0]) for times in staged[level].values())
+            last = max(int(times[-1]) for times in staged[level].values())
+            statements = ['DELETE FROM "{}" WHERE site_no=$s AND "time" < {}'.format(level, first),
+                          'DELETE FROM "{}" WHERE site_no=$s AND "time" > {}'.format(level, last)]
+            statements.extend(stale_day_statements(
+                level, live_day_counts(influx_client, level, site_no, first, last), day_counts(staged[level])))
+        else:
+            statements = ['DROP SERIES FROM "{}" WHERE site_no=$s'.format(level)]
+        for start in range(0, len(statements), PROMOTE_BATCH):
+            batch = statements[start:start + PROMOTE_BATCH]
+            influx_client.query(";".join(batch), bind_params=bind_params, method='POST')
+            increment('queries', len(batch))
+        influx_client.query('DROP SERIES FROM "{}" WHERE site_no=$s'.format(staging), bind_params=bind_params,
+                            method='POST')
+        increment('queries')
+
+
+def init_process_worker(all_params, run_metrics, trace_settings=None):
+    """
+    Pool initializer: the stations' parameters cache, the worker's own database clients,
+    where the run's metrics go, and its tracing.
+    """
+    init_worker(all_params)
+    init_worker_clients()
+    set_run(run_metrics)
+    set_tracing(trace_settings)
+
+
+def process_site_task(task, options):
+    """
+    Scheduler task: the whole of process_levels for one site.
+    """
+    return process_levels(task.site_no, options)
+
+
+def promote_site_task(task, options=None):
+    """
+    Scheduler task: promote a site's rebuilt levels, if they pass staged_level_problems.
+    An incomplete rebuild is left in staging, and the site keeps its old levels.
+    :return: True if the site's levels were promoted
+    :rtype: bool
+    """
+    staged = read_staged_levels(task.site_no)
+    summary = ", ".join("{} {}".format(level, sum(len(times) for times in staged[level].values())) for level in LEVELS)
+    problems = staged_level_problems(staged)
+    if problems:
+        print("Site {} rebuild is incomplete ({}: {}), keeping its old levels.".format(
+            task.site_no, summary, "; ".join(problems)))
+        return False
+    promote_staged_levels(task.site_no, staged)
+    print("Site {} rebuilt levels promoted ({}).".format(task.site_no, summary))
+    return True
+
+
+def process_chunk_task(task, options):
+    """
+    Scheduler task: levels 1-3 for one time chunk of a site, or every level in fused mode.
+    Each stage loads its own lead-in from before the chunk, so the chunks of a site can run in any order.
+    """
+    start_time = options['start_time']
+    backprocess = start_time - task.start
+    mongo_client2 = get_mongo_client()
+    print("Starting site {} from {} to {}".format(task.site_no, task.start, task.end or "now"))
+    staging = options.get('staging', False)
+    if options.get('fused', False):
+        fused_process_levels(mongo_client2, site_no=task.site_no, start_time=start_time, backprocess=backprocess,
+                             end_time=task.end, staging=staging)
+    else:
+        raw_to_level1(site_no=task.site_no, start_time=start_time, backprocess=backprocess, end_time=task.end,
+                      staging=staging)
+        level1_to_level2(mongo_client2, site_no=task.site_no, start_time=start_time, backprocess=backprocess,
+                         end_time=task.end, staging=staging)
+        level2_to_level3(mongo_client2, site_no=task.site_no, start_time=start_time, backprocess=backprocess,
+                         end_time=task.end, staging=staging)
+    if options.get('do_tests', False):
+        for level in (LEVELS if options.get('fused', False) else LEVELS[:3]):
+            assert verify_stage(task.site_no, level, start_time, backprocess, end_time=task.end, staging=staging)
+    print("Finished site {} from {} to {}".format(task.site_no, task.start, task.end or "now"))
+
+
+def process_chunk_level4_task(task, options):
+    """
+    Scheduler task: level3->level4 for one time chunk of a site.
+    The smoothing reaches into the neighbouring chunks' level3, so this runs once every chunk has its level3.
+    """
+    start_time = options['start_time']
+    level3_to_level4(site_no=task.site_no, start_time=start_time, backprocess=start_time - task.start,
+                     end_time=task.end, staging=options.get('staging', False))
+    if options.get('do_tests', False):
+        assert verify_stage(task.site_no, "level4", start_time, start_time - task.start, end_time=task.end,
+                            staging=options.get('staging', False))
+
+
+def read_fused_task(task, options):
+    """
+    Overlapped mode read step: load the fused inputs for a chunk task, or for the part of a
+    whole-site task after its watermarks in incremental mode.
+    :return: (inputs, latest_raw_time), or None if there is nothing to do
+    """
+    influx_client = get_influx_client()
+    start_time = options['start_time']
+    mongo_client2 = get_mongo_client()
+    with stage_metrics(task.site_no, "fused_read"):
+        latest_raw_time = None
+        if task.start is not None:
+            back_time = task.start
+        else:
+            backprocess = options.get('backprocess', None)
+            back_time = start_time - (TEN_YEARS if backprocess is None else backprocess)
+            if options.get('incremental', False):
+                mdb = getattr(mongo_client2, mongodb_config['DB_NAME'])
+                watermarks = get_watermarks(mdb, task.site_no)
+                latest_raw_time = probe_latest_time(influx_client, "raw_values", task.site_no)
+                if is_up_to_date(watermarks, latest_raw_time):
+                    print("Site {} has no new raw data since {}, skipping.".format(task.site_no, latest_raw_time))
+                    return None
+                back_time = min(stage_back_times(watermarks, back_time).values())
+        return load_fused_inputs(mongo_client2, task.site_no, back_time, end_time=task.end), latest_raw_time
+
+
+def compute_fused_task(task, read_result):
+    """
+    Overlapped mode compute step.
+    :return: (levels, latest_raw_time), or None if there is nothing to write
+    """
+    if read_result is None:
+        return None
+    inputs, latest_raw_time = read_result
+    with stage_metrics(task.site_no, "fused_compute"):
+        return fused_levels(**inputs), latest_raw_time
+
+
+def write_fused_task(task, compute_result, options=None):
+    """
+    Overlapped mode write step. Advances the site's watermarks in incremental mode.
+    """
+    if compute_result is None:
+        return
+    levels, latest_raw_time = compute_result
+    with stage_metrics(task.site_no, "fused_write"):
+        for measurement in LEVELS:
+            write_level_columns(measurement, task.site_no, levels[measurement],
+                                staging=options is not None and options.get('staging', False))
+    if options is not None and options.get('incremental', False) and latest_raw_time is not None:
+        mdb = getattr(get_mongo_client(), mongodb_config['DB_NAME'])
+        for level in LEVELS:
+            set_watermark(mdb, task.site_no, level, latest_raw_time)
+    print("Finished site {} from {} to {}".format(task.site_no, task.start or "watermark", task.end or "now"))
+
+
+def process_dirty_ranges_task(task, options):
+    """
+    Scheduler task: recompute_dirty_ranges for one site.
+    """
+    return recompute_dirty_ranges(get_mongo_client(), task.site_no)
+
+
+def promote_rebuilt_sites(site_nos, jobs, initargs, printout=print):
+    """
+    Promote every site's rebuilt levels, in parallel, and report the sites that were not promoted.
+    :param initargs: for init_process_worker
+    :return: the site numbers that kept their old levels
+    :rtype: list
+    """
+    results = run_largest_first(promote_site_task, [ChunkTask(site_no) for site_no in site_nos], processes=jobs,
+                                initializer=init_process_worker, initargs=initargs)
+    kept = sorted(task.site_no for (task, promoted) in results if not promoted)
+    if kept:
+        printout("Sites {} kept their old levels, their incomplete rebuilds are in the {} measurements.".format(
+            ", ".join(str(s) for s in kept), STAGING_SUFFIX))
+    return kept
+
+
+def plan_tasks(mongo_client, site_nos, start_time, backprocess, incremental=False, chunk_length=None,
+               max_concurrency=None):
+    """
+    Work out the scheduler tasks for a run, with their estimated sizes from COUNT probes.
+    Incremental runs get one task per site, sized by the raw data after its oldest watermark.
+    Otherwise each site's backprocess window is split into chunks of chunk_length.
+    :param max_concurrency: send up to this many probes at once through async_db, or None to send them one by one
+    :return: list of ChunkTask
+    :rtype: list
+    """
+    influx_client = get_influx_client()
+    if max_concurrency is not None:
+        return run_sync(plan_tasks_async(site_nos, start_time, backprocess, incremental=incremental,
+                                         chunk_length=chunk_length, max_concurrency=max_concurrency))
+    back_time = start_time - backprocess
+    tasks = []
+    if incremental:
+        mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
+        for site_no in site_nos:
+            watermarks = get_watermarks(mdb, site_no)
+            from_time = min(stage_back_times(watermarks, back_time).values())
+            tasks.append(ChunkTask(site_no, estimate=probe_point_count(influx_client, site_no, from_time)))
+        return tasks
+    if chunk_length is None:
+        chunk_length = timedelta(days=DEFAULT_CHUNK_DAYS)
+    for site_no in site_nos:
+        tasks.extend(plan_site_chunks(influx_client, site_no, back_time, start_time, chunk_length))
+    return tasks
+
+
+async def plan_tasks_async(site_nos, start_time, backprocess, incremental=False, chunk_length=None,
+                           max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    plan_tasks, with the probes for every site in flight at once.
+    :return: list of ChunkTask
+    :rtype: list
+    """
+    back_time = start_time - backprocess
+    async with AsyncInfluxClient(max_concurrency=max_concurrency) as async_influx_client:
+        if incremental:
+            async_mongo_client = make_async_mongo_client()
+            try:
+                docs = await find_docs(async_mongo_client, STATE_COLLECTION,
+                                       {'site_no': {'$in': [int(site_no) for site_no in site_nos]}})
+            finally:
+                async_mongo_client.close()
+            from_times = []
+            for site_no in site_nos:
+                watermarks = watermarks_from_docs(d for d in docs if d['site_no'] == int(site_no))
+                from_times.append(min(stage_back_times(watermarks, back_time).values()))
+            results = await query_many(async_influx_client, [
+                point_count_query(site_no, from_time) for site_no, from_time in zip(site_nos, from_times)])
+            return [ChunkTask(site_no, estimate=point_count_from_result(result))
+                    for site_no, result in zip(site_nos, results)]
+        if chunk_length is None:
+            chunk_length = timedelta(days=DEFAULT_CHUNK_DAYS)
+        bounds = chunk_bounds(back_time, start_time, chunk_length)
+        results = await query_many(async_influx_client, [chunk_count_query(site_no, bounds) for site_no in site_nos])
+    tasks = []
+    for site_no, result in zip(site_nos, results):
+        tasks.extend(chunk_tasks(site_no, bounds, chunk_counts_from_result(result, bounds)))
+    return tasks
+
+
 # if __name__ == "__main__":
 #     from threading import Thread
 #     #process_levels(site_no=2, do_tests=True)
@@ -683,9 +1004,36 @@ def main():
     parser.add_argument('-d', '--process-days', type=str, dest="processdays",
                         help='Number of days to backprocess. Default is 365 days.')
     parser.add_argument('-xx', '--dropold', dest="drop_old", action="store_true",
-                        help='Drop old contents of table before processing its contents. USE WITH CAUTION!')
+                        help='Rebuild each level into its "{}" staging copy, at full write speed, then replace the old '
+                             'contents of the table with it once the rebuild is complete. USE WITH CAUTION!'.format(STAGING_SUFFIX))
     parser.add_argument('-t', '--from-datetime', type=str, dest="fromdatetime",
                         help='The earliest datetime to backprocess to. In isoformat. Default is all of history.\nNote cannot use -d and -t together.')
+    parser.add_argument('-f', '--fused', dest="fused", action="store_true",
+                        help='Process raw->level4 in memory, writing each level without reading it back.')
+    parser.add_argument('-i', '--incremental', dest="incremental", action="store_true",
+                        help='Only process raw data newer than each level\'s stored watermark. Sites without a watermark use -d or -t.')
+    parser.add_argument('-r', '--dirty-ranges', dest="dirty_ranges", action="store_true",
+                        help='Also recompute the ranges affected by late-arriving raw, intensity and SILO data.')
+    parser.add_argument('-c', '--chunk-days', type=str, dest="chunkdays",
+                        help='Split each site\'s backprocess into chunks of this many days, run in parallel. Default is {} days.'.format(DEFAULT_CHUNK_DAYS))
+    parser.add_argument('-j', '--jobs', type=str, dest="jobs",
+                        help='Number of worker processes. Default is the number of CPUs.')
+    parser.add_argument('-q', '--max-queries', type=str, dest="maxqueries",
+                        help='Most database queries to have in flight at once while planning. Default is {}.'.format(DEFAULT_MAX_CONCURRENCY))
+    parser.add_argument('-p', '--pipelined', dest="pipelined", action="store_true",
+                        help='Use the fused processing, prefetching the next task\'s reads and writing in the background '
+                             'while each task is computed. Without this, each task reads, computes and writes in turn.')
+    parser.add_argument('-v', '--verify', dest="verify", action="store_true",
+                        help='After processing, compare each level, or its staging copy with -xx, with its "_temp" copy and fail '
+                             'if they disagree. Not used with -p.')
+    parser.add_argument('-sp', '--site-params', type=str, dest="siteparams",
+                        help='Read the stations\' calibration parameters from this snapshot file instead of MongoDB. '
+                             'If the file does not exist, it is written from MongoDB. Delete it to pick up changed parameters.')
+    parser.add_argument('-tr', '--trace', type=str, dest="trace",
+                        help='Append a span for every InfluxDB and MongoDB call to this JSONL file, and report the '
+                             'slowest query templates at the end. Default is $TRACE_FILE, or no tracing.')
+    parser.add_argument('-tn', '--trace-top', type=str, dest="tracetop",
+                        help='Number of query templates in the trace report. Default is {}.'.format(DEFAULT_TOP))
     parser.add_argument('-o', '--output', dest='output', nargs='?', type=argparse.FileType('w'),
                         help='Send output to a file (defaults to stdout).',
                         default=sys.stdout)
@@ -697,6 +1045,12 @@ def main():
         processdays = args.processdays
         fromdatetime = args.fromdatetime
         drop_old = args.drop_old
+        fused = args.fused
+        incremental = args.incremental
+        dirty_ranges = args.dirty_ranges
+        pipelined = args.pipelined
+        if incremental and drop_old:
+            raise RuntimeError("Cannot use -i and -xx at the same time. Pick one.")
         siteno = args.siteno
         if processdays is not None and fromdatetime is not None:
             raise RuntimeError("Cannot use -d and -t at the same time. Pick one.")
@@ -714,38 +1068,97 @@ def main():
                 backprocess = start_time - fromdatetime
         if backprocess.days < 0:
             raise RuntimeError("Cannot backprocess negative time. Ensure it is positive.")
-        mongo_client = MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
-        mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
-        all_sites = mdb.all_sites
-        all_stations_docs = mdb.all_stations
-        if siteno is not None:
-            sitenos = [int(s.strip()) for s in siteno.split(',') if s]
-            all_stations = all_stations_docs.find({'site_no': {"$in": sitenos}}, {'site_no': 1})
+        try:
+            chunk_length = timedelta(days=int(args.chunkdays or DEFAULT_CHUNK_DAYS))
+        except ValueError:
+            raise RuntimeError("-c must be an integer")
+        if chunk_length.days < 1:
+            raise RuntimeError("-c must be at least 1 day.")
+        try:
+            jobs = None if args.jobs is None else int(args.jobs)
+        except ValueError:
+            raise RuntimeError("-j must be an integer")
+        try:
+            max_queries = int(args.maxqueries or DEFAULT_MAX_CONCURRENCY)
+        except ValueError:
+            raise RuntimeError("-q must be an integer")
+        if max_queries < 1:
+            raise RuntimeError("-q must be at least 1.")
+        try:
+            trace_top = int(args.tracetop or DEFAULT_TOP)
+        except ValueError:
+            raise RuntimeError("-tn must be an integer")
+        run_metrics = start_run(start_time)
+        trace_settings = start_tracing(args.trace, run_metrics.run_id)
+        mongo_client = get_mongo_client()
+        sitenos = None if siteno is None else [int(s.strip()) for s in siteno.split(',') if s]
+        site_params_path = args.siteparams
+        if site_params_path is not None and os.path.exists(site_params_path):
+            all_params = load_snapshot(site_params_path)
+        elif site_params_path is not None:
+            all_params = load_all_site_params(mongo_client)
+            save_snapshot(site_params_path, all_params)
         else:
-            all_stations = all_stations_docs.find({}, {'site_no': 1})
-        mongo_client.close()
-        worker_options = {'start_time': start_time, 'do_tests': False, 'backprocess': backprocess, 'drop_old': drop_old}
-        all_stations = list(all_stations) #This turns a the mongo cursor into a python list
-        if len(all_stations) < 1:
+            all_params = load_all_site_params(mongo_client, sitenos)
+        if sitenos is not None:
+            all_params = {s: p for s, p in all_params.items() if s in sitenos}
+        if len(all_params) < 1:
+            close_clients()
             printout("No stations to process.")
             return
-        elif len(all_stations) < 2:
-            printout("Only doing station {}".format(siteno))
-            process_levels(all_stations[0]['site_no'], worker_options)
-            end_time = datetime.now().astimezone(timezone.utc)
-            printout("Finished process_levels for site {} at {}".format(siteno, end_time))
-            printout("process_levels took {}".format((end_time - start_time)))
+        # converted once here, and given to each worker process once when it starts
+        set_site_params(all_params)
+        site_nos = sorted(all_params)
+        tasks = plan_tasks(mongo_client, site_nos, start_time, backprocess,
+                           incremental=incremental, chunk_length=chunk_length, max_concurrency=max_queries)
+        # the workers make their own clients
+        close_clients()
+        # -xx rebuilds every level into its staging copy, and promotes it once the rebuild is complete
+        worker_options = {'start_time': start_time, 'do_tests': args.verify, 'backprocess': backprocess, 'drop_old': drop_old,
+                          'fused': fused, 'incremental': incremental, 'dirty_ranges': dirty_ranges, 'staging': drop_old}
+        if dirty_ranges and (pipelined or not incremental):
+            # before any watermark moves, see recompute_dirty_ranges. Incremental site tasks do this themselves.
+            run_largest_first(partial(process_dirty_ranges_task, options=worker_options),
+                              [ChunkTask(site_no) for site_no in site_nos], processes=jobs,
+                              initializer=init_process_worker, initargs=(all_params, run_metrics, trace_settings))
+        printout("Scheduling {} tasks for {} sites, largest first{}".format(
+            len(tasks), len(site_nos), ", pipelined" if pipelined else ""))
+        if pipelined:
+            if drop_old:
+                for site_no in site_nos:
+                    drop_staged_levels(site_no)
+            run_largest_first_overlapped(partial(read_fused_task, options=worker_options), compute_fused_task,
+                                         partial(write_fused_task, options=worker_options), tasks, processes=jobs,
+                                         initializer=init_process_worker, initargs=(all_params, run_metrics, trace_settings))
+            if drop_old:
+                promote_rebuilt_sites(site_nos, jobs, (all_params, run_metrics, trace_settings), printout)
+        elif incremental:
+            run_largest_first(partial(process_site_task, options=worker_options), tasks, processes=jobs,
+                              initializer=init_process_worker, initargs=(all_params, run_metrics, trace_settings))
         else:
-            printout("Using multiprocessing")
-            processes = []
-            pool = Pool(None)  # uses os.cpu_count
-            with pool as p:
-                worker_args = [(s['site_no'], worker_options) for s in all_stations]
-                p.starmap(process_levels, worker_args)
-            end_time = datetime.now().astimezone(timezone.utc)
-            printout("Finished process_levels for All Sites at {}".format(end_time))
-            printout("All sites process_levels took {}".format((end_time - start_time)))
+            if drop_old:
+                for site_no in site_nos:
+                    drop_staged_levels(site_no)
+            run_largest_first(partial(process_chunk_task, options=worker_options), tasks, processes=jobs,
+                              initializer=init_process_worker, initargs=(all_params, run_metrics, trace_settings))
+            if not fused:
+                run_largest_first(partial(process_chunk_level4_task, options=worker_options), tasks, processes=jobs,
+                                  initializer=init_process_worker, initargs=(all_params, run_metrics, trace_settings))
+            if drop_old:
+                promote_rebuilt_sites(site_nos, jobs, (all_params, run_metrics, trace_settings), printout)
+        record_run(start_time, sites=len(site_nos), tasks=len(tasks))
+        if trace_settings is not None:
+            report_path, report = write_report(trace_settings, top=trace_top)
+            for line in report:
+                printout(line)
+            printout("Trace report written to {}".format(report_path))
+        end_time = datetime.now().astimezone(timezone.utc)
+        printout("Finished process_levels for {} at {}".format(
+            "site {}".format(siteno) if len(site_nos) < 2 else "All Sites", end_time))
+        printout("process_levels took {}".format((end_time - start_time)))
     finally:
+        flush_metrics()
+        close_clients()
         outfile.close()
 
 if __name__ == "__main__":
@@ -17,27 +17,34 @@ limitations under the License.
 """
 import csv
 from datetime import time as d_time, datetime, timezone, timedelta
-from influxdb import InfluxDBClient
 try:
-    from .influx_cached_writer import AccumCacheInfluxWriter
+    from .clients import get_influx_client, get_mongo_client
 except ImportError:
-    from influx_cached_writer import AccumCacheInfluxWriter
+    from clients import get_influx_client, get_mongo_client
+try:
+    from .dirty_ranges import extend_range, mark_dirty_ranges
+except ImportError:
+    from dirty_ranges import extend_range, mark_dirty_ranges
+try:
+    from .influx_cached_writer import adaptive_writer
+except ImportError:
+    from influx_cached_writer import adaptive_writer
 try:
     from ._influx_db_config import config as influx_config
 except ImportError:
     from _influx_db_config import config as influx_config
 try:
-    from .utils import sql_to_isostring, datetime_to_isostring
+    from ._mongo_db_config import config as mongodb_config
 except ImportError:
-    from utils import sql_to_isostring, datetime_to_isostring
-
+    from _mongo_db_config import config as mongodb_config
+try:
+    from .utils import sql_to_isostring, datetime_to_isostring, isostring_to_datetime
+except ImportError:
+    from utils import sql_to_isostring, datetime_to_isostring, isostring_to_datetime
 
-influx_client = InfluxDBClient(
-    influx_config['DB_HOST'], int(influx_config['DB_PORT']),
-    influx_config['DB_USERNAME'], influx_config['DB_PASSWORD'],
-    influx_config['DB_NAME'], timeout=30)
 
 def look_intensities(at_site, startdate):
+    influx_client = get_influx_client()
     to_site = int(at_site)
     enddate = datetime.utcnow().replace(tzinfo=timezone.utc)
     startdate_iso = datetime_to_isostring(datetime.combine(startdate.date(), d_time(startdate.hour, 0, 0, 0, tzinfo=startdate.tzinfo)))
@@ -51,6 +58,7 @@ def look_intensities(at_site, startdate):
         print("{}:{}".format(i, intensity), flush=True)
 
 def copy_intensities(from_site, to_site, startdate, enddate=None):
+    influx_client = get_influx_client()
     from_site = int(from_site)
     to_site = int(to_site)
     if enddate is None:
@@ -63,7 +71,7 @@ def copy_intensities(from_site, to_site, startdate, enddate=None):
 
     intensities = intensity_req.get_points()
 
-    with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+    with adaptive_writer(influx_client, report=print) as writer:
         while True:
             try:
                 row = next(intensities)
@@ -93,10 +101,11 @@ def copy_intensities(from_site, to_site, startdate, enddate=None):
             del row
 
 def intensities():
+    influx_client = get_influx_client()
     with open("./intensity.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -131,10 +140,13 @@ def intensities():
 
 
 def silo_data():
+    influx_client = get_influx_client()
+    # SILO days already processed into level2 and level3 are recomputed by the next -r run
+    written_ranges = {}
     with open("./silo.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -173,13 +185,16 @@ def silo_data():
                         }
                     }
                 writer.write_point(json_body)
+                extend_range(written_ranges, site_num, isostring_to_datetime(iso_timestamp))
+    mark_dirty_ranges(getattr(get_mongo_client(), mongodb_config['DB_NAME']), written_ranges, "silo_data")
 
 
 def level1():
+    influx_client = get_influx_client()
     with open("./level1.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -220,10 +235,11 @@ def level1():
 
 
 def level2():
+    influx_client = get_influx_client()
     with open("./level2.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -255,10 +271,11 @@ def level2():
 
 
 def level3():
+    influx_client = get_influx_client()
     with open("./level3.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -288,11 +305,12 @@ def level3():
 
 
 def level4():
+    influx_client = get_influx_client()
     influx_client.drop_measurement("level4")
     with open("./level4.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -331,10 +349,11 @@ def level4():
 
 
 def raw_vals():
+    influx_client = get_influx_client()
     with open("./raw.csv", "r", encoding="utf-8") as f:
         r = csv.reader(f, delimiter="\t")
         headers = next(r)
-        with AccumCacheInfluxWriter(influx_client, cache_length=10) as writer:
+        with adaptive_writer(influx_client, report=print) as writer:
             while True:
                 try:
                     row = next(r)
@@ -374,7 +393,7 @@ def raw_vals():
                 writer.write_point(json_body)
 
 if __name__ == "__main__":
-    influx_client.create_database(influx_config['DB_NAME'])
+    get_influx_client().create_database(influx_config['DB_NAME'])
     now = datetime.utcnow().replace(tzinfo=timezone.utc)
     ago = now - timedelta(days=60)
     #look_intensities(22, ago)
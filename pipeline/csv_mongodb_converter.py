@@ -21,14 +21,12 @@ import time
 import datetime
 from urllib import request
 from bson import Decimal128
-from pymongo import MongoClient
+from .clients import get_mongo_client
 from ._mongo_db_config import config as mongodb_config
 from .utils import isostring_to_datetime, sql_to_isostring
 
-client = MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
-
 def all_stations():
-    db = getattr(client, mongodb_config['DB_NAME'])
+    db = getattr(get_mongo_client(), mongodb_config['DB_NAME'])
     all_stations_collection = db.all_stations
     with open("./all_stations.tsv", "r", encoding="latin1") as f:
         r = csv.reader(f, delimiter="\t")
@@ -102,7 +100,7 @@ def all_stations():
 
 # This doesn't work anymore, because http://cosmoz.csiro.au/sensor-information/?SiteNo was from the old site, no longer used
 def stations_calibration():
-    db = getattr(client, mongodb_config['DB_NAME'])
+    db = getattr(get_mongo_client(), mongodb_config['DB_NAME'])
     all_stations_collection = db.all_stations
     cal_txt_collection = db.stations_calibration_txt
     cal_collection = db.stations_calibration
@@ -195,7 +193,7 @@ def stations_calibration():
             cal_collection.insert_many(to_add)
 
 def station_calibration(site_no, csv_file):
-    db = getattr(client, mongodb_config['DB_NAME'])
+    db = getattr(get_mongo_client(), mongodb_config['DB_NAME'])
     all_stations_collection = db.all_stations
     cal_txt_collection = db.stations_calibration_txt
     cal_collection = db.stations_calibration
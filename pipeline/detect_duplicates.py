@@ -20,114 +20,159 @@ import sys
 from multiprocessing import Process, Pool, Queue
 import math
 from datetime import time as d_time, datetime, timedelta, timezone
-from influxdb import InfluxDBClient
-from pymongo import MongoClient
-from sortedcontainers import SortedList
+from functools import partial
+import numpy as np
 
+from .clients import close_clients, get_influx_client, get_mongo_client, init_worker_clients
+from .frames import Frame, stream_frames
 from .influx_cached_writer import AccumCacheInfluxWriter
-from .utils import datetime_to_isostring, isostring_to_datetime
-from ._influx_db_config import config as influx_config
+from .raw_checks import DUPLICATE_WINDOW_NS
+from .scheduler import DEFAULT_CHUNK_DAYS, plan_site_chunks, run_largest_first
+from .tracing import DEFAULT_TOP, set_tracing, start_tracing, write_report
+from .utils import datetime_to_epoch_ns, datetime_to_isostring, epoch_ns_to_datetime, epoch_ns_to_isostring, isostring_to_datetime
 from ._mongo_db_config import config as mongodb_config
 
-influx_client = InfluxDBClient(
-    influx_config['DB_HOST'], int(influx_config['DB_PORT']),
-    influx_config['DB_USERNAME'], influx_config['DB_PASSWORD'],
-    influx_config['DB_NAME'], timeout=30)
-
 THIRTY_YEARS = timedelta(days=365 * 30)
 TEN_YEARS = timedelta(days=365 * 10)
 ONE_YEAR = timedelta(days=365)
 
 
-def check_in_raw(site_no=0, start_time=None, processdays=None, outfile=None):
-    result = influx_client.query("""SELECT * FROM "raw_values" WHERE site_no=$s;""", bind_params={'s': str(site_no)})
-    points = result.get_points()
+def _same(a, b):
+    # missing fields are NaN, and two missing fields count as the same
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+
+def find_duplicates_in_raw(site_no=0, from_time=None, to_time=None):
+    """
+    Find raw records that may be duplicates of a record in the 29 minutes before them.
+    Only records in (from_time, to_time] are checked, but the 29 minutes before from_time
+    are loaded too, so the results don't depend on how a site's history is split up.
+    :return: list of (at_time, record, [(previous_time, previous_record), ...])
+    :rtype: list
+    """
+    influx_client = get_influx_client()
+    time_clauses = ""
+    if from_time is not None:
+        time_clauses += """ AND "time" >= '{}'""".format(datetime_to_isostring(from_time - timedelta(minutes=29.0)))
+    if to_time is not None:
+        time_clauses += """ AND "time" <= '{}'""".format(datetime_to_isostring(to_time))
     print("Loading all points in raw table...")
-    all_records = {}  # this really should be a pandas dataframe.. but doesn't matter..
-    count = 0
-    for p in points:
-        timestr = p.pop('time')
-        this_datetime = isostring_to_datetime(timestr)
-        if this_datetime in all_records:
-            raise Exception("Got unexpected temporal duplicate: site {} time {}".format(site_no, timestr))
-        count += 1
-
-        all_records[this_datetime] = p
-        if count % 100 == 0:
-            print("Reading {}...           \r".format(count), end="", flush=True)
+    frame = Frame.concat(list(stream_frames(
+        influx_client, """SELECT * FROM "raw_values" WHERE site_no=$s{}""".format(time_clauses),
+        bind_params={'s': str(site_no)})))
+    count = len(frame)
     print("Read {} records!".format(count))
-    all_times = SortedList(all_records.keys())
-    maybe_duplicates = {}
+    if count < 1:
+        return []
+    times = frame['time']
+    repeated = np.flatnonzero(times[1:] == times[:-1])
+    if len(repeated) > 0:
+        raise Exception("Got unexpected temporal duplicate: site {} time {}".format(
+            site_no, epoch_ns_to_isostring(times[repeated[0]])))
     print("Checking for duplicates.")
-    for i, (at_time, params) in enumerate(all_records.items()):
-        if i % 100 == 0:
-            percentage = (i/count) * 100
-            print("Completed {}% - {}       \r".format(percentage, at_time), end="", flush=True)
-        # check up to 30 mins before this time
-        backtime = at_time - timedelta(minutes=29.0)
-        possible_duplicates_times = list(all_times.irange(backtime, at_time, inclusive=(True,False)))
-        if len(possible_duplicates_times) < 1:
-            continue
-        (battery1, count1, tube_temperature1, rain1) = (params['battery'], params['count'], params['tube_temperature'], params['rain'])
-        pressure_ref = params['pressure1']
-        use_pressure = 'pressure1'
-        pressure2_ref = params['pressure2']
-        if (pressure2_ref is not None and pressure2_ref > 10) and (pressure_ref is None or pressure_ref < 10):
-            pressure_ref = params['pressure2']
-            use_pressure = 'pressure2'
-        maybe_duplicates[at_time] = list()
-        for p in possible_duplicates_times:
-            rec = all_records[p]
-            (battery2, count2, tube_temperature2, rain2) = (rec['battery'], rec['count'], rec['tube_temperature'], rec['rain'])
-            pressure_ref2 = rec[use_pressure]
-            matches = 0
-            for (param1, param2) in ((battery1,battery2),(count1,count2),(tube_temperature1,tube_temperature2),(rain1,rain2), (pressure_ref,pressure_ref2)):
-                if param1 == param2:
-                    matches += 1
-            if matches >= 5:
-                maybe_duplicates[at_time].append((p, rec))
-    if maybe_duplicates:
-        if outfile is None:
-            outfile = "./duplicates_2_s{}.txt".format(site_no)
-        with open(outfile, "w") as f:
-            f.write("Results of search for duplicates at station number {}\n".format(site_no))
-            for (di, dv) in maybe_duplicates.items():
-                dvlen = len(dv)
-                if dvlen < 1:
-                    continue
-                if dvlen >1:
-                    print("Got more than one!")
-                f.write("\nTime {} is potentially a duplicate of {} previous records:\n".format(di, dvlen))
-                rec = all_records[di]
-                f.write("\tThis record: {}\n".format(rec))
-                for i,(dvt,dvv) in enumerate(dv):
-                    before_time = "minutes"
-                    offset = (di-dvt).total_seconds()
-                    mins_before = (offset / 60.0)
-                    if mins_before < 1.0:
-                        mins_before = offset
-                        before_time = "seconds"
-                    f.write("\tRecord at {} {} before:\n\t{} - {}\n".format(mins_before, before_time, dvt.time(), dvv))
+    first_index = 0 if from_time is None else int(np.searchsorted(times, datetime_to_epoch_ns(from_time), side='right'))
+    # check up to 30 mins before each record
+    window_starts = np.searchsorted(times, times - DUPLICATE_WINDOW_NS, side='left')
+    pressure1 = frame['pressure1']
+    pressure2 = frame['pressure2']
+    use_pressure2 = (pressure2 > 10) & (np.isnan(pressure1) | (pressure1 < 10))
+    indexes = np.arange(count)
+    matches = []
+    max_back = int((indexes - window_starts).max())
+    for back in range(1, max_back + 1):
+        at = indexes[max(first_index, back):]
+        at = at[at - back >= window_starts[at]]
+        before = at - back
+        same = _same(frame['battery'][at], frame['battery'][before]) \
+            & _same(frame['count'][at], frame['count'][before]) \
+            & _same(frame['tube_temperature'][at], frame['tube_temperature'][before]) \
+            & _same(frame['rain'][at], frame['rain'][before]) \
+            & np.where(use_pressure2[at], _same(pressure2[at], pressure2[before]), _same(pressure1[at], pressure1[before]))
+        matches.extend(zip(at[same].tolist(), before[same].tolist()))
+    matched = {}
+    for at, before in sorted(matches):
+        matched.setdefault(at, []).append(before)
+    maybe_duplicates = []
+    for at, befores in matched.items():
+        params = frame.row(at)
+        del params['time']
+        previous = []
+        for before in befores:
+            rec = frame.row(before)
+            previous.append((epoch_ns_to_datetime(rec.pop('time')), rec))
+        maybe_duplicates.append((epoch_ns_to_datetime(int(times[at])), params, previous))
+    return maybe_duplicates
+
+
+def write_duplicates_report(site_no, maybe_duplicates, outfile=None):
+    """
+    :param maybe_duplicates: as from find_duplicates_in_raw, possibly from several chunks
+    """
+    if not maybe_duplicates:
+        return
+    if outfile is None:
+        outfile = "./duplicates_2_s{}.txt".format(site_no)
+    with open(outfile, "w") as f:
+        f.write("Results of search for duplicates at station number {}\n".format(site_no))
+        for (di, rec, dv) in sorted(maybe_duplicates, key=lambda d: d[0]):
+            dvlen = len(dv)
+            if dvlen >1:
+                print("Got more than one!")
+            f.write("\nTime {} is potentially a duplicate of {} previous records:\n".format(di, dvlen))
+            f.write("\tThis record: {}\n".format(rec))
+            for i,(dvt,dvv) in enumerate(dv):
+                before_time = "minutes"
+                offset = (di-dvt).total_seconds()
+                mins_before = (offset / 60.0)
+                if mins_before < 1.0:
+                    mins_before = offset
+                    before_time = "seconds"
+                f.write("\tRecord at {} {} before:\n\t{} - {}\n".format(mins_before, before_time, dvt.time(), dvv))
+
+
+def check_in_raw(site_no=0, start_time=None, processdays=None, outfile=None):
+    """
+    Find and report the possible duplicates in a site's raw data.
+    :param start_time: check up to this time, default is no limit
+    :param processdays: check this far back from start_time, default is all of history
+    :type processdays: timedelta
+    """
+    from_time = None
+    if processdays is not None:
+        from_time = (start_time or datetime.now().astimezone(timezone.utc)) - processdays
+    maybe_duplicates = find_duplicates_in_raw(site_no=site_no, from_time=from_time, to_time=start_time)
+    write_duplicates_report(site_no, maybe_duplicates, outfile=outfile)
     print("Finished checking duplicates in raw for station {}".format(site_no))
     return
 
-def impl_detect_duplicates(site_no, options=None):
-    if options is None:
-        options = {}
-    start_time = options.get('start_time', None)
-    processdays = options.get('processdays', None)
-    delete_them = options.get('delete_them', False)
-    mongo_client2 = MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
-    p_start_time = datetime.now().astimezone(timezone.utc)
-    if start_time is None:
-        start_time = p_start_time
-    print("Starting detect_duplicates for site {}, at {}".format(site_no, p_start_time))
-    #fix_raws(site_no=site_no)
-    check_in_raw(site_no=site_no, start_time=start_time, processdays=processdays)
-    p_end_time = datetime.now().astimezone(timezone.utc)
-    print("Finished process_levels for site {}, at {}".format(site_no, p_end_time))
-    print("Site {} process_levels took {}".format(site_no, (p_end_time-p_start_time)))
 
+def init_process_worker(trace_settings=None):
+    """
+    Pool initializer: the worker's own database clients, and the run's tracing.
+    """
+    init_worker_clients()
+    set_tracing(trace_settings)
+
+
+def detect_duplicates_chunk_task(task, options=None):
+    """
+    Scheduler task: find the possible duplicates in one time chunk of a site's raw data.
+    """
+    return find_duplicates_in_raw(site_no=task.site_no, from_time=task.start, to_time=task.end)
+
+
+def plan_site_tasks(site_no, chunk_length, back_time, until_time):
+    """
+    Chunk tasks covering a site's raw data after back_time.
+    """
+    influx_client = get_influx_client()
+    result = influx_client.query("""SELECT * FROM "raw_values" WHERE "time" > '{}' AND site_no=$s ORDER BY time ASC LIMIT 1;""".format(
+        datetime_to_isostring(back_time)), bind_params={'s': str(site_no)})
+    for p in result.get_points():
+        first_time = isostring_to_datetime(p['time'])
+        # chunks start exclusively, so start just before the first record
+        return plan_site_chunks(influx_client, site_no, first_time - timedelta(microseconds=1), until_time, chunk_length)
+    return []
 
 
 def main():
@@ -141,7 +186,16 @@ def main():
     parser.add_argument('-x', '--delete', dest="delete", action="store_true",
                         help='Delete them. Default is false.')
     parser.add_argument('-t', '--from-datetime', type=str, dest="fromdatetime",
-                        help='The earliest datetime to backprocess to. In isoformat. Default is all of history.\nNote cannot use -d and -t together.')
+                        help='The earliest datetime to backprocess to. In isoformat.\nNote cannot use -d and -t together.')
+    parser.add_argument('-c', '--chunk-days', type=str, dest="chunkdays",
+                        help='Split each site\'s history into chunks of this many days, checked in parallel. Default is {} days.'.format(DEFAULT_CHUNK_DAYS))
+    parser.add_argument('-j', '--jobs', type=str, dest="jobs",
+                        help='Number of worker processes. Default is the number of CPUs.')
+    parser.add_argument('-tr', '--trace', type=str, dest="trace",
+                        help='Append a span for every InfluxDB and MongoDB call to this JSONL file, and report the '
+                             'slowest query templates at the end. Default is $TRACE_FILE, or no tracing.')
+    parser.add_argument('-tn', '--trace-top', type=str, dest="tracetop",
+                        help='Number of query templates in the trace report. Default is {}.'.format(DEFAULT_TOP))
     parser.add_argument('-o', '--output', dest='output', nargs='?', type=argparse.FileType('w'),
                         help='Send output to a file (defaults to stdout).',
                         default=sys.stdout)
@@ -170,7 +224,22 @@ def main():
                 processdays = start_time - fromdatetime
         if processdays.days < 0:
             raise RuntimeError("Cannot process negative time. Ensure it is positive.")
-        mongo_client = MongoClient(mongodb_config['DB_HOST'], int(mongodb_config['DB_PORT']))  # 27017
+        try:
+            chunk_length = timedelta(days=int(args.chunkdays or DEFAULT_CHUNK_DAYS))
+        except ValueError:
+            raise RuntimeError("-c must be an integer")
+        if chunk_length.days < 1:
+            raise RuntimeError("-c must be at least 1 day.")
+        try:
+            jobs = None if args.jobs is None else int(args.jobs)
+        except ValueError:
+            raise RuntimeError("-j must be an integer")
+        try:
+            trace_top = int(args.tracetop or DEFAULT_TOP)
+        except ValueError:
+            raise RuntimeError("-tn must be an integer")
+        trace_settings = start_tracing(args.trace)
+        mongo_client = get_mongo_client()
         mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
         all_sites = mdb.all_sites
         all_stations_docs = mdb.all_stations
@@ -180,28 +249,37 @@ def main():
         else:
             all_stations = all_stations_docs.find({}, {'site_no': 1})
         all_stations = list(all_stations)  # This turns a the mongo cursor into a python list
-        mongo_client.close()
         worker_options = {'start_time': start_time, 'delete_them': delete_them, 'processdays': processdays}
         if len(all_stations) < 1:
             printout("No stations to check.")
             return
-        elif len(all_stations) < 2:
-            printout("Only doing station {}".format(siteno))
-            impl_detect_duplicates(all_stations[0]['site_no'], worker_options)
-            end_time = datetime.now().astimezone(timezone.utc)
-            printout("Finished detect_duplicates for site {} at {}".format(siteno, end_time))
-            printout("detect_duplicates took {}".format((end_time - start_time)))
-        else:
-            printout("Using multiprocessing")
-            processes = []
-            pool = Pool(None)  # uses os.cpu_count
-            with pool as p:
-                worker_args = [(s['site_no'], worker_options) for s in all_stations]
-                p.starmap(impl_detect_duplicates, worker_args)
-            end_time = datetime.now().astimezone(timezone.utc)
-            printout("Finished detect_duplicates for All Sites at {}".format(end_time))
-            printout("All sites detect_duplicates took {}".format((end_time - start_time)))
+        site_nos = [s['site_no'] for s in all_stations]
+        tasks = []
+        back_time = start_time - processdays
+        for site_no in site_nos:
+            tasks.extend(plan_site_tasks(site_no, chunk_length, back_time, start_time))
+        # the workers make their own clients
+        close_clients()
+        printout("Scheduling {} tasks for {} sites, largest first".format(len(tasks), len(site_nos)))
+        results = run_largest_first(partial(detect_duplicates_chunk_task, options=worker_options), tasks, processes=jobs,
+                                    initializer=init_process_worker, initargs=(trace_settings,))
+        site_duplicates = {site_no: [] for site_no in site_nos}
+        for (task, maybe_duplicates) in results:
+            site_duplicates[task.site_no].extend(maybe_duplicates)
+        for site_no in site_nos:
+            write_duplicates_report(site_no, site_duplicates[site_no])
+            printout("Finished checking duplicates in raw for station {}".format(site_no))
+        if trace_settings is not None:
+            report_path, report = write_report(trace_settings, top=trace_top)
+            for line in report:
+                printout(line)
+            printout("Trace report written to {}".format(report_path))
+        end_time = datetime.now().astimezone(timezone.utc)
+        printout("Finished detect_duplicates for {} at {}".format(
+            "site {}".format(siteno) if len(site_nos) < 2 else "All Sites", end_time))
+        printout("detect_duplicates took {}".format((end_time - start_time)))
     finally:
+        close_clients()
         outfile.close()
 
 if __name__ == "__main__":
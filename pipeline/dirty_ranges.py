@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+"""dirty_ranges.py
+Tracks time ranges of input data (raw_values, intensity, silo_data) that changed after
+they were processed, and works out the minimal downstream ranges of each level that
+need recomputing. Writers record changes in the pipeline_dirty collection in MongoDB
+with mark_dirty; process_levels consumes them.
+"""
+from datetime import datetime, timezone, timedelta, time as d_time
+
+try:
+    from .utils import as_utc, datetime_to_isostring, isostring_to_datetime
+except ImportError:
+    from utils import as_utc, datetime_to_isostring, isostring_to_datetime
+
+DIRTY_COLLECTION = "pipeline_dirty"
+SOURCES = ("raw_values", "intensity", "silo_data")
+
+# A raw record can make any record in the following 29 minutes a duplicate.
+RAW_FORWARD = timedelta(minutes=29)
+# A level3 point is part of the level4 smoothing window of points up to 3h1s either side of it.
+SMOOTHING_REACH = timedelta(hours=3, seconds=1)
+ONE_DAY = timedelta(days=1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def mark_dirty(mdb, site_no, source, start, end):
+    """
+    Record that a site's input data changed between start and end (inclusive).
+    :param mdb: the cosmoz mongo database
+    :param site_no:
+    :param source: one of SOURCES
+    :param start:
+    :type start: datetime
+    :param end:
+    :type end: datetime
+    """
+    if source not in SOURCES:
+        raise ValueError("Unknown dirty range source: {}".format(source))
+    getattr(mdb, DIRTY_COLLECTION).insert_one({
+        'site_no': int(site_no), 'source': source, 'start': start, 'end': end,
+        'created': datetime.now().astimezone(timezone.utc)})
+
+
+def extend_range(ranges, site_no, at_time):
+    """
+    Widen a site's (start, end) range in ranges to take in at_time, as data is written.
+    :param ranges: dict of site number to (start, end)
+    :type at_time: datetime
+    """
+    try:
+        start, end = ranges[site_no]
+    except KeyError:
+        ranges[site_no] = (at_time, at_time)
+        return
+    ranges[site_no] = (min(start, at_time), max(end, at_time))
+
+
+def mark_dirty_ranges(mdb, ranges, source):
+    """
+    mark_dirty every site's range, as collected with extend_range.
+    """
+    for site_no, (start, end) in ranges.items():
+        mark_dirty(mdb, site_no, source, start, end)
+
+
+def pending_dirty(mdb, site_no):
+    """
+    :param mdb: the cosmoz mongo database
+    :param site_no:
+    :return: the site's recorded dirty range documents
+    :rtype: list
+    """
+    docs = list(getattr(mdb, DIRTY_COLLECTION).find({'site_no': int(site_no)}))
+    for d in docs:
+        d['start'] = as_utc(d['start'])
+        d['end'] = as_utc(d['end'])
+    return docs
+
+
+def clear_dirty(mdb, doc_ids):
+    """
+    Remove dirty range documents once they have been recomputed.
+    :param mdb: the cosmoz mongo database
+    :param doc_ids: the _id of each document to remove
+    """
+    doc_ids = list(doc_ids)
+    if doc_ids:
+        getattr(mdb, DIRTY_COLLECTION).delete_many({'_id': {'$in': doc_ids}})
+
+
+def probe_next_time(influx_client, measurement, site_no, after_time):
+    """
+    :return: the time of the first record of a site in a measurement after after_time, or None
+    :rtype: datetime | NoneType
+    """
+    result = influx_client.query("""SELECT * FROM "{}" WHERE "time" > '{}' AND site_no=$s ORDER BY time ASC LIMIT 1""".format(
+        measurement, datetime_to_isostring(after_time)), bind_params={"s": str(site_no)})
+    for p in result.get_points():
+        return isostring_to_datetime(p['time'])
+    return None
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping or touching (start, end) ranges. An end of None is open-ended.
+    :param ranges: iterable of (start, end) datetime pairs
+    :return: sorted, non-overlapping list of (start, end) pairs
+    :rtype: list
+    """
+    merged = []
+    for start, end in sorted(ranges, key=lambda r: r[0]):
+        if merged:
+            last_start, last_end = merged[-1]
+            if last_end is None or start <= last_end:
+                if last_end is not None and (end is None or end > last_end):
+                    merged[-1] = (last_start, end)
+                continue
+        merged.append((start, end))
+    return merged
+
+
+def level_ranges(changes, next_raw_time=None, next_intensity_time=None):
+    """
+    Compute the ranges of each level affected by a set of input changes.
+    raw_values changes affect levels 1-3 from the change to 29 minutes after it (the duplicate window),
+    or to the next raw record if that is later (its count difference).
+    An intensity change affects levels 2-3 from the start of its hour up to the next hour that has its own
+    intensity record, because points in between fall back to the last intensity before them.
+    A SILO change affects levels 2-3 for the whole of each changed day.
+    level4 is affected 3h1s either side of every level3 range (the smoothing window).
+    :param changes: iterable of (source, start, end)
+    :param next_raw_time: callable returning the time of the first raw record after a given time, or None
+    :param next_intensity_time: callable returning the time of the first intensity record after a given time, or None
+    :return: dict of level name to merged (start, end) ranges, an end of None is open-ended
+    :rtype: dict
+    """
+    level1 = []
+    level2 = []
+    for (source, start, end) in changes:
+        if source == "raw_values":
+            affected_end = end + RAW_FORWARD
+            if next_raw_time is not None:
+                next_time = next_raw_time(end)
+                if next_time is not None and next_time > affected_end:
+                    affected_end = next_time
+            level1.append((start, affected_end))
+        elif source == "intensity":
+            hour_start = start.replace(minute=0, second=0, microsecond=0)
+            last_hour_end = end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            affected_end = None
+            if next_intensity_time is not None:
+                next_time = next_intensity_time(last_hour_end - ONE_MICROSECOND)
+                if next_time is not None:
+                    affected_end = next_time.replace(minute=0, second=0, microsecond=0) - ONE_MICROSECOND
+                    affected_end = max(affected_end, last_hour_end - ONE_MICROSECOND)
+            level2.append((hour_start, affected_end))
+        elif source == "silo_data":
+            day_start = datetime.combine(start.date(), d_time(0, 0, 0, 0, tzinfo=start.tzinfo))
+            last_day_end = datetime.combine(end.date(), d_time(0, 0, 0, 0, tzinfo=end.tzinfo)) + ONE_DAY - ONE_MICROSECOND
+            level2.append((day_start, last_day_end))
+        else:
+            raise ValueError("Unknown dirty range source: {}".format(source))
+    level1 = merge_ranges(level1)
+    level2 = merge_ranges(level1 + level2)
+    level4 = merge_ranges((start - SMOOTHING_REACH, None if end is None else end + SMOOTHING_REACH)
+                          for (start, end) in level2)
+    return {"level1": level1, "level2": level2, "level3": list(level2), "level4": level4}
+
+
+def clip_ranges(ranges, back_times):
+    """
+    The parts of each level's ranges to recompute before an incremental run: those up to where
+    that run resumes the level, the rest is left to it. A level without a watermark has no
+    incremental run to leave anything to, so all of its ranges are recomputed.
+    :param ranges: as from level_ranges
+    :param back_times: level name to where the next incremental run starts it, or None if the level
+        has no watermark, as from watermarks.stage_back_times
+    :return: dict of level name to (start, end) ranges, an end of None is open-ended
+    :rtype: dict
+    """
+    clipped = {}
+    for level, level_range in ranges.items():
+        back_time = back_times.get(level, None)
+        if back_time is None:
+            clipped[level] = list(level_range)
+            continue
+        clipped[level] = [(start, back_time if end is None or end > back_time else end)
+                          for (start, end) in level_range if start <= back_time]
+    return clipped
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+"""filters.py
+In-memory windowed filters for the level3->level4 smoothing.
+"""
+import numpy as np
+
+# Level4 smoothing takes the mean of up to the first 7 level3 samples within +/- 3 hours and 1 second.
+SMOOTHING_HALF_WIDTH_NS = (3 * 3600 + 1) * 1000000000
+SMOOTHING_MAX_SAMPLES = 7
+
+
+def window_bounds(times, half_width=SMOOTHING_HALF_WIDTH_NS, max_samples=SMOOTHING_MAX_SAMPLES):
+    """
+    For every sample, the index range of the samples that fall within its window.
+    The window is inclusive at both ends, and is cut off after the first max_samples samples
+    (by time), the same as "time" >= t-w AND "time" <= t+w LIMIT max_samples in InfluxQL.
+    :param times: sorted int64 epoch-ns times
+    :param half_width: half of the window width, in ns
+    :param max_samples: maximum number of samples per window
+    :return: (starts, ends) index arrays, ends are exclusive
+    :rtype: tuple
+    """
+    times = np.asarray(times, dtype=np.int64)
+    starts = np.searchsorted(times, times - half_width, side='left')
+    ends = np.searchsorted(times, times + half_width, side='right')
+    if max_samples is not None:
+        ends = np.minimum(ends, starts + max_samples)
+    return starts, ends
+
+
+def windowed_mean(values, starts, ends):
+    """
+    The mean of values[starts[i]:ends[i]] for every i.
+    Sums are accumulated in time order, so results match InfluxDB's MEAN() over the same samples.
+    Windows are short (see SMOOTHING_MAX_SAMPLES), so this is linear in the number of samples.
+    :param values: float64 sample values
+    :param starts: window start indexes
+    :param ends: exclusive window end indexes
+    :return: float64 array of means
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = ends - starts
+    sums = np.zeros(len(values), dtype=np.float64)
+    max_count = int(counts.max()) if len(counts) else 0
+    for k in range(max_count):
+        take = counts > k
+        sums[take] += values[starts[take] + k]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def smooth_level3(times, soil_moist, effective_depth):
+    """
+    Compute the level4 soil_moist_filtered and depth_filtered series.
+    :param times: sorted int64 epoch-ns times of the flag=0 level3 samples
+    :param soil_moist:
+    :param effective_depth:
+    :return: (soil_moist_filtered, depth_filtered) arrays
+    :rtype: tuple
+    """
+    starts, ends = window_bounds(times)
+    return windowed_mean(soil_moist, starts, ends), windowed_mean(effective_depth, starts, ends)
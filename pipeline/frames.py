@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+"""frames.py
+Columnar query results. InfluxDB returns each series as a list of column names and a list
+of row values; these are decoded straight into one typed NumPy array per column, without
+building a dict per row: int64 epoch-ns times (queries are run with epoch='ns'), small-int
+tags and float64 fields.
+"""
+import numpy as np
+
+from .metrics import increment
+from .streaming import DEFAULT_CHUNK_SIZE, stream_results
+
+# Tags and tag aliases that hold small integers. Every other column except time is a float64 field.
+INT_COLUMNS = {
+    'site_no': np.int32,
+    'flag': np.int8,
+    'raw_flag': np.int8,
+    'level1_flag': np.int8,
+    'level2_flag': np.int8,
+}
+
+
+class Frame(object):
+    """
+    A query result as a dict of equal-length column arrays.
+    Columns are read with frame[name], the same as fields of a point.
+    """
+    __slots__ = ('columns', 'length')
+
+    def __new__(cls, columns):
+        self = super(Frame, cls).__new__(cls)
+        self.columns = columns
+        self.length = len(next(iter(columns.values()))) if columns else 0
+        return self
+
+    def __getnewargs__(self):
+        return (self.columns,)
+
+    def __getstate__(self):
+        return None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __repr__(self):
+        return "Frame(columns={}, length={})".format(list(self.columns), self.length)
+
+    def items(self):
+        return self.columns.items()
+
+    def take(self, index):
+        """
+        :param index: a slice, boolean mask or index array
+        :return: a new Frame with the selected rows
+        :rtype: Frame
+        """
+        return Frame({k: v[index] for k, v in self.columns.items()})
+
+    def row(self, i):
+        """
+        :return: row i as a dict of plain python values, for reports and debugging
+        :rtype: dict
+        """
+        return {k: v[i].item() for k, v in self.columns.items()}
+
+    @classmethod
+    def concat(cls, frames):
+        """
+        :param frames: Frames with the same columns
+        :return: their rows, one after the other
+        :rtype: Frame
+        """
+        frames = [f for f in frames if len(f) > 0]
+        if len(frames) < 1:
+            return cls({})
+        if len(frames) == 1:
+            return frames[0]
+        return cls({k: np.concatenate([f.columns[k] for f in frames]) for k in frames[0].columns})
+
+
+def _column_array(name, values):
+    if name == 'time':
+        return np.array(values, dtype=np.int64)
+    dtype = INT_COLUMNS.get(name, None)
+    if dtype is not None:
+        # tags are strings, so go through int first
+        return np.array([int(v) for v in values], dtype=dtype)
+    # None (a missing field) becomes NaN
+    return np.array(values, dtype=np.float64)
+
+
+def frame_from_result(result):
+    """
+    :param result: one statement's result, as a raw dict or a ResultSet, from a query run with epoch='ns'
+    :return: the rows of all its series, in order
+    :rtype: Frame
+    """
+    raw = getattr(result, 'raw', result)
+    frames = []
+    for series in raw.get('series', []):
+        names = series['columns']
+        values = series.get('values', [])
+        if len(values) < 1:
+            continue
+        frames.append(Frame({n: _column_array(n, col) for n, col in zip(names, zip(*values))}))
+    return Frame.concat(frames)
+
+
+def stream_frames(influx_client, query, bind_params=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Run a SELECT query with a chunked response, and yield a Frame for each chunk as it arrives.
+    :return: generator of non-empty Frames
+    """
+    for result in stream_results(influx_client, query, bind_params=bind_params, chunk_size=chunk_size, epoch='ns'):
+        frame = frame_from_result(result)
+        if len(frame) > 0:
+            yield frame
+
+
+def read_frame(influx_client, query, bind_params=None):
+    """
+    Run a SELECT query and return the whole result as one Frame.
+    :rtype: Frame
+    """
+    frame = frame_from_result(influx_client.query(query, bind_params=bind_params, epoch='ns'))
+    increment('queries')
+    increment('rows_read', len(frame))
+    return frame
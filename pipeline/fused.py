@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+"""fused.py
+Fused raw->level4 processing on in-memory columns.
+Every level is computed from the previous level's arrays, without reading
+anything back from the database. fused_levels is a pure function of the raw
+columns, the site parameters and the intensity/SILO lookup tables, so it can be
+used from notebooks and tests as well as from process_levels.
+"""
+from .corrections import level2_corrections, silo_fallbacks
+from .filters import SMOOTHING_HALF_WIDTH_NS, smooth_level3
+from .metrics import increment
+from .raw_checks import DUPLICATE_WINDOW_NS, column_record_keys, duplicate_mask, level1_flags
+from .soil_moisture import level3_values
+
+# How far before the first output record the raw rows must start:
+# the level4 smoothing window, plus the duplicate window for the earliest smoothing context record.
+RAW_LEAD_IN_NS = SMOOTHING_HALF_WIDTH_NS + DUPLICATE_WINDOW_NS
+
+
+def _select(columns, mask):
+    return {k: v[mask] for k, v in columns.items()}
+
+
+def fused_levels(raw, site_params, intensity_index, silo_index, window_start_ns, emulate_old_version=False,
+                 window_end_ns=None):
+    """
+    Compute level1 to level4 from raw columns.
+    Raw rows should start RAW_LEAD_IN_NS before window_start_ns, so that duplicate checks,
+    count differences and the level4 smoothing have their context. Only records after
+    window_start_ns are returned.
+    :param raw: raw columns, as a dict of arrays or a raw_values Frame, sorted by time
+    :type raw: dict | frames.Frame
+    :param site_params: the station's calibration parameters
+    :type site_params: site_params.SiteParams
+    :param intensity_index:
+    :type intensity_index: lookups.IntensityIndex
+    :param silo_index:
+    :type silo_index: lookups.SiloIndex
+    :param window_start_ns: exclusive start of the output window, epoch-ns
+    :param emulate_old_version: store wv_corr and choose intensities the way the old system did
+    :param window_end_ns: inclusive end of the output window, epoch-ns, or None for no end.
+        Raw rows should continue SMOOTHING_HALF_WIDTH_NS past it, for the level4 smoothing.
+    :return: dict of level name to columns
+    :rtype: dict
+    """
+    times = raw['time']
+    duplicates = duplicate_mask(times, column_record_keys(raw))
+    flags, _ = level1_flags(raw['count'], raw['battery'], raw['raw_flag'])
+    keep = ~duplicates & (times >= window_start_ns - SMOOTHING_HALF_WIDTH_NS)
+    # the very first record doesn't have a previous count
+    keep[:1] = False
+    level1 = _select(raw, keep)
+    del level1['raw_flag']
+    level1['flag'] = flags[keep]
+
+    average_temperatures, average_humidities = silo_index.averages_many(level1['time'])
+    intensities = intensity_index.lookup_many(level1['time'], emulate_old_version=emulate_old_version)
+    corrections = level2_corrections(
+        level1['count'], level1['pressure1'], level1['pressure2'],
+        level1['external_temperature'], level1['external_humidity'],
+        average_temperatures, average_humidities, intensities,
+        site_params.beta, site_params.ref_pressure, site_params.ref_intensity, site_params.check_scaling(),
+        emulate_old_version=emulate_old_version)
+    increment('silo_fallbacks', silo_fallbacks(level1['external_temperature'], level1['external_humidity'],
+                                               average_humidities))
+    level2 = {
+        "time": level1['time'],
+        "flag": level1['flag'],
+        "count": level1['count'],
+        "rain": level1['rain'],
+    }
+    level2.update(corrections)
+
+    level3 = level3_values(level2['corr_count'], level2['wv_corr'], level2['flag'], level2['rain'],
+                           site_params, alternate_algorithm=site_params.alternate_algorithm)
+    level3['time'] = level2['time']
+
+    level4 = _select(level3, level3['flag'] == 0)
+    del level4['flag']
+    level4['soil_moist_filtered'], level4['depth_filtered'] = smooth_level3(
+        level4['time'], level4['soil_moist'], level4['effective_depth'])
+
+    levels = {"level1": level1, "level2": level2, "level3": level3, "level4": level4}
+    if window_end_ns is None:
+        return {name: _select(columns, columns['time'] > window_start_ns) for name, columns in levels.items()}
+    return {name: _select(columns, (columns['time'] > window_start_ns) & (columns['time'] <= window_end_ns))
+            for name, columns in levels.items()}
@@ -1,19 +1,90 @@
 # -*- coding: utf-8 -*-
 #
+"""influx_cached_writer.py
+Batches points for InfluxDB. A batch is flushed when it reaches its length in points, its size
+in bytes, or the age of its oldest point, whichever comes first. These are all checked as points
+are added, there is no timer: a batch that stops growing waits for the next write, or for the
+writer to exit. Before it is sent, a batch is
+sorted by series and time, so each series' points arrive together and in order, the way TSM
+ingests them best. With adaptive=True the batch length follows the observed write latency:
+it doubles while writes take well under target_ms, and halves when a write is slower than that.
+Points can be given as dicts, as for InfluxDBClient.write_points, or as columns with write_columns,
+which encodes them straight to line protocol.
+"""
 import time
 
 from influxdb.exceptions import InfluxDBServerError
+from influxdb.line_protocol import make_lines
+
+try:
+    from .line_protocol import encode_columns
+except ImportError:
+    from line_protocol import encode_columns
+try:
+    from .metrics import increment
+except ImportError:
+    from metrics import increment
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_AGE_MS = 1000
+DEFAULT_TARGET_MS = 250
+MIN_CACHE_LENGTH = 10
+MAX_CACHE_LENGTH = 10000
+
+
+def series_order(point):
+    """
+    Sort key for a point: its measurement, its tags, then its time.
+    """
+    tags = point.get('tags', None)
+    return (point.get('measurement', ''), tuple(sorted(tags.items())) if tags else (), point.get('time', 0))
+
+
+def estimate_point_bytes(point):
+    """
+    :return: the size of a point in line protocol
+    :rtype: int
+    """
+    return len(make_lines({"points": [point]}).encode('utf-8'))
 
 
 class AccumCacheInfluxWriter(object):
-    __slots__ = ('influx_client', 'accum_cache', 'current_len', 'cache_len')
+    """
+    :param influx_client:
+    :param cache_length: points per batch, the starting length when adaptive
+    :param max_bytes: flush a batch when it is about this large in line protocol, None for no limit
+    :param max_age_ms: flush a batch when a point is added to it this long after its first, None for no limit.
+        Only checked on write.
+    :param adaptive: tune cache_length from the write latency, between MIN_CACHE_LENGTH and MAX_CACHE_LENGTH
+    :param target_ms: the write latency adaptive tuning aims for
+    :param report: called with a summary line when the writer exits, if given
+    """
+    __slots__ = ('influx_client', 'accum_cache', 'accum_lines', 'lines_precision', 'lines_bytes', 'current_len',
+                 'cache_len', 'max_bytes', 'max_age_ms', 'adaptive', 'target_ms', 'report', 'point_bytes',
+                 'first_at', 'points_written', 'batches', 'write_seconds')
 
-    def __new__(cls, influx_client, cache_length=10):
+    def __new__(cls, influx_client, cache_length=10, max_bytes=None, max_age_ms=None, adaptive=False,
+                target_ms=DEFAULT_TARGET_MS, report=None):
         self = super(AccumCacheInfluxWriter, cls).__new__(cls)
         self.influx_client = influx_client
         self.accum_cache = []
+        # (series key, line) pairs from write_columns, and the time precision they are in
+        self.accum_lines = []
+        self.lines_precision = None
+        self.lines_bytes = 0
         self.current_len = 0
         self.cache_len = cache_length
+        self.max_bytes = max_bytes
+        self.max_age_ms = max_age_ms
+        self.adaptive = adaptive
+        self.target_ms = target_ms
+        self.report = report
+        # estimated from the first point, the points of one writer are all much alike
+        self.point_bytes = None
+        self.first_at = None
+        self.points_written = 0
+        self.batches = 0
+        self.write_seconds = 0.0
         return self
 
     def __enter__(self):
@@ -22,30 +93,147 @@ class AccumCacheInfluxWriter(object):
     def __exit__(self, *args, **kwargs):
         if self.current_len > 0:
             self._maybe_flush(force=True, delete_cache=True)
+        if self.report is not None and self.batches > 0:
+            self.report("Wrote {} points in {} batches, {:.0f} points/s.".format(
+                self.points_written, self.batches, self.points_per_second))
+
+    @property
+    def points_per_second(self):
+        """
+        The write rate achieved so far, over the time spent in writes.
+        """
+        if self.write_seconds <= 0.0:
+            return 0.0
+        return self.points_written / self.write_seconds
+
+    def _batch_full(self):
+        if self.current_len >= self.cache_len:
+            return True
+        if self.max_bytes is not None:
+            batch_bytes = self.lines_bytes
+            if self.accum_cache:
+                if self.point_bytes is None:
+                    self.point_bytes = estimate_point_bytes(self.accum_cache[0])
+                batch_bytes += len(self.accum_cache) * self.point_bytes
+            if batch_bytes >= self.max_bytes:
+                return True
+        if self.max_age_ms is not None:
+            return (time.perf_counter() - self.first_at) * 1000.0 >= self.max_age_ms
+        return False
+
+    def _tune(self, full, write_ms):
+        if write_ms > self.target_ms:
+            self.cache_len = max(MIN_CACHE_LENGTH, self.cache_len // 2)
+        elif full and write_ms < self.target_ms / 2:
+            # only a batch that filled up says anything about a longer one
+            self.cache_len = min(MAX_CACHE_LENGTH, self.cache_len * 2)
 
     def _maybe_flush(self, force=False, delete_cache=False):
-        if force or self.current_len >= self.cache_len:
-            try:
-                self.influx_client.write_points(self.accum_cache)
-            except InfluxDBServerError as er:
-                msg = er.args[0]
-                if b'"timeout"' in msg:
-                    time.sleep(5)
-                    self.influx_client.write_points(self.accum_cache)
-                else:
-                    raise
+        if self.current_len == 0:
+            return
+        full = self.current_len >= self.cache_len
+        if force or self._batch_full():
+            write_seconds = 0.0
+            if self.accum_cache:
+                try:
+                    self.accum_cache.sort(key=series_order)
+                except TypeError:
+                    pass  # times of mixed types, send them as they came
+                write_seconds += self._send(self.accum_cache)
+            if self.accum_lines:
+                # stable, so each series' lines stay in the order they were given, which is time order
+                self.accum_lines.sort(key=lambda series_line: series_line[0])
+                write_seconds += self._send([line for _, line in self.accum_lines],
+                                            time_precision=self.lines_precision, protocol='line')
+            if self.adaptive:
+                self._tune(full, write_seconds * 1000.0)
+            increment('write_batches')
+            increment('rows_written', self.current_len)
+            increment('write_seconds', write_seconds)
+            self.points_written += self.current_len
+            self.batches += 1
+            self.write_seconds += write_seconds
             if delete_cache:
                 del self.accum_cache
+                del self.accum_lines
             else:
                 self.accum_cache = []
+                self.accum_lines = []
+            self.lines_precision = None
+            self.lines_bytes = 0
             self.current_len = 0
 
+    def _send(self, points, **kwargs):
+        """
+        Write points, retrying once after a timeout.
+        :return: the seconds the successful write took
+        :rtype: float
+        """
+        started = time.perf_counter()
+        try:
+            self.influx_client.write_points(points, **kwargs)
+        except InfluxDBServerError as er:
+            msg = er.args[0]
+            if b'"timeout"' in msg:
+                increment('retries')
+                if self.adaptive:
+                    self.cache_len = max(MIN_CACHE_LENGTH, self.cache_len // 2)
+                time.sleep(5)
+                started = time.perf_counter()
+                self.influx_client.write_points(points, **kwargs)
+            else:
+                raise
+        return time.perf_counter() - started
+
     def write_point(self, point, *args, **kwargs):
+        if self.current_len == 0:
+            self.first_at = time.perf_counter()
         self.accum_cache.append(point)
         self.current_len += 1
         self._maybe_flush()
 
     def write_points(self, points, *args, **kwargs):
+        if self.current_len == 0:
+            self.first_at = time.perf_counter()
         self.accum_cache.extend(points)
         self.current_len += len(points)
         self._maybe_flush()
+
+    def write_columns(self, measurement, tags, fields, times, tag_columns=None):
+        """
+        Write points given as columns, encoded straight to line protocol.
+        The batch is flushed as the columns are added, so it never grows much past its limits.
+        :param measurement:
+        :param tags: tags every point has, dict
+        :param fields: dict of field key to a column of values, an array or a sequence
+        :param times: epoch ns of each point
+        :param tag_columns: dict of tag key to a column of tag values, for tags that vary between points
+        """
+        if len(times) == 0:
+            return
+        precision, lines = encode_columns(measurement, tags, fields, times, tag_columns=tag_columns)
+        if self.accum_lines and precision != self.lines_precision:
+            # one write has one time precision
+            self._maybe_flush(force=True)
+        start = 0
+        while start < len(lines):
+            if self.current_len == 0:
+                self.first_at = time.perf_counter()
+            stop = start + max(self.cache_len - self.current_len, 1)
+            added = lines[start:stop]
+            self.accum_lines.extend(added)
+            self.lines_precision = precision
+            self.lines_bytes += sum(len(line) + 1 for _, line in added)
+            self.current_len += len(added)
+            start = stop
+            self._maybe_flush()
+
+
+def adaptive_writer(influx_client, cache_length=MIN_CACHE_LENGTH, report=None):
+    """
+    A writer for bulk loads: its batches grow while InfluxDB keeps up, up to DEFAULT_MAX_BYTES,
+    and a batch is sent on the first write after it is DEFAULT_MAX_AGE_MS old.
+    :rtype: AccumCacheInfluxWriter
+    """
+    return AccumCacheInfluxWriter(influx_client, cache_length=cache_length, max_bytes=DEFAULT_MAX_BYTES,
+                                  max_age_ms=DEFAULT_MAX_AGE_MS, adaptive=True, report=report)
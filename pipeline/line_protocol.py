@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+"""line_protocol.py
+Encodes columns straight to InfluxDB line protocol, without building a dict per point for
+InfluxDBClient.write_points to convert again. A field is formatted a column at a time, and each
+distinct combination of tag values is encoded once. The lines are the same as influxdb's
+make_lines gives for the equivalent points: tags and fields in key order, None fields left out.
+NaN fields are left out too, as InfluxDB has no NaN, and a point left with no fields is not written.
+Timestamps are given in epoch ns, and are sent in seconds when they are all whole seconds.
+"""
+import numpy as np
+
+from influxdb.line_protocol import quote_ident
+
+try:
+    from .utils import NS_PER_SECOND
+except ImportError:
+    from utils import NS_PER_SECOND
+
+
+def escape_name(name):
+    """
+    Escape a measurement, tag key, tag value or field key.
+    """
+    name = str(name)
+    if not any(c in name for c in '\\ ,=\n'):
+        return name
+    return name.replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=").replace("\n", "\\n")
+
+
+def field_value(value):
+    """
+    :return: a field value in line protocol, or None to leave the field out, for None or NaN
+    """
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        return quote_ident(value)
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, int):
+        return str(value) + 'i'
+    value = float(value)
+    if value != value:
+        return None
+    return repr(value)
+
+
+def format_field(name, values):
+    """
+    Format a column of field values.
+    :return: (list of "key=value" strings, with None for a value left out, whether there are any None)
+    :rtype: tuple
+    """
+    key = escape_name(name) + "="
+    if isinstance(values, np.ndarray):
+        kind = values.dtype.kind
+        if kind == 'f':
+            nan = np.isnan(values)
+            if nan.any():
+                return [None if n else key + repr(v) for v, n in zip(values.tolist(), nan.tolist())], True
+            return [key + repr(v) for v in values.tolist()], False
+        if kind in 'iu':
+            return [key + str(v) + 'i' for v in values.tolist()], False
+        if kind == 'b':
+            return [key + str(v) for v in values.tolist()], False
+        values = values.tolist()
+    if all(type(v) is float and v == v for v in values):
+        return [key + repr(v) for v in values], False
+    formatted = [field_value(v) for v in values]
+    return [None if v is None else key + v for v in formatted], None in formatted
+
+
+def series_key(measurement, tags):
+    """
+    :return: measurement and tags in line protocol, the part of a line that names its series
+    """
+    parts = [escape_name(measurement)]
+    for k in sorted(tags):
+        v = escape_name(tags[k])
+        if v:
+            if v.endswith('\\'):
+                v += ' '
+            parts.append("{}={}".format(escape_name(k), v))
+    return ",".join(parts)
+
+
+def encode_times(times):
+    """
+    :param times: epoch ns
+    :return: (precision, list of timestamps in that precision)
+    :rtype: tuple
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) and not (times % NS_PER_SECOND).any():
+        return 's', (times // NS_PER_SECOND).tolist()
+    return 'n', times.tolist()
+
+
+def encode_columns(measurement, tags, fields, times, tag_columns=None):
+    """
+    Encode points given as columns.
+    :param measurement:
+    :param tags: tags every point has, dict
+    :param fields: dict of field key to a column of values, an array or a sequence
+    :param times: epoch ns of each point
+    :param tag_columns: dict of tag key to a column of tag values, for tags that vary between points
+    :return: (precision, list of (series key, line)), lines in the given order, leaving out points with no fields
+    :rtype: tuple
+    """
+    precision, timestamps = encode_times(times)
+    n = len(timestamps)
+    columns = []
+    sparse = False
+    for name in sorted(fields):
+        formatted, has_none = format_field(name, fields[name])
+        columns.append(formatted)
+        sparse = sparse or has_none
+    rows = zip(*columns) if columns else [()] * n
+    if sparse:
+        field_parts = [",".join(v for v in row if v is not None) for row in rows]
+    else:
+        field_parts = [",".join(row) for row in rows]
+    if tag_columns:
+        tag_keys = sorted(tag_columns)
+        series_of = {}
+        series = []
+        for values in zip(*(tag_columns[k].tolist() if isinstance(tag_columns[k], np.ndarray) else tag_columns[k]
+                            for k in tag_keys)):
+            key = series_of.get(values, None)
+            if key is None:
+                point_tags = dict(tags)
+                point_tags.update(zip(tag_keys, values))
+                key = series_of[values] = series_key(measurement, point_tags)
+            series.append(key)
+    else:
+        series = [series_key(measurement, tags)] * n
+    return precision, [(s, "{} {} {}".format(s, f, t)) for s, f, t in zip(series, field_parts, timestamps) if f]
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+"""lookups.py
+In-memory, time-indexed lookup tables for the ancillary series that the
+processing levels consult once per point (NMDB intensity, SILO climate data).
+Each table is loaded with a handful of queries per site, then searched in-process.
+"""
+from datetime import timedelta
+
+import numpy as np
+
+from .frames import Frame, read_frame
+from .metrics import increment
+from .utils import DAY_NS, HOUR_NS, datetime_to_epoch_ns, datetime_to_isostring, epoch_ns_to_isostring
+
+# The last instant of an hour that has always been treated as part of it, xx:59:59.999999
+HOUR_END_NS = HOUR_NS - 1000
+
+
+def hour_bounds(at_ns):
+    """
+    The first and last instant of the UTC hour containing at_ns, matching
+    the bounds the processing levels have always used for an hour match.
+    :param at_ns: epoch-ns time, or an int64 array of them
+    :return: (hour_start, hour_end)
+    :rtype: tuple
+    """
+    hour_start = at_ns - at_ns % HOUR_NS
+    return hour_start, hour_start + HOUR_END_NS
+
+
+def _or_none(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+class IntensityIndex(object):
+    """
+    Sorted copy of a site's "intensity" series, with int64 epoch-ns times.
+    Answers the hour-match and nearest-previous/nearest-next questions
+    that level1_to_level2 used to send to InfluxDB for every point.
+    """
+    __slots__ = ('times', 'values', 'earliest')
+
+    def __new__(cls, times, values, earliest=None):
+        """
+        :param times: epoch-ns times
+        :param values: the intensity at each time
+        :param earliest: the first ever (epoch-ns time, intensity) pair for the site, if known
+        """
+        self = super(IntensityIndex, cls).__new__(cls)
+        times = np.asarray(times, dtype=np.int64)
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.values = np.asarray(values, dtype=np.float64)[order]
+        self.earliest = earliest
+        return self
+
+    def __len__(self):
+        return len(self.times)
+
+    def lookup_many(self, at_ns, emulate_old_version=False):
+        """
+        The intensity to use for each point, with the searches done as array operations.
+        The record in the same hour if there is one, otherwise the last record before the point
+        (the first ever record, when emulating the old version), otherwise the first record after.
+        The points answered from the records before or after them, rather than from their hour,
+        are counted as fallbacks in the stage metrics.
+        :param at_ns: sorted or unsorted int64 epoch-ns times
+        :param emulate_old_version:
+        :return: float64 array of intensities, NaN where the site has no intensity records
+        """
+        at_ns = np.asarray(at_ns, dtype=np.int64)
+        result = np.full(len(at_ns), np.nan, dtype=np.float64)
+        n = len(self.times)
+        if n < 1:
+            return result
+
+        def fill(indexes, valid):
+            # only fill points that are still missing, from an index that exists
+            take = np.isnan(result) & valid
+            result[take] = self.values[indexes[take]]
+            return int(np.count_nonzero(take))
+
+        hour_start, hour_end = hour_bounds(at_ns)
+        i = np.searchsorted(self.times, hour_start, side='left')
+        in_range = i < n
+        i = np.minimum(i, n - 1)
+        fill(i, in_range & (self.times[i] <= hour_end))
+        if emulate_old_version:
+            if self.earliest is not None and self.earliest[1] is not None:
+                take = np.isnan(result) & (at_ns >= self.earliest[0])
+                result[take] = self.earliest[1]
+                increment('intensity_before_fallbacks', int(np.count_nonzero(take)))
+        else:
+            i = np.searchsorted(self.times, at_ns, side='right') - 1
+            increment('intensity_before_fallbacks', fill(np.maximum(i, 0), i >= 0))
+        i = np.searchsorted(self.times, at_ns, side='left')
+        increment('intensity_after_fallbacks', fill(np.minimum(i, n - 1), i < n))
+        return result
+
+    @classmethod
+    def load(cls, influx_client, site_no, from_time, with_earliest=False, to_time=None):
+        """
+        Load every intensity record from the start of the hour containing from_time onwards,
+        plus the last record before that, so every lookup for a point after from_time
+        can be answered from memory.
+        :param influx_client:
+        :param site_no:
+        :param from_time:
+        :type from_time: datetime
+        :param with_earliest: also load the first ever record, for the old FIRST() fallback
+        :param to_time: only answer lookups up to this time, loading up to the end of its hour
+            and the first record after that, or None to load everything after from_time
+        :type to_time: datetime | NoneType
+        :return: the loaded index
+        :rtype: IntensityIndex
+        """
+        window_start = epoch_ns_to_isostring(hour_bounds(datetime_to_epoch_ns(from_time))[0])
+        bind_params = {"s": str(site_no)}
+        if to_time is None:
+            window_end = None
+            end_clause = ""
+        else:
+            window_end = epoch_ns_to_isostring(hour_bounds(datetime_to_epoch_ns(to_time))[1])
+            end_clause = """ AND "time" <= '{}'""".format(window_end)
+        frames = [read_frame(influx_client, """\
+SELECT "time", "intensity" FROM "intensity"
+WHERE "time" >= '{}'{} AND site_no=$s""".format(window_start, end_clause), bind_params=bind_params)]
+        if window_end is not None:
+            frames.append(read_frame(influx_client, """\
+SELECT "time", "intensity" FROM "intensity"
+WHERE "time" > '{}' AND site_no=$s ORDER BY time ASC LIMIT 1""".format(window_end), bind_params=bind_params))
+        frames.append(read_frame(influx_client, """\
+SELECT "time", "intensity" FROM "intensity"
+WHERE "time" < '{}' AND site_no=$s ORDER BY time DESC LIMIT 1""".format(window_start), bind_params=bind_params))
+        records = Frame.concat(frames)
+        earliest = None
+        if with_earliest:
+            first = read_frame(influx_client, """\
+SELECT "time", "intensity" FROM "intensity"
+WHERE site_no=$s ORDER BY time ASC LIMIT 1""", bind_params=bind_params)
+            if len(first) > 0:
+                earliest = (int(first['time'][0]), _or_none(first['intensity'][0]))
+        if len(records) < 1:
+            return cls([], [], earliest)
+        return cls(records['time'], records['intensity'], earliest)
+
+
+class SiloIndex(object):
+    """
+    Per-day SILO average temperature and humidity for a site.
+    Replaces the SELECT LAST(*) FROM "silo_data" query that the water vapour
+    correction used to send for every point with missing external readings.
+    Days are numbered from the epoch, so a time's day is at_ns // DAY_NS.
+    """
+    __slots__ = ('days', 'temperatures', 'humidities')
+
+    # A SILO day has always been matched from midnight to 11:59:59.999999 on that date
+    DAY_END_NS = 12 * HOUR_NS - 1000
+
+    def __new__(cls, times, average_temperatures, average_humidities):
+        """
+        :param times: epoch-ns times of the SILO records
+        :param average_temperatures:
+        :param average_humidities:
+        """
+        self = super(SiloIndex, cls).__new__(cls)
+        times = np.asarray(times, dtype=np.int64)
+        average_temperatures = np.asarray(average_temperatures, dtype=np.float64)
+        average_humidities = np.asarray(average_humidities, dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        last_temps = {}
+        last_humids = {}
+        for at_ns, average_temperature, average_humidity in zip(
+                times[order].tolist(), average_temperatures[order].tolist(), average_humidities[order].tolist()):
+            if at_ns % DAY_NS > cls.DAY_END_NS:
+                continue
+            day = at_ns // DAY_NS
+            # LAST(*) picks the last non-null value of each field independently
+            if average_temperature == average_temperature:
+                last_temps[day] = average_temperature
+            if average_humidity == average_humidity:
+                last_humids[day] = average_humidity
+        days = sorted(day for day in last_temps if day in last_humids)
+        self.days = np.array(days, dtype=np.int64)
+        self.temperatures = np.array([last_temps[day] for day in days], dtype=np.float64)
+        self.humidities = np.array([last_humids[day] for day in days], dtype=np.float64)
+        return self
+
+    def __len__(self):
+        return len(self.days)
+
+    def averages_many(self, at_ns):
+        """
+        The SILO average temperature and average humidity for the day of each time.
+        :param at_ns: int64 epoch-ns times
+        :return: (average_temperatures, average_humidities) float64 arrays, NaN for days without SILO data
+        :rtype: tuple
+        """
+        day = np.asarray(at_ns, dtype=np.int64) // DAY_NS
+        temperatures = np.full(len(day), np.nan, dtype=np.float64)
+        humidities = np.full(len(day), np.nan, dtype=np.float64)
+        if len(self.days) < 1:
+            return temperatures, humidities
+        i = np.minimum(np.searchsorted(self.days, day, side='left'), len(self.days) - 1)
+        found = self.days[i] == day
+        temperatures[found] = self.temperatures[i[found]]
+        humidities[found] = self.humidities[i[found]]
+        return temperatures, humidities
+
+    @classmethod
+    def load(cls, influx_client, site_no, from_time, to_time=None):
+        """
+        Load the SILO records for every day from the day containing from_time onwards.
+        :param influx_client:
+        :param site_no:
+        :param from_time:
+        :type from_time: datetime
+        :param to_time: only load up to the end of the day containing to_time, or None for no limit
+        :type to_time: datetime | NoneType
+        :return: the loaded index
+        :rtype: SiloIndex
+        """
+        window_start = datetime_to_isostring(from_time.date())
+        if to_time is None:
+            end_clause = ""
+        else:
+            end_clause = """ AND "time" < '{}'""".format(datetime_to_isostring(to_time.date() + timedelta(days=1)))
+        records = read_frame(influx_client, """\
+SELECT "time", average_temperature, average_humidity FROM "silo_data"
+WHERE "time" >= '{}'{} AND site_no=$s""".format(window_start, end_clause), bind_params={"s": str(site_no)})
+        if len(records) < 1:
+            return cls([], [], [])
+        return cls(records['time'], records['average_temperature'], records['average_humidity'])
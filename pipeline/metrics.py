@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+"""metrics.py
+Structured metrics for a processing run. Each stage of each site is timed, and counts
+what it did: rows read and written, queries, write batches, write retries, the time spent
+in writes, and how often the SILO and intensity fallbacks were taken. When a stage finishes,
+its record is appended, as line protocol, to a text file in the metrics directory that
+upload_metrics.sh ships, and queued as a point for the _pipeline_metrics measurement. Queued
+points are written in batches, and the rest with flush_metrics, which a process runs when it exits.
+Nothing is recorded until a run is started with start_run (or set_run in a worker), so the
+stages can still be used on their own without writing any metrics.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+import inspect
+from multiprocessing.util import Finalize
+import os
+import threading
+import time
+
+from influxdb.line_protocol import make_lines
+
+try:
+    from .clients import get_influx_client
+except ImportError:
+    from clients import get_influx_client
+try:
+    from .utils import datetime_to_epoch_ns, do_load_dotenv
+except ImportError:
+    from utils import datetime_to_epoch_ns, do_load_dotenv
+
+do_load_dotenv()
+
+MEASUREMENT = "_pipeline_metrics"
+# The same default as upload_metrics.sh
+DEFAULT_METRICS_DIRECTORY = "/usr/local/lib/cosmoz-rest-wrapper/metrics"
+COUNTERS = ('rows_read', 'rows_written', 'queries', 'write_batches', 'retries', 'silo_fallbacks',
+            'intensity_before_fallbacks', 'intensity_after_fallbacks', 'write_seconds')
+# Counters of seconds rather than of things, always written as floats so the field type never changes
+FLOAT_COUNTERS = ('write_seconds',)
+# Queued points are written once there are this many
+METRICS_BATCH = 500
+
+
+class RunMetrics(object):
+    """
+    Where a run's metrics go. Picklable, so it can be given to pool workers.
+    :param run_id: tags every record of the run
+    :param directory: the metrics directory, or None to write no text file
+    :param to_influx: write records to the _pipeline_metrics measurement
+    """
+    __slots__ = ('run_id', 'directory', 'to_influx')
+
+    def __new__(cls, run_id, directory=None, to_influx=True):
+        self = super(RunMetrics, cls).__new__(cls)
+        self.run_id = run_id
+        self.directory = directory
+        self.to_influx = to_influx
+        return self
+
+    def __getnewargs__(self):
+        return self.run_id, self.directory, self.to_influx
+
+    def __getstate__(self):
+        return None
+
+    @property
+    def path(self):
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, "pipeline_metrics_{}.txt".format(self.run_id))
+
+
+class StageMetrics(object):
+    """
+    The record of one stage of one site. site_no is None for records about the whole run.
+    """
+    __slots__ = ('site_no', 'stage', 'start_ns', 'seconds', 'failed', 'counters')
+
+    def __new__(cls, site_no, stage):
+        self = super(StageMetrics, cls).__new__(cls)
+        self.site_no = site_no
+        self.stage = stage
+        self.start_ns = datetime_to_epoch_ns(datetime.now(timezone.utc))
+        self.seconds = 0.0
+        self.failed = False
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.counters.update(dict.fromkeys(FLOAT_COUNTERS, 0.0))
+        return self
+
+    def as_point(self, run_id):
+        tags = {"run": run_id, "stage": self.stage}
+        if self.site_no is not None:
+            tags["site_no"] = str(self.site_no)
+        fields = {"seconds": float(self.seconds), "failed": self.failed}
+        fields.update(self.counters)
+        return {"measurement": MEASUREMENT, "tags": tags, "time": self.start_ns, "fields": fields}
+
+
+# The run of this process, set by start_run or set_run
+_run = None
+# Each thread has its own stack of open stages, so the overlapped reader and writer threads count separately
+_local = threading.local()
+# Points waiting to be written, and the process they belong to
+_pending = []
+_pending_pid = None
+_pending_lock = threading.Lock()
+_finalizer_pid = None
+
+
+def start_run(start_time, directory=None, to_influx=True):
+    """
+    Start recording metrics in this process.
+    :param start_time: the run's start time, which identifies it
+    :type start_time: datetime
+    :param directory: the metrics directory, by default $METRICS_DIRECTORY as upload_metrics.sh uses it.
+        No text file is written if it does not exist.
+    :return: the run's settings, for set_run in worker processes
+    :rtype: RunMetrics
+    """
+    if directory is None:
+        directory = os.getenv("METRICS_DIRECTORY", DEFAULT_METRICS_DIRECTORY)
+    if not os.path.isdir(directory):
+        print("Metrics directory {} does not exist, not writing metrics files.".format(directory))
+        directory = None
+    run_metrics = RunMetrics(start_time.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ"), directory, to_influx)
+    set_run(run_metrics)
+    return run_metrics
+
+
+def set_run(run_metrics):
+    """
+    Record metrics for run_metrics in this process, or stop recording with None.
+    """
+    global _run, _finalizer_pid
+    _run = run_metrics
+    if run_metrics is not None and run_metrics.to_influx and _finalizer_pid != os.getpid():
+        _finalizer_pid = os.getpid()
+        # ahead of clients.close_clients, which init_worker_clients registers with exitpriority=10
+        Finalize(None, flush_metrics, exitpriority=20)
+
+
+def increment(name, n=1):
+    """
+    Add n to a counter of every stage open in this thread. Does nothing outside a stage.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        for m in stack:
+            m.counters[name] += n
+
+
+@contextmanager
+def stage_metrics(site_no, stage):
+    """
+    Time the enclosed block as a stage of site_no, and record it when it ends.
+    Stages can be nested, increments go to every open stage.
+    :return: the StageMetrics, or None if no run is being recorded
+    """
+    if _run is None:
+        yield None
+        return
+    m = StageMetrics(site_no, stage)
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(m)
+    started = time.perf_counter()
+    try:
+        yield m
+    except BaseException:
+        m.failed = True
+        raise
+    finally:
+        m.seconds = time.perf_counter() - started
+        stack.remove(m)
+        record(m)
+
+
+def timed_stage(stage):
+    """
+    Decorator for a stage function with a site_no parameter, to record it with stage_metrics.
+    """
+    def decorate(fn):
+        signature = inspect.signature(fn)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _run is None:
+                return fn(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            with stage_metrics(bound.arguments['site_no'], stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_run(start_time, **fields):
+    """
+    Record the run as a whole: its wall time since start_time, and fields such as the number of sites.
+    The per-site counts are in the stage records.
+    :type start_time: datetime
+    """
+    if _run is None:
+        return
+    m = StageMetrics(None, "run")
+    m.start_ns = datetime_to_epoch_ns(start_time)
+    m.seconds = (datetime.now(timezone.utc) - start_time).total_seconds()
+    record(m, **fields)
+
+
+def _process_pending():
+    global _pending, _pending_pid
+    pid = os.getpid()
+    if _pending_pid != pid:
+        # inherited through fork: the parent writes its own
+        _pending = []
+        _pending_pid = pid
+    return _pending
+
+
+def flush_metrics():
+    """
+    Write the points queued in this process to the measurement.
+    Failures are reported and otherwise ignored, like those of record.
+    """
+    with _pending_lock:
+        pending = _process_pending()
+        points = list(pending)
+        del pending[:]
+    if not points:
+        return
+    try:
+        get_influx_client().write_points(points)
+    except Exception as e:
+        print("Could not write {} metrics records: {!r}".format(len(points), e))
+
+
+def record(m, **fields):
+    """
+    Queue a stage's record for the measurement, and write it to the metrics file of the current run.
+    Failures are reported and otherwise ignored, so they never stop the processing.
+    :param m:
+    :type m: StageMetrics
+    :param fields: extra fields for the point
+    """
+    run = _run
+    if run is None:
+        return
+    point = m.as_point(run.run_id)
+    point["fields"].update(fields)
+    if run.to_influx:
+        with _pending_lock:
+            pending = _process_pending()
+            pending.append(point)
+            full = len(pending) >= METRICS_BATCH
+        if full:
+            flush_metrics()
+    path = run.path
+    if path is not None:
+        try:
+            # one write per record, so records from several worker processes don't interleave
+            with open(path, "a") as f:
+                f.write(make_lines({"points": [point]}))
+        except OSError as e:
+            print("Could not write metrics to {}: {!r}".format(path, e))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+"""overlapped.py
+Overlapped read/compute/write execution of a stream of tasks.
+A reader thread prefetches the inputs of the next tasks while the calling
+thread computes the current one, and a writer thread drains finished results
+to the database in the background. Both hand-offs go through bounded queues,
+so at most prefetch + write_backlog tasks are held in memory at once.
+The threads mostly wait on database round-trips, during which the GIL is released.
+The writer thread has an InfluxDB client of its own, so it never shares a connection with the reader.
+"""
+from queue import Queue
+from threading import Event, Thread
+
+try:
+    from .clients import close_thread_influx_client, open_thread_influx_client
+except ImportError:
+    from clients import close_thread_influx_client, open_thread_influx_client
+
+DEFAULT_PREFETCH = 2
+DEFAULT_WRITE_BACKLOG = 2
+
+_DONE = object()
+
+
+def run_overlapped(tasks, read_fn, compute_fn, write_fn, prefetch=DEFAULT_PREFETCH, write_backlog=DEFAULT_WRITE_BACKLOG):
+    """
+    For each task, run read_fn(task), then compute_fn(task, inputs), then write_fn(task, outputs),
+    overlapping the reads and writes of neighbouring tasks with the computation.
+    Tasks are written in the order they are read.
+    The first exception raised by any of the three functions stops the run and is re-raised here.
+    :param tasks: iterable of tasks, consumed lazily by the reader thread
+    :param read_fn: callable(task) -> inputs
+    :param compute_fn: callable(task, inputs) -> outputs
+    :param write_fn: callable(task, outputs)
+    :param prefetch: how many tasks' inputs can be read ahead of the computation
+    :param write_backlog: how many tasks' outputs can be waiting to be written
+    :return: the number of tasks written
+    :rtype: int
+    """
+    if prefetch < 1 or write_backlog < 1:
+        raise ValueError("prefetch and write_backlog must be at least 1.")
+    read_queue = Queue(maxsize=prefetch)
+    write_queue = Queue(maxsize=write_backlog)
+    stop = Event()
+    errors = []
+    written = [0]
+
+    def _reader():
+        try:
+            for task in tasks:
+                if stop.is_set():
+                    break
+                read_queue.put((task, read_fn(task)))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            read_queue.put(_DONE)
+
+    def _writer():
+        # the reader queries through the process's client at the same time
+        open_thread_influx_client()
+        try:
+            while True:
+                item = write_queue.get()
+                if item is _DONE:
+                    return
+                if stop.is_set():
+                    continue
+                try:
+                    write_fn(*item)
+                    written[0] += 1
+                except BaseException as e:
+                    errors.append(e)
+                    stop.set()
+        finally:
+            close_thread_influx_client()
+
+    reader = Thread(target=_reader, name="overlapped-reader", daemon=True)
+    writer = Thread(target=_writer, name="overlapped-writer", daemon=True)
+    reader.start()
+    writer.start()
+    item = None
+    try:
+        while True:
+            item = read_queue.get()
+            if item is _DONE:
+                break
+            if stop.is_set():
+                continue
+            task, inputs = item
+            write_queue.put((task, compute_fn(task, inputs)))
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+        # unblock the reader, then wait for its end marker
+        while item is not _DONE:
+            item = read_queue.get()
+    finally:
+        write_queue.put(_DONE)
+        writer.join()
+        reader.join()
+    if errors:
+        raise errors[0]
+    return written[0]
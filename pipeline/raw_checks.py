@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+"""raw_checks.py
+In-memory checks on raw_values rows for the raw->level1 stage.
+"""
+import numpy as np
+
+# A raw record is a duplicate if an identical record was received up to 29 minutes before it.
+DUPLICATE_WINDOW_NS = 29 * 60 * 1000000000
+
+# Every raw_values column compared when deciding whether two records are duplicates.
+RAW_COMPARE_FIELDS = ("count", "pressure1", "internal_temperature", "internal_humidity", "battery",
+                      "tube_temperature", "tube_humidity", "rain", "vwc1", "vwc2", "vwc3", "pressure2",
+                      "external_temperature", "external_humidity", "raw_flag")
+
+
+def column_record_keys(columns):
+    """
+    The hashable tuple of compared fields for every row of raw columns.
+    Missing fields are NaN in the columns, they become None again so that they compare equal.
+    :param columns: raw columns, a Frame or dict of arrays
+    :return: list of tuples
+    :rtype: list
+    """
+    key_columns = []
+    for f in RAW_COMPARE_FIELDS:
+        values = np.asarray(columns[f])
+        column = values.tolist()
+        if values.dtype.kind == 'f':
+            for i in np.flatnonzero(np.isnan(values)).tolist():
+                column[i] = None
+        key_columns.append(column)
+    return list(zip(*key_columns))
+
+
+def duplicate_mask(times, keys, window_ns=DUPLICATE_WINDOW_NS):
+    """
+    Find records that exactly repeat a record received less than window_ns before them.
+    Keeps a sliding window of preceding record keys in a multiset, so the whole
+    series is checked in a single pass.
+    :param times: sorted int epoch-ns times
+    :param keys: hashable key (see column_record_keys) for each record
+    :param window_ns: how far back to look for an identical record
+    :return: boolean array, True where the record is a duplicate
+    """
+    n = len(times)
+    mask = np.zeros(n, dtype=bool)
+    in_window = {}
+    lo = 0
+    hi = 0
+    for i in range(n):
+        at_time = times[i]
+        back_time = at_time - window_ns
+        # window is [at_time - window_ns, at_time)
+        while hi < n and times[hi] < at_time:
+            k = keys[hi]
+            in_window[k] = in_window.get(k, 0) + 1
+            hi += 1
+        while lo < hi and times[lo] < back_time:
+            k = keys[lo]
+            remaining = in_window[k] - 1
+            if remaining:
+                in_window[k] = remaining
+            else:
+                del in_window[k]
+            lo += 1
+        if keys[i] in in_window:
+            mask[i] = True
+    return mask
+
+
+def level1_flags(count, battery, raw_flag):
+    """
+    Level1 flags for a series of raw records, in time order.
+    Flag 4 for a low battery, flag 1 for a count more than 20% away from the previous
+    record's count, otherwise the raw flag. The first record has no previous count,
+    so its flag is only meaningful for the battery check.
+    :param count:
+    :param battery:
+    :param raw_flag:
+    :return: (flags, prev_count) arrays, prev_count is NaN for the first record
+    :rtype: tuple
+    """
+    count = np.asarray(count, dtype=np.float64)
+    battery = np.asarray(battery, dtype=np.float64)
+    raw_flag = np.asarray(raw_flag, dtype=np.int64)
+    prev_count = np.empty_like(count)
+    prev_count[:1] = np.nan
+    prev_count[1:] = count[:-1]
+    if np.any(prev_count[1:] < 0):
+        raise ValueError("Incorrect previous_count calculation.")
+    jumped = (count < (0.8 * prev_count)) | (count > (1.2 * prev_count))
+    flags = np.select([battery < 10, jumped], [4, 1], raw_flag)
+    return flags, prev_count
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+"""scheduler.py
+Splits a run over many sites into (site, time-chunk) tasks and runs them on a
+process pool, largest first. Idle workers take the next task from the shared
+queue, so a run takes roughly the total work divided by the number of cores,
+rather than as long as the site with the longest history.
+"""
+from datetime import timedelta
+from functools import partial
+from multiprocessing import Pool, Process, Queue
+import os
+
+from .overlapped import DEFAULT_PREFETCH, DEFAULT_WRITE_BACKLOG, run_overlapped
+from .utils import NS_PER_SECOND, datetime_to_epoch_ns, datetime_to_isostring, isostring_to_epoch_ns
+
+DEFAULT_CHUNK_DAYS = 30
+
+
+class ChunkTask(object):
+    """
+    One unit of work: a site, and the time range (start, end] to process.
+    A start or end of None means unbounded on that side.
+    """
+    __slots__ = ('site_no', 'start', 'end', 'estimate')
+
+    def __new__(cls, site_no, start=None, end=None, estimate=0):
+        self = super(ChunkTask, cls).__new__(cls)
+        self.site_no = site_no
+        self.start = start
+        self.end = end
+        self.estimate = estimate
+        return self
+
+    def __getnewargs__(self):
+        return self.site_no, self.start, self.end, self.estimate
+
+    def __getstate__(self):
+        return None
+
+    def __repr__(self):
+        return "ChunkTask(site_no={}, start={}, end={}, estimate={})".format(
+            self.site_no, self.start, self.end, self.estimate)
+
+
+def chunk_bounds(back_time, until_time, chunk_length):
+    """
+    Split (back_time, until_time] into consecutive chunks of chunk_length.
+    The last chunk is left open-ended, so it also picks up records arriving after until_time.
+    :param back_time:
+    :type back_time: datetime
+    :param until_time:
+    :type until_time: datetime
+    :param chunk_length:
+    :type chunk_length: timedelta
+    :return: list of (start, end) pairs
+    :rtype: list
+    """
+    if chunk_length <= timedelta(0):
+        raise ValueError("Chunk length must be positive.")
+    bounds = []
+    start = back_time
+    while start + chunk_length < until_time:
+        bounds.append((start, start + chunk_length))
+        start = start + chunk_length
+    bounds.append((start, None))
+    return bounds
+
+
+def point_count_query(site_no, from_time=None, measurement="raw_values"):
+    """
+    :return: (query, bind_params) counting a site's records after from_time
+    :rtype: tuple
+    """
+    if from_time is None:
+        time_clause = ""
+    else:
+        time_clause = """"time" > '{}' AND """.format(datetime_to_isostring(from_time))
+    return ("""SELECT COUNT("count") FROM "{}" WHERE {}site_no=$s""".format(measurement, time_clause),
+            {"s": str(site_no)})
+
+
+def point_count_from_result(result):
+    for p in result.get_points():
+        return int(p.get('count', None) or 0)
+    return 0
+
+
+def probe_point_count(influx_client, site_no, from_time=None, measurement="raw_values"):
+    """
+    Cheap estimate of how many records a site has after from_time.
+    :return: the number of records
+    :rtype: int
+    """
+    query, bind_params = point_count_query(site_no, from_time, measurement)
+    return point_count_from_result(influx_client.query(query, bind_params=bind_params))
+
+
+def _chunk_seconds(bounds):
+    if len(bounds) < 2:
+        return None
+    chunk_s = int((bounds[0][1] - bounds[0][0]).total_seconds())
+    return chunk_s if chunk_s > 0 else None
+
+
+def chunk_count_query(site_no, bounds, measurement="raw_values"):
+    """
+    :param bounds: as from chunk_bounds
+    :return: (query, bind_params) counting a site's records in each chunk, grouped by chunk
+    :rtype: tuple
+    """
+    back_time = bounds[0][0]
+    chunk_s = _chunk_seconds(bounds)
+    if chunk_s is None:
+        return point_count_query(site_no, back_time, measurement)
+    offset_s = (datetime_to_epoch_ns(back_time) // NS_PER_SECOND) % chunk_s
+    return ("""\
+SELECT COUNT("count") FROM "{}"
+WHERE "time" > '{}' AND site_no=$s GROUP BY time({}s, {}s)""".format(
+        measurement, datetime_to_isostring(back_time), chunk_s, offset_s), {"s": str(site_no)})
+
+
+def chunk_counts_from_result(result, bounds):
+    """
+    :param result: the result of a chunk_count_query
+    :param bounds: the bounds given to chunk_count_query
+    :return: list of counts, one per chunk
+    :rtype: list
+    """
+    chunk_s = _chunk_seconds(bounds)
+    if chunk_s is None:
+        return [point_count_from_result(result)]
+    back_ns = datetime_to_epoch_ns(bounds[0][0])
+    chunk_ns = chunk_s * NS_PER_SECOND
+    counts = [0] * len(bounds)
+    for p in result.get_points():
+        n = p.get('count', None)
+        if not n:
+            continue
+        bucket_ns = isostring_to_epoch_ns(p['time'])
+        # buckets start on whole seconds, so they can be up to 1s before their chunk
+        index = (bucket_ns - back_ns + chunk_ns // 2) // chunk_ns
+        index = min(max(index, 0), len(bounds) - 1)
+        counts[index] += int(n)
+    return counts
+
+
+def chunk_tasks(site_no, bounds, counts):
+    """
+    :return: a ChunkTask for each chunk that has records
+    :rtype: list
+    """
+    return [ChunkTask(site_no, start, end, estimate=n)
+            for (start, end), n in zip(bounds, counts) if n > 0]
+
+
+def plan_site_chunks(influx_client, site_no, back_time, until_time, chunk_length):
+    """
+    The chunk tasks for one site, leaving out chunks that have no raw records.
+    The records in each chunk are counted with one COUNT query grouped by chunk.
+    :rtype: list
+    """
+    bounds = chunk_bounds(back_time, until_time, chunk_length)
+    query, bind_params = chunk_count_query(site_no, bounds)
+    return chunk_tasks(site_no, bounds, chunk_counts_from_result(influx_client.query(query, bind_params=bind_params), bounds))
+
+
+def run_largest_first(fn, tasks, processes=None, initializer=None, initargs=()):
+    """
+    Run fn(task) for every task, biggest estimate first, on a pool of worker processes.
+    Tasks are handed out one at a time, so a worker that finishes early takes the next task
+    rather than waiting on a fixed share of the work.
+    :param fn: a picklable callable taking one task
+    :param tasks: iterable of ChunkTask
+    :param processes: number of workers, None for os.cpu_count
+    :param initializer: called with initargs once in each worker when it starts, for state shared by every task
+    :return: list of (task, result) pairs, in completion order
+    :rtype: list
+    """
+    tasks = sorted(tasks, key=lambda t: t.estimate, reverse=True)
+    if len(tasks) < 2 or processes == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [(t, fn(t)) for t in tasks]
+    with Pool(processes, initializer=initializer, initargs=initargs) as pool:
+        results = list(pool.imap_unordered(partial(_run_task, fn), tasks, chunksize=1))
+        # let the workers exit by themselves, rather than be terminated, so they close their clients
+        pool.close()
+        pool.join()
+    return results
+
+
+def _run_task(fn, task):
+    return task, fn(task)
+
+
+def run_largest_first_overlapped(read_fn, compute_fn, write_fn, tasks, processes=None,
+                                 prefetch=DEFAULT_PREFETCH, write_backlog=DEFAULT_WRITE_BACKLOG,
+                                 initializer=None, initargs=()):
+    """
+    Like run_largest_first, but each worker process runs its tasks with overlapped.run_overlapped.
+    Workers take tasks from one shared queue, biggest estimate first, so a worker can prefetch
+    its next task while computing the current one and still only takes work when it has room for it.
+    :param read_fn: picklable callable(task) -> inputs
+    :param compute_fn: picklable callable(task, inputs) -> outputs
+    :param write_fn: picklable callable(task, outputs)
+    :param tasks: iterable of ChunkTask
+    :param processes: number of workers, None for os.cpu_count
+    :param initializer: called with initargs once in each worker when it starts
+    """
+    tasks = sorted(tasks, key=lambda t: t.estimate, reverse=True)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(tasks))
+    if processes < 2:
+        if initializer is not None:
+            initializer(*initargs)
+        run_overlapped(tasks, read_fn, compute_fn, write_fn, prefetch=prefetch, write_backlog=write_backlog)
+        return
+    task_queue = Queue()
+    for t in tasks:
+        task_queue.put(t)
+    for _ in range(processes):
+        task_queue.put(None)
+    workers = [Process(target=_overlapped_worker,
+                       args=(task_queue, read_fn, compute_fn, write_fn, prefetch, write_backlog,
+                             initializer, initargs))
+               for _ in range(processes)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    failed = sum(1 for w in workers if w.exitcode != 0)
+    if failed:
+        raise RuntimeError("{} of {} overlapped workers failed.".format(failed, len(workers)))
+
+
+def _overlapped_worker(task_queue, read_fn, compute_fn, write_fn, prefetch, write_backlog, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    run_overlapped(iter(task_queue.get, None), read_fn, compute_fn, write_fn,
+                   prefetch=prefetch, write_backlog=write_backlog)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+"""site_params.py
+Per-run cache of each station's calibration parameters, as plain floats.
+The all_stations documents store them as Decimal128, which used to be converted
+again by every stage (and for every batch) of every site. Here they are read for
+all stations with one query at the start of a run, converted once, and handed to
+pool workers once, through the pool initializer, rather than with every task.
+The cache can be saved to a JSON snapshot file, so a run can start without
+reading all_stations from MongoDB at all.
+"""
+from decimal import Decimal
+import json
+import os
+
+from ._mongo_db_config import config as mongodb_config
+
+# The all_stations fields the processing levels use
+STATION_FIELDS = ('site_no', 'beta', 'ref_pressure', 'ref_intensity', 'latit_scaling', 'elev_scaling',
+                  'n0_cal', 'bulk_density', 'lattice_water_g_g', 'soil_organic_matter_g_g', 'alternate_algorithm')
+
+
+def _to_decimal(value):
+    to_decimal = getattr(value, 'to_decimal', None)
+    if to_decimal is not None:
+        return to_decimal()
+    return Decimal(str(value))
+
+
+class SiteParams(object):
+    """
+    Everything the processing levels need from a station's all_stations document.
+    Fields can also be read as params[name], so a SiteParams can be passed as the
+    soil_params of the calibration models.
+    scaling is latit_scaling / elev_scaling, or None if elev_scaling is zero.
+    """
+    __slots__ = ('site_no', 'beta', 'ref_pressure', 'ref_intensity', 'latit_scaling', 'elev_scaling', 'scaling',
+                 'n0_cal', 'bulk_density', 'lattice_soil_organic_sum', 'alternate_algorithm')
+
+    def __new__(cls, site_no, beta, ref_pressure, ref_intensity, latit_scaling, elev_scaling, scaling,
+                n0_cal, bulk_density, lattice_soil_organic_sum, alternate_algorithm=None):
+        self = super(SiteParams, cls).__new__(cls)
+        self.site_no = site_no
+        self.beta = beta
+        self.ref_pressure = ref_pressure
+        self.ref_intensity = ref_intensity
+        self.latit_scaling = latit_scaling
+        self.elev_scaling = elev_scaling
+        self.scaling = scaling
+        self.n0_cal = n0_cal
+        self.bulk_density = bulk_density
+        self.lattice_soil_organic_sum = lattice_soil_organic_sum
+        self.alternate_algorithm = alternate_algorithm
+        return self
+
+    def __getnewargs__(self):
+        return tuple(getattr(self, s) for s in self.__slots__)
+
+    def __getstate__(self):
+        return None
+
+    def __repr__(self):
+        return "SiteParams({})".format(", ".join("{}={!r}".format(s, getattr(self, s)) for s in self.__slots__))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def as_dict(self):
+        return {s: getattr(self, s) for s in self.__slots__}
+
+    @classmethod
+    def from_site(cls, this_site):
+        """
+        :param this_site: the all_stations document
+        :type this_site: dict
+        :rtype: SiteParams
+        """
+        latit_scaling = _to_decimal(this_site['latit_scaling'])
+        elev_scaling = _to_decimal(this_site['elev_scaling'])
+        try:
+            scaling = float(latit_scaling / elev_scaling)
+        except ZeroDivisionError:
+            scaling = None
+        # summed as decimals, the same as the site's SQL did
+        lattice_soil_organic_sum = _to_decimal(this_site['lattice_water_g_g']) + \
+            _to_decimal(this_site['soil_organic_matter_g_g'])
+        return cls(
+            int(this_site['site_no']),
+            float(_to_decimal(this_site['beta'])),
+            float(_to_decimal(this_site['ref_pressure'])),
+            float(_to_decimal(this_site['ref_intensity'])),
+            float(latit_scaling),
+            float(elev_scaling),
+            scaling,
+            float(_to_decimal(this_site['n0_cal'])),
+            float(_to_decimal(this_site['bulk_density'])),
+            float(lattice_soil_organic_sum),
+            this_site.get('alternate_algorithm', None))
+
+    def check_scaling(self):
+        """
+        :return: the scaling factor for the intensity correction
+        :rtype: float
+        :raises ZeroDivisionError: if the station's elev_scaling is zero
+        """
+        if self.scaling is None:
+            print("latit_scaling:", self.latit_scaling)
+            print("elev_scaling:", self.elev_scaling)
+            raise ZeroDivisionError("Site {} has an elev_scaling of zero.".format(self.site_no))
+        return self.scaling
+
+
+# The cache for this process. Filled by load_all_site_params, or by init_worker in pool workers.
+_site_params = {}
+
+
+def load_all_site_params(mongo_client, site_nos=None):
+    """
+    Read and convert the parameters of every station, or of just site_nos, with one query.
+    Stations with missing or invalid parameters are reported and left out.
+    :param mongo_client:
+    :param site_nos: the station numbers to load, or None for all stations
+    :return: dict of site_no to SiteParams
+    :rtype: dict
+    """
+    mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
+    query = {} if site_nos is None else {'site_no': {"$in": [int(s) for s in site_nos]}}
+    all_params = {}
+    for this_site in mdb.all_stations.find(query, {f: 1 for f in STATION_FIELDS}):
+        try:
+            params = SiteParams.from_site(this_site)
+        except (LookupError, TypeError, ValueError, ArithmeticError) as e:
+            print("Site {} has invalid calibration parameters: {!r}".format(this_site.get('site_no', None), e))
+            continue
+        all_params[params.site_no] = params
+    return all_params
+
+
+def set_site_params(all_params):
+    """
+    Replace this process's cache.
+    :param all_params: dict of site_no to SiteParams
+    """
+    _site_params.clear()
+    _site_params.update(all_params)
+
+
+def init_worker(all_params):
+    """
+    Pool initializer: give a worker process the cache once, when it starts.
+    """
+    set_site_params(all_params)
+
+
+def get_site_params(site_no, mongo_client=None):
+    """
+    A station's parameters from the cache. If they are not cached and mongo_client is given,
+    they are read from all_stations and cached, so the stages can still be run on their own.
+    :rtype: SiteParams
+    :raises LookupError: if the station has no usable parameters
+    """
+    site_no = int(site_no)
+    try:
+        return _site_params[site_no]
+    except KeyError:
+        if mongo_client is None:
+            raise LookupError("No calibration parameters loaded for site {}.".format(site_no))
+    mdb = getattr(mongo_client, mongodb_config['DB_NAME'])
+    this_site = mdb.all_stations.find_one({'site_no': site_no})
+    if this_site is None:
+        raise LookupError("Site {} is not in all_stations.".format(site_no))
+    params = _site_params[site_no] = SiteParams.from_site(this_site)
+    return params
+
+
+def save_snapshot(path, all_params):
+    """
+    Write the parameters to a JSON snapshot file, atomically.
+    :param all_params: dict of site_no to SiteParams
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump([p.as_dict() for p in all_params.values()], f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    """
+    :return: dict of site_no to SiteParams, as written by save_snapshot
+    :rtype: dict
+    """
+    with open(path, 'r') as f:
+        records = json.load(f)
+    return {int(r['site_no']): SiteParams(**r) for r in records}
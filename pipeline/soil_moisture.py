@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+"""soil_moisture.py
+Columnar level2->level3 soil moisture engine.
+Calibration models are registered by name and chosen by the station's
+alternate_algorithm; each one is a vectorized function over corr_count.
+"""
+import numpy as np
+
+CALIBRATION_MODELS = {}
+DEFAULT_CALIBRATION_MODEL = "standard"
+
+
+def calibration_model(name):
+    """
+    Decorator to register a calibration model under a name usable as a station's alternate_algorithm.
+    A model takes (corr_count, soil_params) and returns (corrected_moist_val, too_high, too_low),
+    where corrected_moist_val is the volumetric soil moisture fraction, and too_high/too_low are
+    boolean arrays selecting points to flag as 3 and 2 respectively.
+    :param name:
+    :type name: str
+    """
+    def _register(fn):
+        CALIBRATION_MODELS[name] = fn
+        return fn
+    return _register
+
+
+def get_calibration_model(alternate_algorithm=None):
+    """
+    :param alternate_algorithm: the station's alternate_algorithm, or None
+    :return: the registered model, the standard model if no alternate algorithm is registered by that name
+    """
+    if alternate_algorithm:
+        try:
+            return CALIBRATION_MODELS[alternate_algorithm]
+        except KeyError:
+            pass
+    return CALIBRATION_MODELS[DEFAULT_CALIBRATION_MODEL]
+
+
+@calibration_model("standard")
+def standard_model(corr_count, soil_params):
+    n0_cal = soil_params['n0_cal']
+    #((0.0808 / ((l2.CorrCount / a.N0_Cal) - 0.372) - 0.115 - a.LatticeWater_g_g - a.SoilOrganicMatter_g_g) * a.BulkDensity) * 100
+    corrected_moist_val = (0.0808 / ((corr_count / n0_cal) - 0.372) - 0.115 - soil_params['lattice_soil_organic_sum']) * soil_params['bulk_density']
+    return corrected_moist_val, corr_count > n0_cal, corr_count < (0.4 * n0_cal)
+
+
+@calibration_model("sandy")
+def sandy_model(corr_count, soil_params):
+    sandy_a = 1216036430.0
+    sandy_b = -3.272
+    n0_cal = soil_params['n0_cal']
+    corrected_moist_val = sandy_a * (corr_count ** sandy_b)
+    return corrected_moist_val, corr_count > (3.0 * n0_cal), corr_count < (0.5 * n0_cal)
+
+
+def level3_values(corr_count, wv_corr, level2_flag, rain, soil_params, alternate_algorithm=None):
+    """
+    Compute soil moisture, effective depth, flags and rainfall for a batch of level2 points.
+    :param corr_count:
+    :param wv_corr:
+    :param level2_flag: the level2 flag of each point
+    :param rain: rain gauge tips
+    :param soil_params: the station's n0_cal, bulk_density and lattice_soil_organic_sum
+    :type soil_params: site_params.SiteParams
+    :param alternate_algorithm: the station's alternate_algorithm, selects the calibration model
+    :return: dict of soil_moist, effective_depth, rainfall and flag arrays
+    :rtype: dict
+    """
+    corr_count = np.asarray(corr_count, dtype=np.float64)
+    wv_corr = np.asarray(wv_corr, dtype=np.float64)
+    level2_flag = np.asarray(level2_flag, dtype=np.int64)
+    rain = np.asarray(rain, dtype=np.float64)
+    model = get_calibration_model(alternate_algorithm)
+    try:
+        with np.errstate(divide='raise'):
+            corrected_moist_val, too_high, too_low = model(corr_count, soil_params)
+            #5.8 / ( ((a.LatticeWater_g_g + a.SoilOrganicMatter_g_g) * a.BulkDensity) + ( (0.0808 / ( (l2.CorrCount / a.N0_Cal) - 0.372) - 0.115 - a.LatticeWater_g_g - a.SoilOrganicMatter_g_g) * a.BulkDensity ) + 0.0829) AS EffectiveDepth,
+            effective_depth = 5.8 / ((soil_params['lattice_soil_organic_sum'] * soil_params['bulk_density']) + corrected_moist_val + 0.0829)
+    except FloatingPointError as e:
+        raise ZeroDivisionError(*e.args)
+    flag = np.select([wv_corr == 1.0, too_high, too_low], [5, 3, 2], level2_flag)
+    return {
+        "soil_moist": corrected_moist_val * 100.0,
+        "effective_depth": effective_depth,
+        "rainfall": rain * 0.2,
+        "flag": flag,
+    }
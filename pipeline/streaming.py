@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+"""streaming.py
+Streaming reads from InfluxDB using its chunked query responses.
+Points are handed over one chunk at a time as they arrive, so a reader holds at most a chunk
+(plus whatever context it keeps from the previous chunk) instead of the whole history.
+The client's timeout applies to each read from the connection, not to the whole response,
+so long backprocesses no longer time out while the server is still sending data.
+"""
+import json
+
+from influxdb.exceptions import InfluxDBClientError
+
+from ._influx_db_config import config as influx_config
+from .metrics import increment
+from .tracing import trace_rows
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def stream_results(influx_client, query, bind_params=None, chunk_size=DEFAULT_CHUNK_SIZE, epoch=None):
+    """
+    Run a SELECT query with a chunked response, and yield the raw result of each chunk as it arrives.
+    The response is requested as JSON, because the client reads msgpack responses whole.
+    :param influx_client:
+    :type influx_client: influxdb.InfluxDBClient
+    :param query: a single InfluxQL SELECT statement
+    :param bind_params: values for $name placeholders in the query
+    :param chunk_size: the number of points per chunk
+    :param epoch: return times as epoch integers of this precision (h, m, s, ms, u or ns)
+    :return: generator of result dicts, with "series" lists of columns and values
+    """
+    params = {'db': influx_config['DB_NAME'], 'q': query, 'chunked': 'true', 'chunk_size': int(chunk_size)}
+    if bind_params:
+        params['params'] = json.dumps(bind_params)
+    if epoch is not None:
+        params['epoch'] = epoch
+    response = influx_client.request(url="query", method="GET", params=params, stream=True,
+                                     headers={'Accept': 'application/json'})
+    increment('queries')
+    try:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            data = json.loads(line)
+            if 'error' in data:
+                raise InfluxDBClientError(data['error'])
+            for result in data.get('results', []):
+                if 'error' in result:
+                    raise InfluxDBClientError(result['error'])
+                rows = sum(len(s.get('values', [])) for s in result.get('series', []))
+                increment('rows_read', rows)
+                trace_rows(response, rows)
+                yield result
+    finally:
+        response.close()
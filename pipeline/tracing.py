@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+#
+"""tracing.py
+Query-level tracing of InfluxDB and MongoDB calls. Every call becomes a span, with the
+query template (the query with its literals replaced by ?), the pipeline function that
+made it, its latency, response size and row count. Spans are appended as JSON lines to a
+local file, one line per call, by every process of a run; top_templates then shows which
+query templates the run's time went to.
+Clients are wrapped once, when they are made, and the wrappers pass calls straight through
+until tracing is started with start_tracing (or set_tracing in a worker), so tracing can be
+switched on for a run without touching the code that makes the calls.
+"""
+import argparse
+from collections import defaultdict
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+try:
+    from .utils import do_load_dotenv
+except ImportError:
+    from utils import do_load_dotenv
+
+do_load_dotenv()
+
+DEFAULT_TOP = 20
+
+# Frames in these modules are plumbing; the caller is the first frame outside them
+_PLUMBING_MODULES = ('influxdb', 'pymongo', 'requests', 'urllib3', 'asyncio', 'contextlib')
+_PLUMBING_HELPERS = ('tracing', 'frames', 'streaming', 'influx_cached_writer', 'async_db')
+_PLUMBING_FUNCTIONS = ('_maybe_flush', 'write_point', 'write_points', '__exit__')
+
+_COMMENT = re.compile(r'^\s*--.*$', re.MULTILINE)
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r'(?<![\w$".])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w".])')
+_SPACE = re.compile(r'\s+')
+
+
+def query_template(query):
+    """
+    :return: an InfluxQL query with comments removed, string and number literals replaced by ?
+        and whitespace collapsed, so the same query for different sites and times gives the same template
+    :rtype: str
+    """
+    template = _COMMENT.sub('', query)
+    template = _STRING.sub('?', template)
+    template = _NUMBER.sub('?', template)
+    return _SPACE.sub(' ', template).strip()
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return ['?']
+    return '?'
+
+
+def mongo_template(collection, method, query=None):
+    """
+    :return: collection.method and the query's keys and operators, with every value replaced by ?
+    :rtype: str
+    """
+    if not query:
+        return "{}.{}".format(collection, method)
+    return "{}.{} {}".format(collection, method, json.dumps(_shape(query), sort_keys=True))
+
+
+class TraceSettings(object):
+    """
+    Where a run's spans go. Picklable, so it can be given to pool workers.
+    """
+    __slots__ = ('path', 'run_id')
+
+    def __new__(cls, path, run_id):
+        self = super(TraceSettings, cls).__new__(cls)
+        self.path = path
+        self.run_id = run_id
+        return self
+
+    def __getnewargs__(self):
+        return self.path, self.run_id
+
+    def __getstate__(self):
+        return None
+
+
+class Span(object):
+    """
+    One traced call. bytes are the request body and the response together;
+    bytes and rows are None where they are not known.
+    """
+    __slots__ = ('kind', 'template', 'caller', 'start', 'started', 'seconds', 'bytes', 'rows')
+
+    def __new__(cls, kind, template, caller=None):
+        self = super(Span, cls).__new__(cls)
+        self.kind = kind
+        self.template = template
+        self.caller = _caller() if caller is None else caller
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.bytes = None
+        self.rows = None
+        return self
+
+    def add_bytes(self, n):
+        self.bytes = n if self.bytes is None else self.bytes + n
+
+    def add_rows(self, n):
+        self.rows = n if self.rows is None else self.rows + n
+
+    def finish(self):
+        """
+        Record the span, once.
+        """
+        if self.seconds is not None:
+            return
+        self.seconds = time.perf_counter() - self.started
+        _write_span(self)
+
+
+# The tracing of this process, set by start_tracing or set_tracing
+_settings = None
+# This process's spans file, reopened after a fork
+_file = None
+_file_pid = None
+_file_lock = threading.Lock()
+# The span of the query or write_points call in progress in each thread, for the request it makes
+_local = threading.local()
+
+
+def start_tracing(path=None, run_id=None):
+    """
+    Start tracing in this process.
+    :param path: the JSONL file to append spans to, by default $TRACE_FILE
+    :param run_id: tags every span of the run, by default the current time
+    :return: the run's settings, for set_tracing in worker processes, or None if there is no path
+    :rtype: TraceSettings | NoneType
+    """
+    if path is None:
+        path = os.getenv("TRACE_FILE", None)
+    if not path:
+        return None
+    if run_id is None:
+        run_id = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    settings = TraceSettings(path, run_id)
+    set_tracing(settings)
+    return settings
+
+
+def set_tracing(settings):
+    """
+    Trace calls for settings in this process, or stop tracing with None.
+    """
+    global _settings
+    _settings = settings
+
+
+def tracing_enabled():
+    """
+    :return: True if this process is tracing
+    """
+    return _settings is not None
+
+
+def _caller():
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if not (module.split('.', 1)[0] in _PLUMBING_MODULES or module.rsplit('.', 1)[-1] in _PLUMBING_HELPERS or
+                frame.f_code.co_name in _PLUMBING_FUNCTIONS):
+            return "{}.{}:{}".format(module, frame.f_code.co_name, frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def _write_span(span):
+    global _file, _file_pid
+    settings = _settings
+    if settings is None:
+        return
+    line = json.dumps({
+        'run': settings.run_id, 'pid': os.getpid(), 'kind': span.kind, 'template': span.template,
+        'caller': span.caller, 'start': round(span.start, 6), 'seconds': round(span.seconds, 6),
+        'bytes': span.bytes, 'rows': span.rows}) + "\n"
+    try:
+        with _file_lock:
+            if _file is None or _file_pid != os.getpid():
+                _file = open(settings.path, "a")
+                _file_pid = os.getpid()
+            # one write per span, so spans from several worker processes don't interleave
+            _file.write(line)
+            _file.flush()
+    except OSError as e:
+        print("Could not write trace span to {}: {!r}".format(settings.path, e))
+
+
+def result_rows(result):
+    """
+    :return: the number of rows in a query result, a ResultSet or a list of them
+    """
+    results = result if isinstance(result, list) else [result]
+    return sum(len(series.get('values', None) or []) for r in results
+               for series in getattr(r, 'raw', r).get('series', []))
+
+
+class _TracedResponse(object):
+    """
+    A streamed response, whose span ends when it is closed.
+    The reader reports the rows it decodes with trace_rows.
+    """
+    __slots__ = ('response', 'span')
+
+    def __new__(cls, response, span):
+        self = super(_TracedResponse, cls).__new__(cls)
+        self.response = response
+        self.span = span
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_lines(self, *args, **kwargs):
+        for line in self.response.iter_lines(*args, **kwargs):
+            self.span.add_bytes(len(line) + 1)
+            yield line
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            self.span.finish()
+
+
+def trace_rows(response, n):
+    """
+    Count n decoded rows against a streamed response's span, if it is traced.
+    """
+    if isinstance(response, _TracedResponse):
+        response.span.add_rows(n)
+
+
+def _line_measurement(line):
+    end = len(line)
+    for sep in (',', ' '):
+        i = line.find(sep)
+        if 0 <= i < end:
+            end = i
+    return line[:end]
+
+
+def trace_influx_client(client):
+    """
+    Wrap an InfluxDBClient's query, write_points and request methods, in place.
+    Streamed requests (stream_results) get their own spans.
+    :return: client
+    """
+    if getattr(client, '_traced', False):
+        return client
+    request, query, write_points = client.request, client.query, client.write_points
+
+    def traced_request(*args, **kwargs):
+        if _settings is None:
+            return request(*args, **kwargs)
+        outer = getattr(_local, 'span', None)
+        if outer is None:
+            url = kwargs.get('url', args[0] if args else None)
+            q = (kwargs.get('params', None) or {}).get('q', None)
+            span = Span("influx.{}".format(url), url if q is None else query_template(q))
+        else:
+            span = outer
+        data = kwargs.get('data', None)
+        if data:
+            span.add_bytes(len(data))
+        response = request(*args, **kwargs)
+        if kwargs.get('stream', False):
+            return response if outer is not None else _TracedResponse(response, span)
+        span.add_bytes(len(response.content))
+        if outer is None:
+            span.finish()
+        return response
+
+    def traced_query(q, *args, **kwargs):
+        if _settings is None:
+            return query(q, *args, **kwargs)
+        span = _local.span = Span("influx.query", query_template(q))
+        try:
+            result = query(q, *args, **kwargs)
+            span.rows = result_rows(result)
+            return result
+        finally:
+            _local.span = None
+            span.finish()
+
+    def traced_write_points(points, *args, **kwargs):
+        if _settings is None:
+            return write_points(points, *args, **kwargs)
+        if kwargs.get('protocol', 'json') == 'line':
+            measurements = sorted({_line_measurement(line) for line in points})
+        else:
+            measurements = sorted({p.get('measurement', kwargs.get('measurement', None)) or '' for p in points})
+        span = _local.span = Span("influx.write", "WRITE {}".format(",".join(measurements)))
+        span.rows = len(points)
+        try:
+            return write_points(points, *args, **kwargs)
+        finally:
+            _local.span = None
+            span.finish()
+
+    client.request = traced_request
+    client.query = traced_query
+    client.write_points = traced_write_points
+    client._traced = True
+    return client
+
+
+class _TracedCursor(object):
+    """
+    A pymongo Cursor whose span covers reading its documents. It ends when the cursor is exhausted,
+    closed or let go. Methods that return the cursor, such as sort and limit, return this proxy instead,
+    so calls still chain.
+    """
+    __slots__ = ('cursor', 'span')
+
+    def __new__(cls, cursor, span):
+        self = super(_TracedCursor, cls).__new__(cls)
+        self.cursor = cursor
+        self.span = span
+        span.rows = 0
+        return self
+
+    def __getattr__(self, name):
+        value = getattr(self.cursor, name)
+        if not callable(value):
+            return value
+
+        def chained(*args, **kwargs):
+            result = value(*args, **kwargs)
+            return self if result is self.cursor else result
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            doc = next(self.cursor)
+        except StopIteration:
+            self.span.finish()
+            raise
+        self.span.rows += 1
+        return doc
+
+    next = __next__
+
+    def __getitem__(self, index):
+        result = self.cursor[index]
+        return self if result is self.cursor else result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self.cursor.close()
+        finally:
+            self.span.finish()
+
+    def __del__(self):
+        self.span.finish()
+
+
+_MONGO_ROWS = {
+    'find_one': lambda doc: 0 if doc is None else 1,
+    'insert_one': lambda result: 1,
+    'insert_many': lambda result: len(result.inserted_ids),
+    'update_one': lambda result: result.modified_count,
+    'update_many': lambda result: result.modified_count,
+    'replace_one': lambda result: result.modified_count,
+    'delete_one': lambda result: result.deleted_count,
+    'delete_many': lambda result: result.deleted_count,
+    'count_documents': lambda n: n,
+}
+
+
+class _TracedCollection(object):
+    """
+    A pymongo Collection whose calls are traced. find returns a traced cursor,
+    so the span covers reading the documents.
+    """
+    __slots__ = ('collection',)
+
+    def __new__(cls, collection):
+        self = super(_TracedCollection, cls).__new__(cls)
+        self.collection = collection
+        return self
+
+    def __getattr__(self, name):
+        value = getattr(self.collection, name)
+        rows = _MONGO_ROWS.get(name, None)
+        if (rows is None and name != 'find') or _settings is None:
+            return value
+
+        def traced(*args, **kwargs):
+            query = args[0] if args else kwargs.get('filter', None)
+            span = Span("mongo.{}".format(name), mongo_template(self.collection.name, name, query))
+            if name == 'find':
+                try:
+                    return _TracedCursor(value(*args, **kwargs), span)
+                except Exception:
+                    span.finish()
+                    raise
+            try:
+                result = value(*args, **kwargs)
+                span.rows = rows(result)
+                return result
+            finally:
+                span.finish()
+        return traced
+
+
+class _TracedDatabase(object):
+    __slots__ = ('database',)
+
+    def __new__(cls, database):
+        self = super(_TracedDatabase, cls).__new__(cls)
+        self.database = database
+        return self
+
+    def __getattr__(self, name):
+        value = getattr(self.database, name)
+        return _TracedCollection(value) if isinstance(value, Collection) else value
+
+    def __getitem__(self, name):
+        return _TracedCollection(self.database[name])
+
+
+class _TracedMongoClient(object):
+    __slots__ = ('client',)
+
+    def __new__(cls, client):
+        self = super(_TracedMongoClient, cls).__new__(cls)
+        self.client = client
+        return self
+
+    def __getattr__(self, name):
+        value = getattr(self.client, name)
+        return _TracedDatabase(value) if isinstance(value, Database) else value
+
+    def __getitem__(self, name):
+        return _TracedDatabase(self.client[name])
+
+
+def trace_mongo_client(client):
+    """
+    :return: a MongoClient whose collection calls are traced, or client itself when tracing is off
+    """
+    if _settings is None:
+        return client
+    return _TracedMongoClient(client)
+
+
+def read_spans(path, run_id=None):
+    """
+    :return: the spans in a JSONL file, only those of run_id if it is given
+    :rtype: list
+    """
+    spans = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            span = json.loads(line)
+            if run_id is None or span.get('run', None) == run_id:
+                spans.append(span)
+    return spans
+
+
+def top_templates(spans, top=DEFAULT_TOP):
+    """
+    Group spans by kind and template, largest total time first.
+    :return: list of dicts of kind, template, calls, seconds, max_seconds, bytes, rows and callers
+        (caller to total seconds, largest first)
+    :rtype: list
+    """
+    groups = {}
+    for s in spans:
+        key = (s['kind'], s['template'])
+        g = groups.get(key, None)
+        if g is None:
+            g = groups[key] = {'kind': s['kind'], 'template': s['template'], 'calls': 0, 'seconds': 0.0,
+                               'max_seconds': 0.0, 'bytes': 0, 'rows': 0, 'callers': defaultdict(float)}
+        g['calls'] += 1
+        g['seconds'] += s['seconds']
+        g['max_seconds'] = max(g['max_seconds'], s['seconds'])
+        g['bytes'] += s['bytes'] or 0
+        g['rows'] += s['rows'] or 0
+        g['callers'][s['caller']] += s['seconds']
+    ranked = sorted(groups.values(), key=lambda g: -g['seconds'])[:top]
+    for g in ranked:
+        g['callers'] = dict(sorted(g['callers'].items(), key=lambda c: -c[1]))
+    return ranked
+
+
+def format_report(ranked, total_seconds=None):
+    """
+    :param ranked: as from top_templates
+    :return: the report as printable lines
+    :rtype: list
+    """
+    lines = []
+    for i, g in enumerate(ranked, 1):
+        share = "" if not total_seconds else " ({:.1f}%)".format(100.0 * g['seconds'] / total_seconds)
+        lines.append("{}. {:.3f}s{} in {} {} calls, max {:.3f}s, {} rows, {} bytes".format(
+            i, g['seconds'], share, g['calls'], g['kind'], g['max_seconds'], g['rows'], g['bytes']))
+        lines.append("   {}".format(g['template']))
+        for caller, seconds in list(g['callers'].items())[:3]:
+            lines.append("   {:.3f}s from {}".format(seconds, caller))
+    return lines
+
+
+def write_report(settings, top=DEFAULT_TOP):
+    """
+    Write the top query templates of a run to a text file next to its spans file.
+    :type settings: TraceSettings
+    :return: (the report's path, its lines)
+    :rtype: tuple
+    """
+    spans = read_spans(settings.path, settings.run_id)
+    total_seconds = sum(s['seconds'] for s in spans)
+    lines = ["Top {} query templates by total time of run {}: {} calls, {:.3f}s".format(
+        top, settings.run_id, len(spans), total_seconds)]
+    lines.extend(format_report(top_templates(spans, top), total_seconds))
+    path = "{}.{}.top.txt".format(os.path.splitext(settings.path)[0], settings.run_id)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the query templates that took the most time in a trace.')
+    parser.add_argument('path', type=str, help='The JSONL spans file.')
+    parser.add_argument('-r', '--run', type=str, dest="run", help='Only report on this run.')
+    parser.add_argument('-n', '--top', type=int, dest="top", default=DEFAULT_TOP,
+                        help='Number of templates to show. Default is {}.'.format(DEFAULT_TOP))
+    args = parser.parse_args()
+    spans = read_spans(args.path, args.run)
+    for line in format_report(top_templates(spans, args.top), sum(s['seconds'] for s in spans)):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
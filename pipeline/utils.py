@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 """utils.py"""
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 
 def do_load_dotenv():
     if do_load_dotenv.completed:
@@ -13,24 +13,83 @@ def do_load_dotenv():
 do_load_dotenv.completed = False
 
 
+NS_PER_SECOND = 1000000000
+HOUR_NS = 3600 * NS_PER_SECOND
+DAY_NS = 86400 * NS_PER_SECOND
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_offset_zones = {0: timezone.utc}
+
+
+def _parse_isostring(iso_string):
+    """
+    Split an ISO8601 datetime with a UTC offset, like InfluxDB returns,
+    "2019-11-10T23:00:00Z", "2019-11-10T23:00:00.123456789Z" or "2019-11-10T23:00:00+10:00".
+    Slices the fixed-width fields directly rather than trying strptime formats.
+    :return: (year, month, day, hour, minute, second, nanosecond, utc_offset_seconds)
+    :rtype: tuple
+    """
+    try:
+        if iso_string[4] != '-' or iso_string[7] != '-' or iso_string[13] != ':' or iso_string[16] != ':':
+            raise ValueError()
+        hour = int(iso_string[11:13])
+        minute = int(iso_string[14:16])
+        second = int(iso_string[17:19])
+        if hour > 23 or minute > 59 or second > 59:
+            raise ValueError()
+        pos = 19
+        nanosecond = 0
+        if iso_string[pos:pos + 1] == '.':
+            end = pos + 1
+            length = len(iso_string)
+            while end < length and iso_string[end].isdigit():
+                end += 1
+            digits = iso_string[pos + 1:end]
+            if not digits:
+                raise ValueError()
+            nanosecond = int(digits[:9].ljust(9, '0'))
+            pos = end
+        suffix = iso_string[pos:]
+        if suffix == 'Z':
+            offset = 0
+        else:
+            sign = suffix[:1]
+            hhmm = suffix[1:].replace(':', '')
+            if sign not in ('+', '-') or len(hhmm) != 4 or not hhmm.isdigit():
+                raise ValueError()
+            offset = int(hhmm[:2]) * 3600 + int(hhmm[2:]) * 60
+            if sign == '-':
+                offset = -offset
+        return (int(iso_string[0:4]), int(iso_string[5:7]), int(iso_string[8:10]),
+                hour, minute, second, nanosecond, offset)
+    except (ValueError, IndexError):
+        raise ValueError("Not an ISO8601 datetime with a UTC offset: {!r}".format(iso_string))
+
+
 def isostring_to_datetime(iso_string):
     """
     :param iso_string:
     :type iso_string: str
-    :return: the python datetime obj
+    :return: the python datetime obj, in the string's UTC offset, truncated to microseconds
     :rtype: datetime
     """
-    if iso_string.endswith('Z'):
-        iso_string = iso_string[:-1]+"+0000"
-    else:
-        last4 = iso_string[-4:]
-        if ":" in last4:
-            # something like +04:30, change to 0430
-            iso_string = iso_string[:-4] + last4.replace(":", "")
-    try:
-       return datetime.strptime(iso_string, "%Y-%m-%dT%H:%M:%S%z")
-    except:
-       return datetime.strptime(iso_string, "%Y-%m-%dT%H:%M:%S.%f%z")
+    year, month, day, hour, minute, second, nanosecond, offset = _parse_isostring(iso_string)
+    tz = _offset_zones.get(offset, None)
+    if tz is None:
+        tz = _offset_zones[offset] = timezone(timedelta(seconds=offset))
+    return datetime(year, month, day, hour, minute, second, nanosecond // 1000, tzinfo=tz)
+
+
+def isostring_to_epoch_ns(iso_string):
+    """
+    :param iso_string:
+    :type iso_string: str
+    :return: integer nanoseconds since the unix epoch, keeping all of the string's precision
+    :rtype: int
+    """
+    year, month, day, hour, minute, second, nanosecond, offset = _parse_isostring(iso_string)
+    days = date(year, month, day).toordinal() - _EPOCH_ORDINAL
+    return (days * 86400 + hour * 3600 + minute * 60 + second - offset) * NS_PER_SECOND + nanosecond
+
 
 delta_1h = timedelta(hours=1)
 delta_1m = timedelta(minutes=1)
@@ -65,16 +124,72 @@ def datetime_to_isostring(py_datetime):
         suffix = "Z"
 
     if isinstance(py_datetime, date) and not isinstance(py_datetime, datetime):
-        datetime_string = py_datetime.strftime("%Y-%m-%dT00:00:00")
+        datetime_string = "%04d-%02d-%02dT00:00:00" % (py_datetime.year, py_datetime.month, py_datetime.day)
     else:
-        micros = getattr(py_datetime, 'microsecond', 0)
+        datetime_string = "%04d-%02d-%02dT%02d:%02d:%02d" % (
+            py_datetime.year, py_datetime.month, py_datetime.day,
+            py_datetime.hour, py_datetime.minute, py_datetime.second)
+        micros = py_datetime.microsecond
         if micros > 0:
-            datetime_string = py_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")
-        else:
-            datetime_string = py_datetime.strftime("%Y-%m-%dT%H:%M:%S")
+            datetime_string += ".%06d" % micros
     return datetime_string + suffix
 
 
+def epoch_ns_to_isostring(epoch_ns):
+    """
+    :param epoch_ns: integer nanoseconds since the unix epoch
+    :type epoch_ns: int
+    :return: the UTC iso string representation, with microseconds or nanoseconds if there are any
+    :rtype: str
+    """
+    seconds, nanosecond = divmod(int(epoch_ns), NS_PER_SECOND)
+    days, seconds = divmod(seconds, 86400)
+    day = date.fromordinal(days + _EPOCH_ORDINAL)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    datetime_string = "%04d-%02d-%02dT%02d:%02d:%02d" % (day.year, day.month, day.day, hour, minute, second)
+    if nanosecond > 0:
+        if nanosecond % 1000 == 0:
+            datetime_string += ".%06d" % (nanosecond // 1000)
+        else:
+            datetime_string += ".%09d" % nanosecond
+    return datetime_string + "Z"
+
+
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+def datetime_to_epoch_ns(py_datetime):
+    """
+    :param py_datetime: a timezone-aware datetime
+    :type py_datetime: datetime
+    :return: integer nanoseconds since the unix epoch
+    :rtype: int
+    """
+    delta = py_datetime - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+
+def epoch_ns_to_datetime(epoch_ns):
+    """
+    :param epoch_ns: integer nanoseconds since the unix epoch
+    :type epoch_ns: int
+    :return: UTC datetime, truncated to microseconds
+    :rtype: datetime
+    """
+    return epoch + timedelta(microseconds=epoch_ns // 1000)
+
+
+def as_utc(py_datetime):
+    """
+    Naive datetimes (as returned by pymongo) are always UTC, make them aware.
+    :param py_datetime:
+    :type py_datetime: datetime | NoneType
+    :rtype: datetime | NoneType
+    """
+    if py_datetime is not None and py_datetime.tzinfo is None:
+        py_datetime = py_datetime.replace(tzinfo=timezone.utc)
+    return py_datetime
+
+
 def sql_to_isostring(sql_datetime):
     """
     Assumes sql date string is in UTC
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+"""verify.py
+Columnar comparison of two measurements holding the same level, usually a level
+against its "_temp" copy. Both are loaded as Frames, joined on time, and every
+field is checked against its tolerance as one array operation. The result is a
+compact report: counts, the worst offenders and the time ranges that disagree,
+rather than a line printed for every differing value.
+"""
+import numpy as np
+
+from .frames import read_frame
+from .utils import datetime_to_isostring, epoch_ns_to_isostring
+
+DEFAULT_WORST = 5
+DEFAULT_RANGES = 10
+
+
+class LevelCheck(object):
+    """
+    The fields of a level and how far apart they may be.
+    A float field agrees if |a - b| <= atol or |a - b| <= rtol * |a|, where a is the reference value.
+    Fields in exact must be equal. Two missing values agree.
+    """
+    __slots__ = ('fields', 'exact', 'atol', 'rtol')
+
+    def __new__(cls, fields, exact=(), atol=0.0, rtol=0.0):
+        self = super(LevelCheck, cls).__new__(cls)
+        self.fields = tuple(fields)
+        self.exact = frozenset(exact)
+        self.atol = atol
+        self.rtol = rtol
+        return self
+
+    def __getnewargs__(self):
+        return self.fields, tuple(self.exact), self.atol, self.rtol
+
+    def __getstate__(self):
+        return None
+
+    def tolerance(self, field, reference):
+        """
+        :return: the allowed absolute difference for each reference value
+        """
+        if field in self.exact:
+            return np.zeros(len(reference), dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            return np.maximum(self.atol, self.rtol * np.abs(reference))
+
+
+# The tolerances the old point-by-point tests used, with percentages as fractions
+LEVEL_CHECKS = {
+    "level1": LevelCheck(
+        ("count", "pressure1", "internal_temperature", "internal_humidity", "battery", "tube_temperature",
+         "tube_humidity", "rain", "vwc1", "vwc2", "vwc3", "pressure2", "external_temperature",
+         "external_humidity", "flag"),
+        exact=("count", "flag")),
+    "level2": LevelCheck(
+        ("count", "press_corr", "wv_corr", "intensity_corr", "corr_count", "rain", "flag"),
+        exact=("count", "flag"), rtol=8.88888912e-09),
+    "level3": LevelCheck(
+        ("soil_moist", "effective_depth", "rainfall", "flag"),
+        exact=("flag",), atol=0.00001, rtol=0.0000033),
+    "level4": LevelCheck(
+        ("soil_moist", "effective_depth", "rainfall", "soil_moist_filtered", "depth_filtered"),
+        atol=3.29e-05, rtol=4.8e-08),
+}
+
+
+class VerifyReport(object):
+    """
+    The result of comparing a reference measurement with a candidate.
+    ranges and worst are sorted, the largest disagreements first.
+    """
+    __slots__ = ('reference', 'candidate', 'site_no', 'compared', 'only_reference', 'only_candidate',
+                 'field_counts', 'rows_differing', 'worst', 'ranges', 'range_count')
+
+    def __new__(cls, reference, candidate, site_no):
+        self = super(VerifyReport, cls).__new__(cls)
+        self.reference = reference
+        self.candidate = candidate
+        self.site_no = site_no
+        self.compared = 0
+        self.only_reference = 0
+        self.only_candidate = 0
+        # field name to the number of rows where it disagrees
+        self.field_counts = {}
+        self.rows_differing = 0
+        # (field, epoch-ns time, reference value, candidate value, difference)
+        self.worst = []
+        # (first epoch-ns time, last epoch-ns time, number of rows)
+        self.ranges = []
+        self.range_count = 0
+        return self
+
+    @property
+    def ok(self):
+        return self.rows_differing == 0 and self.only_reference == 0 and self.only_candidate == 0
+
+    def summary(self):
+        """
+        :return: the report as printable lines
+        :rtype: list
+        """
+        lines = ["Site {} {} vs {}: {} rows compared, {} differ, {} only in {}, {} only in {}{}".format(
+            self.site_no, self.reference, self.candidate, self.compared, self.rows_differing,
+            self.only_reference, self.reference, self.only_candidate, self.candidate, "" if self.ok else " FAILED")]
+        if self.field_counts:
+            lines.append("  differing fields: {}".format(", ".join(
+                "{} {}".format(f, n) for f, n in sorted(self.field_counts.items(), key=lambda i: -i[1]))))
+        for (field, t, a, b, diff) in self.worst:
+            lines.append("  worst: {} at {}: {} -> {} (d: {})".format(field, epoch_ns_to_isostring(t), a, b, diff))
+        for (start, end, n) in self.ranges:
+            lines.append("  disagree from {} to {} ({} rows)".format(
+                epoch_ns_to_isostring(start), epoch_ns_to_isostring(end), n))
+        if self.range_count > len(self.ranges):
+            lines.append("  ... and {} more ranges".format(self.range_count - len(self.ranges)))
+        return lines
+
+
+def _disagreeing_ranges(times, bad, max_ranges):
+    """
+    :param times: sorted epoch-ns times
+    :param bad: boolean array, True for rows that disagree
+    :return: (the largest max_ranges runs of consecutive bad rows, the number of runs)
+    """
+    edges = np.diff(np.concatenate(([0], bad.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    lengths = ends - starts
+    order = np.argsort(-lengths, kind='stable')[:max_ranges]
+    return [(int(times[starts[i]]), int(times[ends[i] - 1]), int(lengths[i])) for i in order], len(starts)
+
+
+def compare_frames(reference, candidate, check, report, max_worst=DEFAULT_WORST, max_ranges=DEFAULT_RANGES):
+    """
+    Join two Frames of the same level on time and fill in report.
+    :param reference:
+    :type reference: frames.Frame
+    :param candidate:
+    :type candidate: frames.Frame
+    :param check:
+    :type check: LevelCheck
+    :param report: an empty report for the two measurements
+    :type report: VerifyReport
+    :return: report
+    :rtype: VerifyReport
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    ref_times = reference['time'] if len(reference) > 0 else empty
+    cand_times = candidate['time'] if len(candidate) > 0 else empty
+    # a time can repeat if a point was rewritten with a different flag tag, the first one is compared
+    times, ref_index, cand_index = np.intersect1d(ref_times, cand_times, return_indices=True)
+    all_times = np.union1d(ref_times, cand_times)
+    report.compared = len(times)
+    report.only_reference = len(np.setdiff1d(ref_times, cand_times))
+    report.only_candidate = len(all_times) - len(times) - report.only_reference
+    bad = np.zeros(len(times), dtype=bool)
+    worst = []
+    for field in check.fields:
+        if field not in reference or field not in candidate:
+            continue
+        a = np.asarray(reference[field], dtype=np.float64)[ref_index]
+        b = np.asarray(candidate[field], dtype=np.float64)[cand_index]
+        a_missing = np.isnan(a)
+        b_missing = np.isnan(b)
+        with np.errstate(invalid='ignore'):
+            diff = np.abs(a - b)
+            differs = (a_missing != b_missing) | (~a_missing & (diff > check.tolerance(field, a)))
+        n = int(np.count_nonzero(differs))
+        if n < 1:
+            continue
+        report.field_counts[field] = n
+        bad |= differs
+        diff = np.where(a_missing != b_missing, np.inf, diff)
+        at = np.flatnonzero(differs)
+        for i in at[np.argsort(-diff[at], kind='stable')[:max_worst]].tolist():
+            worst.append((field, int(times[i]), a[i].item(), b[i].item(), diff[i].item()))
+    report.rows_differing = int(np.count_nonzero(bad))
+    report.worst = sorted(worst, key=lambda w: -w[4])[:max_worst]
+    # rows only on one side disagree too
+    all_bad = np.ones(len(all_times), dtype=bool)
+    all_bad[np.searchsorted(all_times, times)] = bad
+    report.ranges, report.range_count = _disagreeing_ranges(all_times, all_bad, max_ranges)
+    return report
+
+
+def verify_level(influx_client, site_no, level, back_time=None, end_time=None, reference=None, candidate=None,
+                 max_worst=DEFAULT_WORST, max_ranges=DEFAULT_RANGES):
+    """
+    Compare a site's records of a level in two measurements, in (back_time, end_time].
+    :param influx_client:
+    :param site_no:
+    :param level: one of the LEVEL_CHECKS names
+    :param back_time: only compare records after this time, or None for all of them
+    :type back_time: datetime | NoneType
+    :param end_time: only compare records up to this time, or None for no limit
+    :type end_time: datetime | NoneType
+    :param reference: the measurement to compare against, the level itself by default
+    :param candidate: the measurement to check, the level's "_temp" copy by default
+    :rtype: VerifyReport
+    """
+    check = LEVEL_CHECKS[level]
+    reference = level if reference is None else reference
+    candidate = "{}_temp".format(level) if candidate is None else candidate
+    time_clause = ""
+    if back_time is not None:
+        time_clause += """"time" > '{}' AND """.format(datetime_to_isostring(back_time))
+    if end_time is not None:
+        time_clause += """"time" <= '{}' AND """.format(datetime_to_isostring(end_time))
+    frames = [read_frame(influx_client, """SELECT "time", {} FROM "{}" WHERE {}site_no=$s""".format(
+        ", ".join('"{}"'.format(f) for f in check.fields), measurement, time_clause), bind_params={"s": str(site_no)})
+        for measurement in (reference, candidate)]
+    report = VerifyReport(reference, candidate, site_no)
+    return compare_frames(frames[0], frames[1], check, report, max_worst=max_worst, max_ranges=max_ranges)
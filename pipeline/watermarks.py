@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+"""watermarks.py
+Per-site, per-level high-water marks for incremental processing.
+A level's watermark is the latest raw_values time that has been fully processed
+into that level. Watermarks live in the pipeline_state collection in MongoDB.
+"""
+from datetime import datetime, timezone, timedelta
+
+from .utils import as_utc, isostring_to_datetime
+
+STATE_COLLECTION = "pipeline_state"
+LEVELS = ("level1", "level2", "level3", "level4")
+
+# level4 points up to this far before the watermark have smoothing windows reaching past it,
+# so they are recomputed when newer level3 data arrives.
+LEVEL4_LOOKBACK = timedelta(hours=3, seconds=1)
+
+
+def get_watermarks(mdb, site_no):
+    """
+    :param mdb: the cosmoz mongo database
+    :param site_no:
+    :return: dict of level name to watermark datetime, None for levels that have never been processed
+    :rtype: dict
+    """
+    return watermarks_from_docs(getattr(mdb, STATE_COLLECTION).find({'site_no': int(site_no)}))
+
+
+def watermarks_from_docs(docs):
+    """
+    :param docs: a site's documents from the STATE_COLLECTION collection
+    :return: dict of level name to watermark datetime, None for levels that have never been processed
+    :rtype: dict
+    """
+    watermarks = {level: None for level in LEVELS}
+    for doc in docs:
+        level = doc.get('level', None)
+        if level in watermarks:
+            watermarks[level] = as_utc(doc.get('watermark', None))
+    return watermarks
+
+
+def set_watermark(mdb, site_no, level, watermark):
+    """
+    :param mdb: the cosmoz mongo database
+    :param site_no:
+    :param level: one of LEVELS
+    :param watermark: the latest raw_values time now processed into this level
+    :type watermark: datetime
+    """
+    getattr(mdb, STATE_COLLECTION).update_one(
+        {'site_no': int(site_no), 'level': level},
+        {'$set': {'watermark': watermark, 'updated': datetime.now().astimezone(timezone.utc)}},
+        upsert=True)
+
+
+def probe_latest_time(influx_client, measurement, site_no):
+    """
+    Cheap probe for the time of the newest record of a site in a measurement.
+    :param influx_client:
+    :param measurement:
+    :param site_no:
+    :return: the time of the newest record, or None if there are none
+    :rtype: datetime | NoneType
+    """
+    result = influx_client.query("""SELECT * FROM "{}" WHERE site_no=$s ORDER BY time DESC LIMIT 1""".format(measurement),
+                                 bind_params={"s": str(site_no)})
+    for p in result.get_points():
+        return isostring_to_datetime(p['time'])
+    return None
+
+
+def is_up_to_date(watermarks, latest_raw_time):
+    """
+    :param watermarks: as from get_watermarks
+    :param latest_raw_time: as from probe_latest_time on raw_values
+    :return: True if every level has already processed the newest raw record
+    :rtype: bool
+    """
+    if latest_raw_time is None:
+        return True
+    return all(wm is not None and wm >= latest_raw_time for wm in watermarks.values())
+
+
+def stage_back_times(watermarks, default_back_time):
+    """
+    Where each level should start processing from.
+    The stages themselves load the lead-in they need before that point
+    (duplicate window, previous count, smoothing context).
+    :param watermarks: as from get_watermarks
+    :param default_back_time: used for levels without a watermark
+    :type default_back_time: datetime
+    :return: dict of level name to back_time
+    :rtype: dict
+    """
+    back_times = {}
+    for level in LEVELS:
+        wm = watermarks.get(level, None)
+        if wm is None:
+            back_times[level] = default_back_time
+        elif level == "level4":
+            back_times[level] = wm - LEVEL4_LOOKBACK
+        else:
+            back_times[level] = wm
+    return back_times
@@ -16,9 +16,9 @@ mkdir -p "./res/archive"
 mkdir -p "./res/sbd-files"
 touch "./res/debug.log"
 
-# How many days to backprocess
+# How many days to backprocess, for sites that have never been processed incrementally
 PROCESS_DAYS=31
-exec python3 - -d $PROCESS_DAYS <<'____HERE'
+exec python3 - -i -r -d $PROCESS_DAYS <<'____HERE'
 import sys
 from datetime import datetime
 from pipeline import cosmoz_process_levels
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+"""test_corrections.py
+The level2 correction kernel against the row-by-row level1->level2 loop it replaced.
+"""
+import math
+import unittest
+
+import numpy as np
+
+from pipeline.corrections import intensity_corr, level2_corrections, press_corr, silo_fallbacks, wv_corr
+
+BETA = 0.0077
+REF_PRESSURE = 1013.25
+REF_INTENSITY = 150.0
+
+
+def old_wv_corr(t, h):
+    return 1+0.0054*((2165*((0.6108*math.exp((17.27*t)/(t+237.3)))*(h/100.0)))/(t+273.16)-0)
+
+
+def old_level2_row(count, pressure1, pressure2, external_temperature, external_humidity,
+                   average_temperature, average_humidity, intensity, scaling, emulate_old_version=False):
+    """
+    The body of the old level1_to_level2 loop, with None for a missing SILO or intensity value.
+    :return: (press_corr, wv_corr_store, intensity_corr, corr_count)
+    """
+    if pressure2 != 0:
+        pc = math.exp(BETA * (pressure2 - REF_PRESSURE))
+    elif pressure1 != 0:
+        pc = math.exp(BETA * (pressure1 - REF_PRESSURE))
+    else:
+        pc = 1.0
+    if external_temperature != 0 and external_humidity != 0:
+        wv_corr_store = wv_corr_use = old_wv_corr(external_temperature, external_humidity)
+    elif average_humidity is not None:
+        use_temp = average_temperature if average_temperature is not None else 0.0
+        wv_corr_use = old_wv_corr(use_temp, average_humidity)
+        if emulate_old_version and average_temperature is None:
+            wv_corr_store = 1.0
+        else:
+            wv_corr_store = wv_corr_use
+    else:
+        use_humidity = average_humidity if external_humidity == 0 else external_humidity
+        use_temp = average_temperature if external_temperature == 0 else external_temperature
+        if use_humidity is None or use_humidity == 0:
+            wv_corr_use = 1.0
+        else:
+            wv_corr_use = old_wv_corr(0.0 if use_temp is None else use_temp, use_humidity)
+        wv_corr_store = 1.0 if emulate_old_version else wv_corr_use
+    if intensity is None or intensity == 0.0:
+        ic = 1.0
+    else:
+        ic = intensity / REF_INTENSITY
+    return pc, wv_corr_store, ic, (float(count)*wv_corr_use*pc/ic)/scaling
+
+
+# count, pressure1, pressure2, external_temperature, external_humidity, average_temperature, average_humidity, intensity
+ROWS = [
+    (1200, 1010.0, 1005.0, 21.5, 60.0, None, None, 160.0),  # external readings, pressure2
+    (1180, 1012.0, 0.0, 18.0, 55.0, None, None, 145.0),  # pressure1
+    (1150, 0.0, 0.0, 0.0, 70.0, 16.0, 65.0, 150.0),  # no pressure, SILO for a zero temperature
+    (1190, 1008.0, 0.0, 22.0, 0.0, 19.5, 48.0, None),  # SILO for a zero humidity, no intensity
+    (1170, 1008.0, 0.0, 0.0, 0.0, None, 52.0, 0.0),  # SILO humidity only, zero intensity
+    (1160, 1009.0, 0.0, 23.0, 0.0, None, None, 155.0),  # no SILO, humidity zero: no correction
+    (1165, 1009.0, 0.0, 0.0, 40.0, None, None, 155.0),  # no SILO, external humidity at zero degrees
+]
+
+
+def _nan(value):
+    return np.nan if value is None else value
+
+
+class Level2CorrectionsTest(unittest.TestCase):
+
+    def _check_rows(self, emulate_old_version):
+        columns = list(zip(*ROWS))
+        result = level2_corrections(*(np.array([_nan(v) for v in c], dtype=np.float64) for c in columns),
+                                    beta=BETA, ref_pressure=REF_PRESSURE, ref_intensity=REF_INTENSITY, scaling=1.25,
+                                    emulate_old_version=emulate_old_version)
+        for i, row in enumerate(ROWS):
+            expected = old_level2_row(*row, scaling=1.25, emulate_old_version=emulate_old_version)
+            got = (result["press_corr"][i], result["wv_corr"][i], result["intensity_corr"][i], result["corr_count"][i])
+            for name, e, g in zip(("press_corr", "wv_corr", "intensity_corr", "corr_count"), expected, got):
+                self.assertAlmostEqual(e, g, places=12, msg="row {} {}".format(i, name))
+
+    def test_matches_old_rows(self):
+        self._check_rows(False)
+
+    def test_matches_old_rows_emulating_old_version(self):
+        self._check_rows(True)
+
+    def test_zero_scaling(self):
+        with self.assertRaises(ZeroDivisionError):
+            level2_corrections([1000], [1000.0], [0.0], [20.0], [50.0], [np.nan], [np.nan], [150.0],
+                               beta=BETA, ref_pressure=REF_PRESSURE, ref_intensity=REF_INTENSITY, scaling=0)
+
+
+class CorrectionTermsTest(unittest.TestCase):
+
+    def test_press_corr(self):
+        got = press_corr([1000.0, 1000.0, 0.0], [990.0, 0.0, 0.0], 0.01, 1000.0)
+        np.testing.assert_allclose(got, [math.exp(-0.1), 1.0, 1.0])
+
+    def test_intensity_corr(self):
+        got = intensity_corr([300.0, 0.0, np.nan, 75.0], 150.0)
+        np.testing.assert_array_equal(got, [2.0, 1.0, 1.0, 0.5])
+
+    def test_wv_corr_without_humidity(self):
+        use, store = wv_corr([25.0], [0.0], [np.nan], [np.nan])
+        self.assertEqual(use[0], 1.0)
+        self.assertEqual(store[0], 1.0)
+
+    def test_wv_corr_zero_humidity(self):
+        # zero relative humidity means no water vapour, the correction is exactly 1
+        use, store = wv_corr([0.0], [0.0], [12.0], [0.0])
+        self.assertEqual(use[0], 1.0)
+
+    def test_silo_fallbacks(self):
+        # external readings, no external humidity with and without SILO, no external temperature with SILO
+        self.assertEqual(silo_fallbacks([20.0, 20.0, 20.0, 0.0], [50.0, 0.0, 0.0, 50.0], [60.0, 60.0, np.nan, 55.0]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+"""test_dirty_ranges.py
+The level ranges recomputed for late-arriving inputs.
+"""
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from pipeline.dirty_ranges import ONE_MICROSECOND, RAW_FORWARD, SMOOTHING_REACH, clip_ranges, extend_range, \
+    level_ranges, merge_ranges
+
+
+def at(day, hour=0, minute=0):
+    return datetime(2019, 1, day, hour, minute, tzinfo=timezone.utc)
+
+
+class MergeRangesTest(unittest.TestCase):
+
+    def test_overlapping_and_touching(self):
+        ranges = [(at(3), at(4)), (at(1), at(2)), (at(2), at(3, 12)), (at(5), at(6))]
+        self.assertEqual(merge_ranges(ranges), [(at(1), at(4)), (at(5), at(6))])
+
+    def test_contained(self):
+        self.assertEqual(merge_ranges([(at(1), at(5)), (at(2), at(3))]), [(at(1), at(5))])
+
+    def test_open_ended(self):
+        self.assertEqual(merge_ranges([(at(1), at(2)), (at(2), None), (at(4), at(5))]), [(at(1), None)])
+        self.assertEqual(merge_ranges([(at(1), None), (at(4), at(5))]), [(at(1), None)])
+
+    def test_extend_range(self):
+        ranges = {}
+        extend_range(ranges, 1, at(3))
+        extend_range(ranges, 1, at(1))
+        extend_range(ranges, 1, at(2))
+        extend_range(ranges, 2, at(4))
+        self.assertEqual(ranges, {1: (at(1), at(3)), 2: (at(4), at(4))})
+
+
+class LevelRangesTest(unittest.TestCase):
+
+    def test_raw(self):
+        ranges = level_ranges([("raw_values", at(1, 10), at(1, 11))])
+        self.assertEqual(ranges["level1"], [(at(1, 10), at(1, 11, 29))])
+        self.assertEqual(ranges["level2"], ranges["level1"])
+        self.assertEqual(ranges["level3"], ranges["level1"])
+        self.assertEqual(ranges["level4"], [(at(1, 10) - SMOOTHING_REACH, at(1, 11, 29) + SMOOTHING_REACH)])
+
+    def test_raw_until_next_record(self):
+        # the next record's count difference changes too
+        ranges = level_ranges([("raw_values", at(1, 10), at(1, 10))], next_raw_time=lambda t: at(1, 12))
+        self.assertEqual(ranges["level1"], [(at(1, 10), at(1, 12))])
+        ranges = level_ranges([("raw_values", at(1, 10), at(1, 10))], next_raw_time=lambda t: at(1, 10, 15))
+        self.assertEqual(ranges["level1"], [(at(1, 10), at(1, 10) + RAW_FORWARD)])
+
+    def test_intensity(self):
+        # points up to the next hour with its own intensity fall back to the changed one
+        ranges = level_ranges([("intensity", at(1, 10, 20), at(1, 11, 40))],
+                              next_intensity_time=lambda t: at(1, 15, 0))
+        self.assertEqual(ranges["level1"], [])
+        self.assertEqual(ranges["level2"], [(at(1, 10), at(1, 15) - ONE_MICROSECOND)])
+        self.assertEqual(ranges["level3"], ranges["level2"])
+
+    def test_intensity_next_hour(self):
+        ranges = level_ranges([("intensity", at(1, 10, 20), at(1, 10, 20))],
+                              next_intensity_time=lambda t: at(1, 11, 0))
+        self.assertEqual(ranges["level2"], [(at(1, 10), at(1, 11) - ONE_MICROSECOND)])
+
+    def test_intensity_without_next(self):
+        ranges = level_ranges([("intensity", at(1, 10, 20), at(1, 10, 20))], next_intensity_time=lambda t: None)
+        self.assertEqual(ranges["level2"], [(at(1, 10), None)])
+        self.assertEqual(ranges["level4"], [(at(1, 10) - SMOOTHING_REACH, None)])
+
+    def test_silo(self):
+        ranges = level_ranges([("silo_data", at(2, 9), at(3, 9))])
+        self.assertEqual(ranges["level2"], [(at(2), at(4) - ONE_MICROSECOND)])
+
+    def test_merged_across_sources(self):
+        ranges = level_ranges([("raw_values", at(2, 23, 50), at(2, 23, 50)), ("silo_data", at(3, 1), at(3, 1))])
+        self.assertEqual(ranges["level1"], [(at(2, 23, 50), at(3, 0, 19))])
+        self.assertEqual(ranges["level2"], [(at(2, 23, 50), at(4) - ONE_MICROSECOND)])
+        # level4 ranges less than 6h2s apart merge
+        ranges = level_ranges([("raw_values", at(1, 0), at(1, 0)), ("raw_values", at(1, 6, 20), at(1, 6, 20))])
+        self.assertEqual(len(ranges["level1"]), 2)
+        self.assertEqual(ranges["level4"], [(at(1, 0) - SMOOTHING_REACH, at(1, 6, 49) + SMOOTHING_REACH)])
+
+    def test_unknown_source(self):
+        with self.assertRaises(ValueError):
+            level_ranges([("level1", at(1), at(1))])
+
+
+class ClipRangesTest(unittest.TestCase):
+
+    def test_clipped_at_back_time(self):
+        ranges = {"level1": [(at(1), at(2)), (at(3), at(5)), (at(6), None)], "level4": [(at(3), None)]}
+        clipped = clip_ranges(ranges, {"level1": at(4), "level4": at(4)})
+        # everything after the back time is left to the incremental run
+        self.assertEqual(clipped, {"level1": [(at(1), at(2)), (at(3), at(4))], "level4": [(at(3), at(4))]})
+
+    def test_without_watermark(self):
+        # no incremental run covers a level without a watermark, so none of its ranges are left out
+        ranges = {"level1": [(at(1), at(2)), (at(6), None)], "level2": [(at(1), at(2))]}
+        clipped = clip_ranges(ranges, {"level1": None, "level2": at(1, 12)})
+        self.assertEqual(clipped, {"level1": [(at(1), at(2)), (at(6), None)], "level2": [(at(1), at(1, 12))]})
+
+    def test_without_any_watermarks(self):
+        ranges = level_ranges([("intensity", at(1, 10, 20), at(1, 10, 20))], next_intensity_time=lambda t: None)
+        self.assertEqual(clip_ranges(ranges, {}), ranges)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+"""test_filters.py
+The level4 smoothing against the query per level3 point it replaced.
+"""
+import unittest
+
+import numpy as np
+
+from pipeline.filters import SMOOTHING_HALF_WIDTH_NS, smooth_level3, window_bounds, windowed_mean
+
+HOUR_NS = 3600 * 1000000000
+
+
+def old_smoothed(times, values, i):
+    """
+    MEAN over SELECT ... WHERE "time" >= t-3h1s AND "time" <= t+3h1s LIMIT 7, as the old level3_to_level4 ran it.
+    """
+    at = times[i]
+    window = [v for t, v in zip(times, values)
+              if at - SMOOTHING_HALF_WIDTH_NS <= t <= at + SMOOTHING_HALF_WIDTH_NS][:7]
+    return sum(window) / len(window)
+
+
+class WindowedMeanTest(unittest.TestCase):
+
+    def test_given_bounds(self):
+        got = windowed_mean([1.0, 2.0, 3.0, 4.0], np.array([0, 0, 1, 3]), np.array([2, 3, 4, 3]))
+        np.testing.assert_array_equal(got[:3], [1.5, 2.0, 3.0])
+        # an empty window has no mean
+        self.assertTrue(np.isnan(got[3]))
+
+    def test_hourly_windows(self):
+        times = np.arange(10, dtype=np.int64) * HOUR_NS
+        starts, ends = window_bounds(times)
+        # 3h1s either side of 5h takes in 2h to 8h, seven samples
+        self.assertEqual((starts[5], ends[5]), (2, 9))
+        # at the start, 0h to 3h
+        self.assertEqual((starts[0], ends[0]), (0, 4))
+
+    def test_window_edges_are_inclusive(self):
+        times = np.array([0, SMOOTHING_HALF_WIDTH_NS, SMOOTHING_HALF_WIDTH_NS + 1], dtype=np.int64)
+        starts, ends = window_bounds(times)
+        np.testing.assert_array_equal(starts, [0, 0, 1])
+        np.testing.assert_array_equal(ends, [2, 3, 3])
+
+    def test_limit_keeps_the_first_samples(self):
+        # every 20 minutes, a window holds 19 samples and only its first 7 are averaged
+        times = np.arange(40, dtype=np.int64) * (HOUR_NS // 3)
+        values = np.arange(40, dtype=np.float64) ** 2
+        smoothed, _ = smooth_level3(times, values, values)
+        self.assertEqual(smoothed[20], (11 ** 2 + 12 ** 2 + 13 ** 2 + 14 ** 2 + 15 ** 2 + 16 ** 2 + 17 ** 2) / 7.0)
+
+    def test_matches_old_queries(self):
+        rng = np.random.RandomState(7)
+        # irregular gaps, some of them wider than the window
+        times = np.cumsum(rng.choice([15, 30, 60, 60, 60, 420], size=200) * 60 * 1000000000).astype(np.int64)
+        soil_moist = rng.uniform(5.0, 40.0, size=200)
+        effective_depth = rng.uniform(10.0, 30.0, size=200)
+        soil_moist_filtered, depth_filtered = smooth_level3(times, soil_moist, effective_depth)
+        for i in range(len(times)):
+            self.assertAlmostEqual(soil_moist_filtered[i], old_smoothed(times, soil_moist, i), places=10)
+            self.assertAlmostEqual(depth_filtered[i], old_smoothed(times, effective_depth, i), places=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
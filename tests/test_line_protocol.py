@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+"""test_line_protocol.py
+encode_columns against influxdb's make_lines for the same points.
+"""
+import unittest
+
+import numpy as np
+from influxdb.line_protocol import make_lines
+
+from pipeline.line_protocol import encode_columns
+
+NS_PER_SECOND = 1000000000
+
+
+def points_from_columns(measurement, tags, fields, times, tag_columns=None):
+    points = []
+    for i, at in enumerate(times):
+        point_tags = dict(tags)
+        for k, column in (tag_columns or {}).items():
+            point_tags[k] = column[i].item() if isinstance(column, np.ndarray) else column[i]
+        points.append({
+            "measurement": measurement,
+            "tags": point_tags,
+            "time": int(at),
+            "fields": {k: (v[i].item() if isinstance(v, np.ndarray) else v[i]) for k, v in fields.items()},
+        })
+    return points
+
+
+class EncodeColumnsTest(unittest.TestCase):
+
+    def _check(self, measurement, tags, fields, times, tag_columns=None):
+        precision, lines = encode_columns(measurement, tags, fields, times, tag_columns=tag_columns)
+        points = points_from_columns(measurement, tags, fields, times, tag_columns=tag_columns)
+        if precision == 's':
+            for p in points:
+                p["time"] //= NS_PER_SECOND
+        self.assertEqual([line for _, line in lines], make_lines({"points": points}).splitlines())
+        for (series, line) in lines:
+            self.assertTrue(line.startswith(series + " "))
+        return precision, lines
+
+    def test_level_columns(self):
+        times = np.array([1546302600, 1546303500, 1546304400], dtype=np.int64) * NS_PER_SECOND
+        precision, _ = self._check("level1", {"site_no": "1"}, {
+            "count": [812, 790, 805],
+            "pressure1": np.array([1015.41, 1015.0, 1014.875]),
+            "rain": np.array([0.0, 0.2, 1e-07]),
+        }, times, tag_columns={"flag": np.array([0, 1, 0], dtype=np.int8)})
+        self.assertEqual(precision, 's')
+
+    def test_nanosecond_times(self):
+        times = np.array([1546302600 * NS_PER_SECOND + 1, 1546303500 * NS_PER_SECOND], dtype=np.int64)
+        precision, lines = self._check("level4", {"site_no": "2"}, {"soil_moist": np.array([11.5, 12.25])}, times)
+        self.assertEqual(precision, 'n')
+        self.assertEqual(lines[0][1], "level4,site_no=2 soil_moist=11.5 1546302600000000001")
+
+    def test_sparse_and_mixed_fields(self):
+        times = np.array([1, 2, 3], dtype=np.int64) * NS_PER_SECOND
+        self._check("m", {"site_no": "3"}, {
+            "a": [1.5, None, 2.5],
+            "b": [None, None, 7],
+            "c": ["x y", "z", "q\"uote"],
+            "d": np.array([True, False, True]),
+            "e": np.array([4, 5, 6], dtype=np.int32),
+        }, times)
+
+    def test_nan_fields_left_out(self):
+        times = np.array([1, 2, 3, 4], dtype=np.int64) * NS_PER_SECOND
+        precision, lines = encode_columns("level3", {"site_no": "4"}, {
+            "soil_moist": np.array([11.5, np.nan, np.nan, 12.0]),
+            "depth": [150.0, 140.0, float('nan'), None],
+        }, times)
+        self.assertEqual(precision, 's')
+        self.assertEqual([line for _, line in lines], [
+            "level3,site_no=4 depth=150.0,soil_moist=11.5 1",
+            "level3,site_no=4 depth=140.0 2",
+            "level3,site_no=4 soil_moist=12.0 4",
+        ])
+
+    def test_escaping_and_empty_tags(self):
+        times = np.array([10, 20], dtype=np.int64) * NS_PER_SECOND
+        self._check("my measurement", {"site no": "a,b=c", "empty": ""}, {"field key": np.array([1.0, 2.0])},
+                    times, tag_columns={"flag": ["0", ""]})
+
+    def test_series_keys(self):
+        times = np.array([1, 2, 3], dtype=np.int64) * NS_PER_SECOND
+        _, lines = encode_columns("level2", {"site_no": "1"}, {"count": [1, 2, 3]}, times,
+                                  tag_columns={"flag": np.array([0, 5, 0], dtype=np.int8)})
+        self.assertEqual([series for series, _ in lines],
+                         ["level2,flag=0,site_no=1", "level2,flag=5,site_no=1", "level2,flag=0,site_no=1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+"""test_promote.py
+The checks and deletes of a --dropold rebuild's promotion.
+"""
+import unittest
+
+import numpy as np
+
+from pipeline.cosmoz_process_levels import day_counts, stale_day_statements, staged_level_problems
+from pipeline.utils import DAY_NS
+
+
+def times(*values):
+    return np.array(values, dtype=np.int64)
+
+
+def complete_rebuild():
+    return {
+        "level1": {0: times(10, 30), 1: times(20)},
+        "level2": {0: times(10, 30), 1: times(20)},
+        "level3": {0: times(10), 5: times(20, 30)},
+        "level4": {None: times(10)},
+    }
+
+
+class StagedLevelProblemsTest(unittest.TestCase):
+
+    def test_complete(self):
+        self.assertEqual(staged_level_problems(complete_rebuild()), [])
+
+    def test_empty(self):
+        problems = staged_level_problems({level: {} for level in ("level1", "level2", "level3", "level4")})
+        self.assertEqual(problems, ["level1 has no points"])
+
+    def test_same_counts_at_other_times(self):
+        staged = complete_rebuild()
+        staged["level3"] = {0: times(10), 5: times(20, 40)}
+        self.assertEqual(staged_level_problems(staged), ["level3 times are not level2's"])
+
+    def test_level2_flags(self):
+        staged = complete_rebuild()
+        staged["level2"] = {0: times(10, 20, 30)}
+        self.assertEqual(staged_level_problems(staged), ["level2 points are not level1's"])
+
+    def test_level4_outside_level3(self):
+        staged = complete_rebuild()
+        staged["level4"] = {None: times(10, 15)}
+        self.assertEqual(staged_level_problems(staged), ["level4 has 1 points at times level3 does not have"])
+
+
+class StaleDayStatementsTest(unittest.TestCase):
+
+    def test_day_counts(self):
+        counts = day_counts({0: times(10, 20, DAY_NS + 5), 1: times(DAY_NS + 6)})
+        self.assertEqual(counts, {(0, 0): 2, (0, DAY_NS): 1, (1, DAY_NS): 1})
+
+    def test_nothing_stale(self):
+        staged = day_counts({0: times(10, DAY_NS + 5)})
+        self.assertEqual(stale_day_statements("level1", dict(staged), staged), [])
+
+    def test_stale_days(self):
+        staged = day_counts({0: times(10, 2 * DAY_NS + 5), 1: times(DAY_NS + 7)})
+        # an extra flag 0 point on day 2, and a flag 3 series the rebuild has no points of
+        live = {(0, 0): 1, (0, 2 * DAY_NS): 2, (1, DAY_NS): 1, (3, DAY_NS): 4}
+        day_2 = """ AND flag='0' AND "time" >= {} AND "time" < {}""".format(2 * DAY_NS, 3 * DAY_NS)
+        self.assertEqual(stale_day_statements("level1", live, staged), [
+            """DELETE FROM "level1" WHERE site_no=$s AND flag='3'""",
+            'DELETE FROM "level1" WHERE site_no=$s' + day_2,
+            'SELECT * INTO "level1" FROM "level1_staging" WHERE site_no=$s' + day_2 + ' GROUP BY *',
+        ])
+
+    def test_unflagged_level(self):
+        staged = day_counts({None: times(10, 20)})
+        day_0 = """ AND "time" >= 0 AND "time" < {}""".format(DAY_NS)
+        self.assertEqual(stale_day_statements("level4", {(None, 0): 3}, staged), [
+            'DELETE FROM "level4" WHERE site_no=$s' + day_0,
+            'SELECT * INTO "level4" FROM "level4_staging" WHERE site_no=$s' + day_0 + ' GROUP BY *',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
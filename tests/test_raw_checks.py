@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+"""test_raw_checks.py
+The raw->level1 checks against the row-by-row raw_to_level1 loop they replaced.
+"""
+import unittest
+
+import numpy as np
+
+from pipeline.raw_checks import DUPLICATE_WINDOW_NS, RAW_COMPARE_FIELDS, column_record_keys, duplicate_mask, \
+    level1_flags
+
+MINUTE_NS = 60 * 1000000000
+
+
+def old_duplicates(times, keys):
+    """
+    The old duplicate check: a record is a duplicate of any record in the 29 minutes before it, up to its own time.
+    """
+    return [any(times[i] - DUPLICATE_WINDOW_NS <= times[j] < times[i] and keys[j] == keys[i] for j in range(len(times)))
+            for i in range(len(times))]
+
+
+class DuplicateMaskTest(unittest.TestCase):
+
+    def test_window(self):
+        times = np.array([0, 10, 29, 39, 59, 70], dtype=np.int64) * MINUTE_NS
+        keys = [("a",), ("b",), ("a",), ("b",), ("a",), ("b",)]
+        # 29 minutes after an identical record is still a duplicate, 30 minutes is not
+        np.testing.assert_array_equal(duplicate_mask(times, keys), [False, False, True, True, False, False])
+
+    def test_same_time_is_not_compared(self):
+        times = np.array([0, 0, 5], dtype=np.int64) * MINUTE_NS
+        np.testing.assert_array_equal(duplicate_mask(times, [("a",)] * 3), [False, False, True])
+
+    def test_matches_old_check(self):
+        rng = np.random.RandomState(3)
+        times = np.cumsum(rng.randint(0, 20, size=300)).astype(np.int64) * MINUTE_NS
+        keys = [(int(k),) for k in rng.randint(0, 4, size=300)]
+        np.testing.assert_array_equal(duplicate_mask(times, keys), old_duplicates(times, keys))
+
+    def test_record_keys(self):
+        columns = {f: np.array([1.0, 1.0, 1.0]) for f in RAW_COMPARE_FIELDS}
+        columns["count"] = np.array([800, 800, 801], dtype=np.int64)
+        columns["vwc1"] = np.array([np.nan, np.nan, 0.5])
+        keys = column_record_keys(columns)
+        # missing fields compare equal
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[1], keys[2])
+        self.assertIsNone(keys[0][RAW_COMPARE_FIELDS.index("vwc1")])
+
+
+def old_level1_flag(count, prev_count, battery, raw_flag):
+    """
+    The old raw_to_level1 flag, with prev_count from DIFFERENCE("count").
+    """
+    if battery < 10:
+        return 4
+    elif count < (0.8 * prev_count) or count > (1.2 * prev_count):
+        return 1
+    return raw_flag
+
+
+class Level1FlagsTest(unittest.TestCase):
+
+    def test_flags(self):
+        count = [1000, 1100, 1400, 1100, 880, 879, 900]
+        battery = [12.0, 12.0, 12.0, 9.5, 12.0, 12.0, 9.9]
+        raw_flag = [0, 0, 0, 0, 2, 0, 0]
+        flags, prev_count = level1_flags(count, battery, raw_flag)
+        # 1100 is within 20% of 1000, 1400 is not, and neither is 1100 after it, but its battery is low.
+        # 880 is exactly 80% of 1100, 879 is within 20% of 880
+        np.testing.assert_array_equal(flags, [0, 0, 1, 4, 2, 0, 4])
+        self.assertTrue(np.isnan(prev_count[0]))
+        np.testing.assert_array_equal(prev_count[1:], count[:-1])
+
+    def test_matches_old_rows(self):
+        rng = np.random.RandomState(5)
+        count = rng.randint(600, 1400, size=200)
+        battery = rng.uniform(9.0, 13.0, size=200)
+        raw_flag = rng.randint(0, 3, size=200)
+        flags, _ = level1_flags(count, battery, raw_flag)
+        # the old loop skipped the first record, it has no previous count
+        expected = [old_level1_flag(count[i], count[i - 1], battery[i], raw_flag[i]) for i in range(1, 200)]
+        np.testing.assert_array_equal(flags[1:], expected)
+
+    def test_first_record_keeps_its_raw_flag(self):
+        flags, _ = level1_flags([5000], [12.0], [2])
+        self.assertEqual(flags[0], 2)
+
+    def test_negative_count(self):
+        with self.assertRaises(ValueError):
+            level1_flags([-1, 1000], [12.0, 12.0], [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+"""test_soil_moisture.py
+level3_values against the row-by-row level2->level3 loop it replaced.
+"""
+import unittest
+
+import numpy as np
+
+from pipeline.soil_moisture import level3_values
+
+SOIL_PARAMS = {'n0_cal': 1000.0, 'bulk_density': 1.4, 'lattice_soil_organic_sum': 0.05}
+
+
+def old_level3_row(wv_corr, corr_count, level2_flag, rain, alternate_algorithm=None):
+    """
+    The body of the old level2_to_level3 loop.
+    :return: (soil_moist, effective_depth, rainfall, flag)
+    """
+    n0_cal = SOIL_PARAMS['n0_cal']
+    bulk_density = SOIL_PARAMS['bulk_density']
+    lattice_soil_organic_sum = SOIL_PARAMS['lattice_soil_organic_sum']
+    if alternate_algorithm == "sandy":
+        if wv_corr == 1.0:
+            flag = 5
+        elif corr_count > (3.0 * n0_cal):
+            flag = 3
+        elif corr_count < (0.5 * n0_cal):
+            flag = 2
+        else:
+            flag = level2_flag
+        corrected_moist_val = 1216036430.0 * (corr_count ** -3.272)
+    else:
+        if wv_corr == 1.0:
+            flag = 5
+        elif corr_count > n0_cal:
+            flag = 3
+        elif corr_count < (0.4 * n0_cal):
+            flag = 2
+        else:
+            flag = level2_flag
+        corrected_moist_val = (0.0808 / ((corr_count / n0_cal) - 0.372) - 0.115 - lattice_soil_organic_sum) * bulk_density
+    effective_depth = 5.8 / ((lattice_soil_organic_sum * bulk_density) + corrected_moist_val + 0.0829)
+    return corrected_moist_val * 100.0, effective_depth, rain * 0.2, flag
+
+
+# wv_corr, corr_count, level2_flag, rain
+ROWS = [
+    (1.01, 700.0, 0, 0.0),
+    (1.02, 650.0, 1, 2.0),  # keeps its level2 flag
+    (1.0, 700.0, 0, 1.0),  # no water vapour correction
+    (1.0, 1100.0, 0, 0.0),  # no water vapour correction takes precedence over too high
+    (1.01, 1100.0, 4, 0.0),  # too high for standard
+    (1.01, 390.0, 0, 0.0),  # too low for standard
+    (1.01, 450.0, 0, 0.0),  # too low only for sandy
+    (1.01, 2500.0, 0, 0.0),  # too high only for standard
+]
+
+
+class Level3ValuesTest(unittest.TestCase):
+
+    def _check_rows(self, alternate_algorithm, old_algorithm):
+        wv_corr, corr_count, level2_flag, rain = (np.array(c) for c in zip(*ROWS))
+        result = level3_values(corr_count, wv_corr, level2_flag, rain, SOIL_PARAMS,
+                               alternate_algorithm=alternate_algorithm)
+        for i, row in enumerate(ROWS):
+            soil_moist, effective_depth, rainfall, flag = old_level3_row(*row, alternate_algorithm=old_algorithm)
+            self.assertAlmostEqual(result["soil_moist"][i], soil_moist, places=10, msg="row {}".format(i))
+            self.assertAlmostEqual(result["effective_depth"][i], effective_depth, places=10, msg="row {}".format(i))
+            self.assertAlmostEqual(result["rainfall"][i], rainfall, places=12, msg="row {}".format(i))
+            self.assertEqual(result["flag"][i], flag, msg="row {}".format(i))
+
+    def test_standard(self):
+        self._check_rows(None, None)
+
+    def test_sandy(self):
+        self._check_rows("sandy", "sandy")
+
+    def test_unknown_algorithm_is_standard(self):
+        self._check_rows("loamy", None)
+
+    def test_standard_by_hand(self):
+        result = level3_values([700.0], [1.01], [0], [3.0], SOIL_PARAMS)
+        # 0.0808 / (0.7 - 0.372) = 0.246341..., less 0.115 and 0.05, times 1.4
+        self.assertAlmostEqual(result["soil_moist"][0], 11.387804878, places=8)
+        self.assertAlmostEqual(result["effective_depth"][0], 5.8 / (0.07 + 0.11387804878 + 0.0829), places=8)
+        self.assertAlmostEqual(result["rainfall"][0], 0.6)
+        self.assertEqual(result["flag"][0], 0)
+
+    def test_division_by_zero(self):
+        # corr_count / n0_cal == 0.372 divides by zero in the standard model, as the old loop did
+        with self.assertRaises(ZeroDivisionError):
+            level3_values([372.0], [1.01], [0], [0.0], SOIL_PARAMS)
+
+
+if __name__ == '__main__':
+    unittest.main()